@@ -2,9 +2,11 @@ import os
 import re
 import csv
 
-from cmlibs.maths.vectorops import magnitude_squared, sub
+import numpy as np
 
 from annotations import load_approved_vagus_marker_terms
+from dataset_files import dataset_basename, has_dataset_extension, is_dataset_dir, list_dataset_dirs, \
+    open_dataset_file, walk_dataset
 
 
 trunk_keywords = ['left cervical trunk', 'right cervical trunk', 'left thoracic trunk', 'right thoracic trunk',
@@ -22,23 +24,24 @@ non_vagus_branches_keywords = [
 
 def find_tracing_csv_files(microct_path):
     """
-    :param microct_path: path to the folder with csv segmentation files
+    :param microct_path: path to the folder with csv segmentation files. Zip and tar archives are
+        browsed like folders, and gzip compressed .csv.gz files are included.
     :return: Dict mapping segment name to list of csv files paths
     """
 
     segment_files = {}
-    if os.path.isdir(microct_path):
+    if is_dataset_dir(microct_path):
         # find csv segmentation files in the supplied folder
-        segment_paths = [f.path for f in os.scandir(microct_path) if f.is_dir()]
+        segment_paths = list_dataset_dirs(microct_path)
         for segment_path in segment_paths:
-            segment_filename = os.path.basename(os.path.normpath(segment_path))
+            segment_filename = dataset_basename(segment_path)
             segment_name = list(filter(lambda x: 'TL' in x or 'CL' in x or 'TR' in x or 'CR' in x,
                                        segment_filename.split('-')))[0]
 
             # find all csv files in a given segment
             csv_files = []
-            for rootpath, dirs, files in os.walk(segment_path):
-                files_to_add = [os.path.join(rootpath, f) for f in files if f.endswith('.csv')]
+            for rootpath, dirs, files in walk_dataset(segment_path):
+                files_to_add = [os.path.join(rootpath, f) for f in files if has_dataset_extension(f, '.csv')]
                 csv_files.extend(files_to_add)
 
             if len(csv_files) > 0:
@@ -108,9 +111,149 @@ def suggest_parent_name(branch_name, side_label, trunk_group_name):
     return try_parent_name
 
 
-def read_segment_csv_files(csv_files):
+def csv_file_group_name(csv_file):
+    """
+    :param csv_file: path to csv file, e.g. SUB01-CL2-left_cervical_trunk.csv
+    :return: group name from the end of the file name, e.g. left cervical trunk
+    """
+
+    return csv_file.split('-')[-1].split('.')[0].replace('_', ' ')
+
+
+def is_trunk_group_name(group_name):
+    """
+    :param group_name: name of the group read from the csv file name
+    :return: True if the group is the trunk of the segment.
+    """
+
+    return any(keyword in group_name.lower() for keyword in trunk_keywords) and 'branch' not in group_name.lower()
+
+
+def find_trunk_group_name(csv_files):
+    """
+    Find the trunk group name from the csv file names only, without reading the files.
+    :param csv_files: List with paths to csv files.
+    :return: Name used for trunk group, same as read_segment_csv_files, or None if there is no trunk file.
+    """
+
+    trunk_group_name = None
+    for csv_file in csv_files:
+        group_name = csv_file_group_name(csv_file)
+        if group_name != 'vagal levels' and is_trunk_group_name(group_name):
+            trunk_group_name = group_name
+    return trunk_group_name
+
+
+def find_branch_group_names(csv_files):
+    """
+    Find the names of the branch groups from the csv file names only, without reading the files.
+    :param csv_files: List with paths to csv files of a segment.
+    :return: list of branch group names, in file order without repeats.
+    """
+
+    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
+    return list(dict.fromkeys(
+        group_name for group_name in (csv_file_group_name(csv_file) for csv_file in csv_files)
+        if classify_csv_group(group_name, side_label) == 'branch'))
+
+
+def classify_csv_group(group_name, side_label):
+    """
+    :param group_name: name of the group read from the csv file name
+    :param side_label: left or right
+    :return: 'marker', 'trunk' or 'branch', or None if the file is not used.
+    """
+
+    if group_name == 'vagal levels':
+        return 'marker'
+    if is_trunk_group_name(group_name):
+        return 'trunk'
+    # remove this condition to consider all branches (vagus/non-vagus)
+    if any(keyword in group_name.lower() for keyword in branch_keywords):
+        # check if branch is a part of vagus
+        if not branch_is_non_vagal(group_name, side_label):
+            return 'branch'
+    return None
+
+
+def read_marker_csv_file(csv_file, vagus_marker_terms, file_buffers=None):
+    """
+    :param csv_file: path to vagal levels csv file.
+    :param vagus_marker_terms: Dict of approved vagus marker terms.
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+    :return: Dict mapping marker name to marker x, y, z coordinate.
+    """
+
+    marker_data = {}
+    with open_dataset_file(csv_file, file_buffers=file_buffers) as csvfile:
+        plots = csv.reader(csvfile, delimiter=',')
+        next(plots, None)  # skip the headers
+        for row in plots:
+            marker_name = row[0]
+            if marker_name not in vagus_marker_terms.keys():
+                # correct marker name
+                marker_name = marker_name + ' on the vagus nerve'
+                if marker_name not in vagus_marker_terms.keys():
+                    # ignore marker if not in the list
+                    continue
+            marker_point = [float(row[3]), float(row[2]), float(row[1])]
+            marker_data[marker_name] = marker_point
+    return marker_data
+
+
+def read_coordinates_csv_file(csv_file, file_buffers=None, dtype=None):
+    """
+    :param csv_file: path to trunk or branch csv file.
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+    :param dtype: optional numpy dtype, e.g. 'float32', to return coordinates as N x 3 numpy array.
+    :return: list of x, y, z coordinates.
+    """
+
+    coordinates = []
+    with open_dataset_file(csv_file, file_buffers=file_buffers) as csvfile:
+        plots = csv.reader(csvfile, delimiter=',')
+        next(plots, None)  # skip headers
+        for row in plots:
+            # read z, y, x coordinates
+            coordinates.append([float(row[3]), float(row[2]), float(row[1])])
+    if dtype:
+        coordinates = np.array(coordinates, dtype=dtype).reshape(-1, 3)
+    return coordinates
+
+
+def iterate_segment_csv_files(csv_files, file_buffers=None, dtype=None):
+    """
+    Read the csv files of a segment one at a time, yielding each classified group as soon as its file is parsed.
+    Non-vagal branch files are skipped without reading them.
+    :param csv_files: List with paths to csv files.
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+    :param dtype: optional numpy dtype, e.g. 'float32', to store coordinates as N x 3 numpy arrays.
+    :return: generator of (group type, group name, group data) where group type is 'marker' with Dict mapping
+        marker name to x, y, z coordinate, or 'trunk' or 'branch' with list of x, y, z coordinates.
+    """
+
+    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
+
+    vagus_marker_terms = load_approved_vagus_marker_terms()
+
+    for csv_file in csv_files:
+        group_name = csv_file_group_name(csv_file)
+        group_type = classify_csv_group(group_name, side_label)
+        if group_type == 'marker':
+            yield group_type, group_name, read_marker_csv_file(csv_file, vagus_marker_terms, file_buffers)
+        elif group_type is not None:
+            yield group_type, group_name, read_coordinates_csv_file(csv_file, file_buffers, dtype)
+        elif any(keyword in group_name.lower() for keyword in branch_keywords):
+            # ignore non vagus structures for now
+            print('Ignored non-vagal branch:', group_name)
+
+
+def read_segment_csv_files(csv_files, file_buffers=None, dtype=None):
     """
     :param csv_files: List with paths to csv files.
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+    :param dtype: optional numpy dtype, e.g. 'float32', to store trunk and branch coordinates as N x 3 numpy
+        arrays instead of lists of floats, using less memory.
     :return:
         marker_data: Dict mapping marker name to marker x, y, z coordinate.
         trunk_group_name: Name used for trunk group.
@@ -120,65 +263,254 @@ def read_segment_csv_files(csv_files):
 
     marker_data = {}
     trunk_group_name = None
-    branch_group_names = []
     trunk_coordinates = []
     branch_coordinates_data = {}
 
-    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
-        
-    vagus_marker_terms = load_approved_vagus_marker_terms()
-
-    # read data from all csv files 
-    for csv_file in csv_files:
-        group_name = csv_file.split('-')[-1].split('.')[0].replace('_', ' ')
-        
-        if group_name == 'vagal levels':
-            # read markers file
-            with open(csv_file, 'r') as csvfile:
-                plots = csv.reader(csvfile, delimiter=',')
-                next(plots, None)  # skip the headers
-                for row in plots: 
-                    marker_name = row[0]
-                    if marker_name not in vagus_marker_terms.keys(): 
-                        # correct marker name
-                        marker_name = marker_name + ' on the vagus nerve'
-                        if marker_name not in vagus_marker_terms.keys():
-                            # ignore marker if not in the list
-                            continue
-                    marker_point = [float(row[3]), float(row[2]), float(row[1])]
-                    marker_data[marker_name] = marker_point
+    # read data from all csv files
+    for group_type, group_name, group_data in iterate_segment_csv_files(csv_files, file_buffers, dtype):
+        if group_type == 'marker':
+            marker_data.update(group_data)
+        elif group_type == 'trunk':
+            trunk_group_name = group_name
+            trunk_coordinates = group_data
         else:
-            # read trunk / branches file
-            coordinates = []       
-            with open(csv_file, 'r') as csvfile:
-                plots = csv.reader(csvfile, delimiter=',')
-                next(plots, None)  # skip headers
-                for row in plots:
-                    # read z, y, x coordinates
-                    coordinates.append([float(row[3]), float(row[2]), float(row[1])])
-
-            if any(keyword in group_name.lower() for keyword in trunk_keywords) and 'branch' not in group_name.lower():
-                trunk_group_name = group_name
-                trunk_coordinates = coordinates[:]
-
-            # remove this condition to consider all branches (vagus/non-vagus)
-            if any(keyword in group_name.lower() for keyword in branch_keywords) and group_name != trunk_group_name:
-                # check if branch is a part of vagus
-                if branch_is_non_vagal(group_name, side_label):
-                    # ignore non vagus structures for now
-                    print('Ignored non-vagal branch:', group_name)
-                else:
-                    branch_group_names.append(group_name)
-                    branch_coordinates_data[group_name] = coordinates[:]
-    
+            branch_coordinates_data[group_name] = group_data
+
     return marker_data, trunk_group_name, trunk_coordinates, branch_coordinates_data
-    
 
-def process_segment_csv_files(csv_files, minimal_distance_allowed):
+
+def find_branch_parent(branch_name, side_label, trunk_group_name, trunk_coordinates, branch_coordinates_data):
+    """
+    :param branch_name: name of branch.
+    :param side_label: left or right.
+    :param trunk_group_name: name of trunk.
+    :param trunk_coordinates: list of x, y, z coordinates for trunk group.
+    :param branch_coordinates_data: dictionary mapping branch name to list with x, y, z branch coordinates
+    :return: name of the parent group (other branch or trunk) and its list of x, y, z coordinates.
+    """
+
+    try_parent_name = suggest_parent_name(branch_name, side_label, trunk_group_name)
+
+    if try_parent_name != branch_name and try_parent_name in branch_coordinates_data.keys():
+        return try_parent_name, branch_coordinates_data[try_parent_name][:]
+
+    # if parent is not a branch, use trunk as default parent
+    return trunk_group_name, trunk_coordinates[:]
+
+
+def find_closest_parent_point(branch_start_point, branch_end_point, parent_coordinates):
+    """
+    :param branch_start_point: x, y, z coordinate near the start of the branch
+    :param branch_end_point: x, y, z coordinate at the end of the branch
+    :param parent_coordinates: list of x, y, z coordinates of the parent group
+    :return:
+        min_dsq: smallest squared distance between the branch start/end point and the parent.
+        closest_branch_point: branch start or end point closest to the parent, None if parent has no points.
+        closest_parent_index: index of the parent coordinate closest to the branch, None if parent has no points.
+    """
+
+    min_dsq = float('inf')
+    closest_branch_point = None
+    closest_parent_index = None
+    if len(parent_coordinates) == 0:
+        return min_dsq, closest_branch_point, closest_parent_index
+
+    # distances are always calculated in double precision, also for float32 coordinates
+    parent_points = np.asarray(parent_coordinates, dtype=np.float64)
+    for bi in [branch_start_point, branch_end_point]:
+        distances_squared = np.sum((parent_points - np.asarray(bi, dtype=np.float64)) ** 2, axis=1)
+        # last of equally close parent points, as found by a sequential search
+        i = len(distances_squared) - 1 - int(np.argmin(distances_squared[::-1]))
+        if distances_squared[i] <= min_dsq:
+            min_dsq = float(distances_squared[i])
+            closest_branch_point = bi
+            closest_parent_index = i
+
+    return min_dsq, closest_branch_point, closest_parent_index
+
+
+def sort_branch_names(branch_names):
+    """
+    :param branch_names: list with names of the branches.
+    :return: list with names of the branches, sorted from first level to second level branches.
+    """
+
+    second_level_branch_pattern = r'.*?branch[A-Z a-z]* of'
+    first_level_branches = [branch_name for branch_name in branch_names
+                            if not re.search(second_level_branch_pattern, branch_name.lower())]
+    second_level_branches = [branch_name for branch_name in branch_names
+                             if re.search(second_level_branch_pattern, branch_name.lower())]
+    return first_level_branches + second_level_branches
+
+
+def find_branch_parent_name(branch_name, side_label, trunk_group_name, branch_names):
+    """
+    :param branch_name: name of branch.
+    :param side_label: left or right.
+    :param trunk_group_name: name of trunk.
+    :param branch_names: names of all branches of the segment.
+    :return: name of the parent group (other branch or trunk), same as find_branch_parent.
+    """
+
+    try_parent_name = suggest_parent_name(branch_name, side_label, trunk_group_name)
+    if try_parent_name != branch_name and try_parent_name in branch_names:
+        return try_parent_name
+    return trunk_group_name
+
+
+def stitch_branch(branch_name, branch_coordinates, parent_name, parent_coordinates, minimal_distance_allowed):
+    """
+    :param branch_name: name of branch.
+    :param branch_coordinates: list of x, y, z coordinates of the branch as read.
+    :param parent_name: name of the parent group (other branch or trunk).
+    :param parent_coordinates: list of x, y, z coordinates of the parent group.
+    :param minimal_distance_allowed: tolerance used for branch stitching
+    :return:
+        branch_coordinates: branch coordinates starting from the parent if stitched, otherwise unchanged.
+        parent: (parent branch name, index of parent coordinate where branch links to the parent),
+            or (None, None) if the branch is too far away to be stitched.
+    """
+
+    # assumes that branches coordinates are recorded from start to end
+    # ignores first branch point near trunk
+    branch_start_point = branch_coordinates[1]
+    branch_end_point = branch_coordinates[-1]
+
+    # find closest to branch distance, branch start, group node closest to the branch
+    min_dsq, closest_branch_point, closest_parent_index = find_closest_parent_point(
+        branch_start_point, branch_end_point, parent_coordinates)
+
+    if min_dsq < minimal_distance_allowed:
+        # print('  ', branch_name, '->', parent_name, closest_parent_index, min_dsq)
+
+        # remove first branch node near trunk
+        stitched_coordinates = branch_coordinates[1:]
+        if tuple(closest_branch_point) == tuple(branch_end_point):
+            # reverse list of coordinates if necessary so that the data always starts from parent
+            print('  branch reversed')
+            stitched_coordinates = stitched_coordinates[::-1]
+        # remember closest parent node index
+        return stitched_coordinates, (parent_name, closest_parent_index)
+
+    # branch is too far away to be stitched
+    print('  ', branch_name, 'has no parent, potentially looked at', parent_name, ', min_dsq =', str(min_dsq))
+    return branch_coordinates, (None, None)
+
+
+def iterate_stitched_segment_groups(csv_files, minimal_distance_allowed, file_buffers=None, dtype=None):
+    """
+    Read and stitch the groups of a segment one at a time. Group names and parents are known from the csv file
+    names, so each branch is stitched as soon as its own and its parent's data are read, and groups are released
+    as soon as they have been yielded and are no longer needed as parents. Peak memory therefore follows the
+    largest groups rather than the whole segment. Results are the same as process_segment_csv_files.
+    :param csv_files: List with paths to csv files.
+    :param minimal_distance_allowed: tolerance used for branch stitching
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+    :param dtype: optional numpy dtype, e.g. 'float32', to store coordinates as numpy arrays.
+    :return: generator of (group type, group name, group data):
+        ('marker', 'vagal levels', Dict mapping marker name to x, y, z coordinate) as soon as markers are read,
+        ('trunk', trunk group name or None, list of trunk x, y, z coordinates) before all branches, then
+        ('branch', branch name, (list of branch x, y, z coordinates, (parent branch name, parent index)))
+        for each branch sorted from first level to second level branches, with parent (None, None) if unstitched.
+    """
+
+    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
+
+    # everything except the coordinates is known from the file names
+    trunk_group_name = find_trunk_group_name(csv_files)
+    branch_names = sort_branch_names(find_branch_group_names(csv_files))
+    branch_order = {branch_name: index for index, branch_name in enumerate(branch_names)}
+    branch_parent_names = {branch_name: find_branch_parent_name(branch_name, side_label, trunk_group_name,
+                                                                branch_names) for branch_name in branch_names}
+
+    # branches processed earlier are stitched when their children look for them, later ones are still as read
+    def uses_stitched_parent(branch_name):
+        parent_name = branch_parent_names[branch_name]
+        return parent_name in branch_order and branch_order[parent_name] < branch_order[branch_name]
+
+    # count children still waiting for each group as read (raw) or stitched
+    waiting_raw_children = {}
+    waiting_stitched_children = {}
+    for branch_name, parent_name in branch_parent_names.items():
+        waiting_children = waiting_stitched_children if uses_stitched_parent(branch_name) or \
+            parent_name not in branch_order else waiting_raw_children
+        waiting_children[parent_name] = waiting_children.get(parent_name, 0) + 1
+
+    trunk_coordinates = None if trunk_group_name else []
+    raw_coordinates = {}
+    stitched_groups = {}
+    stitched_names = set()
+    emitted_names = set()
+    trunk_emitted = False
+
+    def release(group_name):
+        if group_name in stitched_names and not waiting_raw_children.get(group_name):
+            raw_coordinates.pop(group_name, None)
+        if group_name in emitted_names and not waiting_stitched_children.get(group_name):
+            stitched_groups.pop(group_name, None)
+
+    for group_type, group_name, group_data in iterate_segment_csv_files(csv_files, file_buffers, dtype):
+        if group_type == 'marker':
+            yield group_type, group_name, group_data
+            continue
+        if group_type == 'trunk':
+            # only the trunk found from the file names is used, as in read_segment_csv_files
+            if group_name == trunk_group_name:
+                trunk_coordinates = group_data
+        elif group_name in branch_order:
+            raw_coordinates[group_name] = group_data
+        group_data = None
+
+        # stitch all branches whose own data and parent data are available
+        for branch_name in branch_names:
+            if (branch_name in stitched_names) or (branch_name not in raw_coordinates):
+                continue
+            parent_name = branch_parent_names[branch_name]
+            if parent_name not in branch_order:
+                parent_coordinates = trunk_coordinates
+            elif uses_stitched_parent(branch_name):
+                parent_coordinates = stitched_groups[parent_name][0] if parent_name in stitched_names else None
+            else:
+                parent_coordinates = raw_coordinates.get(parent_name)
+            if parent_coordinates is None:
+                continue
+            stitched_groups[branch_name] = stitch_branch(branch_name, raw_coordinates[branch_name], parent_name,
+                                                         parent_coordinates, minimal_distance_allowed)
+            stitched_names.add(branch_name)
+            if uses_stitched_parent(branch_name) or parent_name not in branch_order:
+                waiting_stitched_children[parent_name] -= 1
+            else:
+                waiting_raw_children[parent_name] -= 1
+            release(parent_name)
+            release(branch_name)
+
+        # yield trunk, then stitched branches in order
+        if trunk_coordinates is None:
+            continue
+        if not trunk_emitted:
+            trunk_emitted = True
+            yield 'trunk', trunk_group_name, trunk_coordinates
+        for branch_name in branch_names[len(emitted_names):]:
+            if branch_name not in stitched_names:
+                break
+            emitted_names.add(branch_name)
+            yield 'branch', branch_name, stitched_groups[branch_name]
+            release(branch_name)
+        if not waiting_stitched_children.get(trunk_group_name):
+            trunk_coordinates = []
+
+    if not trunk_emitted:
+        # no trunk or branch files were read
+        yield 'trunk', trunk_group_name, trunk_coordinates if trunk_coordinates is not None else []
+
+
+def process_segment_csv_files(csv_files, minimal_distance_allowed, file_buffers=None, dtype=None):
     """
     :param
         csv_files: List with paths to csv files.
         minimal_distance_allowed: tolerance used for branch stitching
+        file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+        dtype: optional numpy dtype, e.g. 'float32', to store coordinates as numpy arrays.
     :return:
         marker_data: Dict mapping marker name to marker x, y, z coordinate.
         trunk_group_name: Name used for trunk group.
@@ -189,67 +521,22 @@ def process_segment_csv_files(csv_files, minimal_distance_allowed):
             (parent branch name, index of parent coordinate where branch links to the parent)
     """
 
-    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
-    marker_data, trunk_group_name, trunk_coordinates, branch_coordinates_data = read_segment_csv_files(csv_files)
-
-    # sort branches (first level, followed by second level branches)
-    second_level_branch_pattern = r'.*?branch[A-Z a-z]* of'
-    first_level_branches = [branch_name for branch_name in branch_coordinates_data.keys()
-                            if not re.search(second_level_branch_pattern, branch_name.lower())]
-    second_level_branches = [branch_name for branch_name in branch_coordinates_data.keys()
-                             if re.search(second_level_branch_pattern, branch_name.lower())]
-    branches_names_sorted = first_level_branches + second_level_branches
-
-    # find parent (trunk or other branch) and parent point closest to branch
+    marker_data = {}
+    trunk_group_name = None
+    trunk_coordinates = []
+    branches_names_sorted = []
+    branch_coordinates_data = {}
     branch_parent_indices = {}
-    for branch_name in branches_names_sorted:
-        branch_coordinates = branch_coordinates_data[branch_name]
-
-        # assumes that branches coordinates are recorded from start to end
-        # ignores first branch point near trunk
-        branch_start_point = branch_coordinates[1]
-        branch_end_point = branch_coordinates[-1]
-
-        # find parent branch
-        try_parent_name = suggest_parent_name(branch_name, side_label, trunk_group_name)
-
-        if try_parent_name != branch_name and try_parent_name in branch_coordinates_data.keys():
-            parent_name = try_parent_name
-            parent_coordinates = branch_coordinates_data[parent_name][:]
-        else:
-            # if parent is not a branch, use trunk as default parent
-            parent_name = trunk_group_name
-            parent_coordinates = trunk_coordinates[:]
-
-        # find closest to branch distance, branch start, group node closest to the branch
-        min_dsq = float('inf')
-        for bi in [branch_start_point, branch_end_point]:
-            for i in range(len(parent_coordinates)):
-                parent_node = parent_coordinates[i]
-                distance_squared = magnitude_squared(sub(parent_node, bi))
-                if distance_squared <= min_dsq:
-                    min_dsq = distance_squared
-                    closest_branch_point = bi
-                    closest_parent_index = i
-
-        if min_dsq < minimal_distance_allowed:
-            # print('  ', branch_name, '->', parent_name, closest_parent_index, min_dsq)
-
-            # remove first branch node near trunk
-            branch_coordinates.pop(0)
-            # remember closest parent node index
-            branch_parent_indices[branch_name] = (parent_name, closest_parent_index)
-
-            if closest_branch_point == branch_end_point:
-                # reverse list of coordinates if necessary so that the data always starts from parent
-                print('  branch reversed')
-                branch_coordinates.reverse()
-            branch_coordinates_data[branch_name] = branch_coordinates
-
+    for group_type, group_name, group_data in iterate_stitched_segment_groups(
+            csv_files, minimal_distance_allowed, file_buffers, dtype):
+        if group_type == 'marker':
+            marker_data.update(group_data)
+        elif group_type == 'trunk':
+            trunk_group_name = group_name
+            trunk_coordinates = group_data
         else:
-            # branch is too far away to be stitched
-            print('  ', branch_name, 'has no parent, potentially looked at', parent_name, ', min_dsq =', str(min_dsq))
-            branch_parent_indices[branch_name] = (None, None)
+            branches_names_sorted.append(group_name)
+            branch_coordinates_data[group_name], branch_parent_indices[group_name] = group_data
 
     return marker_data, trunk_group_name, trunk_coordinates, \
         branches_names_sorted, branch_coordinates_data, branch_parent_indices
@@ -0,0 +1,431 @@
+import os
+import io
+import gzip
+import tarfile
+import zipfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from remote_dataset import is_remote_path, normalise_remote_path, read_remote_file_bytes, split_remote_path
+
+
+archive_extensions = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+compressed_archive_extensions = ('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+compressed_extension = '.gz'
+# extensions of the files read by the pipeline, which are kept in memory when reading compressed tar archives
+dataset_file_extensions = ('.csv', '.graphml')
+# number of archives kept open, least recently used archives are closed above it
+max_open_archives = 8
+
+# open archives by path, least recently used first, with the archive signature when opened
+_open_archives = OrderedDict()
+# guards the open archives, so an archive is not closed while a member is opened from it
+_archive_lock = threading.RLock()
+
+
+def is_archive_file_name(file_name):
+    """
+    :param file_name: name or path of a file
+    :return: True if the file is a zip or tar archive which can be browsed like a folder.
+    """
+
+    return file_name.lower().endswith(archive_extensions)
+
+
+def has_dataset_extension(file_name, extension):
+    """
+    :param file_name: name or path of a file
+    :param extension: file extension, e.g. '.csv'
+    :return: True if the file has the extension, either uncompressed or gzip compressed (e.g. .csv.gz).
+    """
+
+    return file_name.endswith(extension) or file_name.endswith(extension + compressed_extension)
+
+
+def dataset_basename(path):
+    """
+    :param path: path of a dataset folder, archive or file
+    :return: base name of the path without archive extension.
+    """
+
+    if is_remote_path(path):
+        name = normalise_remote_path(path).split('/')[-1]
+    else:
+        name = os.path.basename(os.path.normpath(path))
+    for extension in archive_extensions:
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def split_archive_path(path):
+    """
+    :param path: path to a file or folder, which may continue inside a zip or tar archive,
+        e.g. sub-SR042.zip/MicroCT/sam-SR042-CL1
+    :return: archive path and member name inside the archive ('' for the archive root),
+        or None and the unchanged path if the path is not inside an archive.
+    """
+
+    prefix = os.path.normpath(path)
+    member_parts = []
+    while prefix and not os.path.exists(prefix):
+        head, tail = os.path.split(prefix)
+        if head == prefix:
+            break
+        member_parts.insert(0, tail)
+        prefix = head
+
+    if prefix and os.path.isfile(prefix) and is_archive_file_name(prefix):
+        return prefix, '/'.join(member_parts)
+    return None, path
+
+
+def _tar_member_name(info):
+    """
+    :return: name of the tar member without leading ./ or trailing /, as used in dataset paths.
+    """
+
+    member_name = info.name.rstrip('/')
+    while member_name.startswith('./'):
+        member_name = member_name[2:]
+    return '' if member_name == '.' else member_name
+
+
+def _is_dataset_file_name(file_name):
+    return any(has_dataset_extension(file_name, extension) for extension in dataset_file_extensions)
+
+
+def _open_tar(archive_path):
+    """
+    Read the member list of a tar archive. Csv and graphml files of compressed tar archives are read in the same
+    sequential pass, as reading their members in any other order decompresses the archive again from the start
+    for each member. Other files, e.g. images, are only listed.
+    :return: TarFile, or None for compressed tar archives, Dict mapping member name to TarInfo, and Dict mapping
+        member name to file bytes for the files read from compressed tar archives.
+    """
+
+    if not archive_path.lower().endswith(compressed_archive_extensions):
+        archive = tarfile.open(archive_path)
+        return archive, {_tar_member_name(info): info for info in archive.getmembers()}, {}
+
+    members = {}
+    member_contents = {}
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for info in archive:
+            member_name = _tar_member_name(info)
+            members[member_name] = info
+            if info.isfile() and _is_dataset_file_name(member_name):
+                member_contents[member_name] = archive.extractfile(info).read()
+    return None, members, member_contents
+
+
+def _read_compressed_tar_member(archive_path, member_name):
+    """
+    Read a file which is not kept in memory from a compressed tar archive, decompressing up to it.
+    :return: file bytes.
+    """
+
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for info in archive:
+            if _tar_member_name(info) == member_name:
+                return archive.extractfile(info).read()
+    raise FileNotFoundError(os.path.join(archive_path, member_name))
+
+
+class _FileRangeStream(io.RawIOBase):
+    """
+    Binary stream of size bytes from offset in a file, read through its own file handle, so several members of
+    an uncompressed tar archive can be read at the same time.
+    """
+
+    def __init__(self, file_path, offset, size):
+        super().__init__()
+        self._file = open(file_path, 'rb')
+        self._file.seek(offset)
+        self._remaining_size = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(min(len(buffer), self._remaining_size))
+        buffer[:len(data)] = data
+        self._remaining_size -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _close_archive(archive):
+    # member streams already opened from a zip or tar archive stay readable
+    if isinstance(archive, zipfile.ZipFile):
+        archive.close()
+    elif archive[0] is not None:
+        archive[0].close()
+
+
+def _get_archive_signature(archive_path):
+    stat = os.stat(archive_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _open_archive(archive_path):
+    """
+    Open an archive, or reuse it if still open and unchanged. Call with _archive_lock held, and keep holding it
+    while opening members, as the archive may be closed by a later call.
+    :return: ZipFile, or tuple from _open_tar.
+    """
+
+    signature = _get_archive_signature(archive_path)
+    open_signature, archive = _open_archives.pop(archive_path, (None, None))
+    if (archive is not None) and (open_signature != signature):
+        _close_archive(archive)
+        archive = None
+    if archive is None:
+        archive = zipfile.ZipFile(archive_path) if archive_path.lower().endswith('.zip') else _open_tar(archive_path)
+    _open_archives[archive_path] = (signature, archive)
+    while len(_open_archives) > max_open_archives:
+        _close_archive(_open_archives.popitem(last=False)[1][1])
+    return archive
+
+
+def close_dataset_archives():
+    """
+    Close all open archives and forget their listings.
+    """
+
+    with _archive_lock:
+        while _open_archives:
+            _close_archive(_open_archives.popitem()[1][1])
+        _archive_tree_for_signature.cache_clear()
+
+
+def _member_tree(members):
+    """
+    :param members: list of (member name with / separators, True if folder)
+    :return: Dict mapping folder member name ('' for root) to (list of sub folder names, list of file names).
+    """
+
+    tree = {'': ([], [])}
+    for member_name, is_dir in members:
+        parts = member_name.split('/')
+        # add all parent folders, as archives do not always have explicit folder entries
+        for i in range(len(parts) - (0 if is_dir else 1)):
+            folder = '/'.join(parts[:i + 1])
+            if folder not in tree:
+                tree[folder] = ([], [])
+                tree['/'.join(parts[:i])][0].append(parts[i])
+        if not is_dir:
+            tree['/'.join(parts[:-1])][1].append(parts[-1])
+    return tree
+
+
+def _archive_tree(archive_path):
+    """
+    :return: Dict mapping folder member name ('' for root) to (list of sub folder names, list of file names).
+        Listed again if the archive has changed.
+    """
+
+    return _archive_tree_for_signature(archive_path, _get_archive_signature(archive_path))
+
+
+@lru_cache(maxsize=64)
+def _archive_tree_for_signature(archive_path, signature):
+    with _archive_lock:
+        archive = _open_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            members = [(info.filename.rstrip('/'), info.is_dir()) for info in archive.infolist()]
+        else:
+            members = [(member_name, info.isdir()) for member_name, info in archive[1].items() if member_name]
+    return _member_tree(members)
+
+
+@lru_cache(maxsize=None)
+def _remote_tree(root_url):
+    """
+    :param root_url: URL of a remote dataset folder with an index
+    :return: Dict mapping folder path relative to root_url ('' for root) to (list of sub folder names,
+        list of file names).
+    """
+
+    _, _, files = split_remote_path(root_url)
+    return _member_tree([(file_path, False) for file_path in files.keys() if file_path])
+
+
+def is_dataset_dir(path):
+    """
+    :param path: path to a folder, an archive or a folder inside an archive, or URL of a remote dataset folder
+    :return: True if the path can be browsed like a folder.
+    """
+
+    if is_remote_path(path):
+        root_url, folder, _ = split_remote_path(path)
+        return root_url is not None and folder in _remote_tree(root_url)
+    if os.path.isdir(path):
+        return True
+    archive_path, member_name = split_archive_path(path)
+    return archive_path is not None and member_name in _archive_tree(archive_path)
+
+
+def _walk_archive(archive_path, member_name):
+    tree = _archive_tree(archive_path)
+    folders = [member_name]
+    while folders:
+        folder = folders.pop(0)
+        dirs, files = tree[folder]
+        rootpath = os.path.join(archive_path, *folder.split('/')) if folder else archive_path
+        yield rootpath, dirs[:], files[:]
+        folders.extend([folder + '/' + d if folder else d for d in dirs])
+
+
+def _walk_remote(root_url, folder_path):
+    tree = _remote_tree(root_url)
+    folders = [folder_path]
+    while folders:
+        folder = folders.pop(0)
+        dirs, files = tree[folder]
+        yield (root_url + '/' + folder) if folder else root_url, dirs[:], files[:]
+        folders.extend([folder + '/' + d if folder else d for d in dirs])
+
+
+def walk_dataset(path):
+    """
+    Same as os.walk, but a zip or tar archive, or a folder inside one, is walked as a folder without extracting it.
+    Archives inside plain folders are listed as files. Remote dataset folders are walked from their index.
+    :param path: path to a folder, an archive or a folder inside an archive, or URL of a remote dataset folder
+    :return: generator of (rootpath, dirs, files) tuples.
+    """
+
+    if is_remote_path(path):
+        root_url, folder_path, _ = split_remote_path(path)
+        if root_url is not None and folder_path in _remote_tree(root_url):
+            yield from _walk_remote(root_url, folder_path)
+        return
+
+    archive_path, member_name = split_archive_path(path)
+    if archive_path is not None:
+        if member_name in _archive_tree(archive_path):
+            yield from _walk_archive(archive_path, member_name)
+        return
+
+    # archives inside plain folders are files, so datasets on disk are found as before
+    yield from os.walk(path)
+
+
+def list_dataset_dirs(path):
+    """
+    :param path: path to a folder, an archive or a folder inside an archive
+    :return: list of paths of the sub folders directly inside path.
+    """
+
+    for rootpath, dirs, files in walk_dataset(path):
+        return [os.path.join(rootpath, d) for d in dirs]
+    return []
+
+
+def _open_raw_dataset_file(path):
+    if is_remote_path(path):
+        return io.BytesIO(read_remote_file_bytes(path))
+
+    archive_path, member_name = split_archive_path(path)
+    if archive_path is None:
+        return open(path, 'rb')
+
+    with _archive_lock:
+        archive = _open_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.open(member_name)
+        tar_archive, members, member_contents = archive
+        info = members.get(member_name)
+        if (info is None) or info.isdir():
+            raise FileNotFoundError(path)
+        if member_name in member_contents:
+            return io.BytesIO(member_contents[member_name])
+        if (tar_archive is not None) and not (info.isreg() and not info.issparse()):
+            # links and sparse files are resolved by tarfile, through the shared file object
+            return io.BytesIO(tar_archive.extractfile(info).read())
+    if tar_archive is None:
+        return io.BytesIO(_read_compressed_tar_member(archive_path, member_name))
+    return io.BufferedReader(_FileRangeStream(archive_path, info.offset_data, info.size))
+
+
+def dataset_file_signature(path):
+    """
+    Signature of a dataset file which changes when the file changes, without reading it.
+    :param path: path to a file, which may be inside an archive, or URL of a file in a remote dataset
+    :return: text with the sha256 digest of a remote file from its index, otherwise the size and modification
+        time of the file, or of the archive containing it.
+    """
+
+    if is_remote_path(path):
+        _, file_path, files = split_remote_path(path)
+        if files is None or file_path not in files:
+            raise FileNotFoundError(path)
+        return files[file_path][1]
+
+    archive_path, _ = split_archive_path(path)
+    stat = os.stat(path if archive_path is None else archive_path)
+    return str(stat.st_size) + ' ' + str(stat.st_mtime_ns)
+
+
+def read_dataset_file_bytes(path):
+    """
+    :param path: path to a file, which may be inside an archive
+    :return: raw (still compressed for .gz files) bytes of the file.
+    """
+
+    with _open_raw_dataset_file(path) as stream:
+        return stream.read()
+
+
+def prefetch_dataset_files(file_path_lists, max_workers=8):
+    """
+    Read groups of files concurrently into memory with a bounded thread pool, reading the next group while
+    the current one is processed. Used to hide latency of network file systems for many small files.
+    :param file_path_lists: list of lists of file paths, e.g. csv files for each segment
+    :param max_workers: maximum number of files read at the same time. If 0, files are not prefetched.
+    :return: generator of Dicts mapping file path to raw file bytes, one for each list in file_path_lists,
+        in the same order.
+    """
+
+    if not max_workers:
+        for file_paths in file_path_lists:
+            yield {}
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_reads(file_paths):
+            return {file_path: executor.submit(read_dataset_file_bytes, file_path) for file_path in file_paths}
+
+        next_reads = submit_reads(file_path_lists[0]) if file_path_lists else {}
+        for index in range(len(file_path_lists)):
+            reads = next_reads
+            next_reads = submit_reads(file_path_lists[index + 1]) if index + 1 < len(file_path_lists) else {}
+            yield {file_path: read.result() for file_path, read in reads.items()}
+
+
+def open_dataset_file(path, mode='r', file_buffers=None):
+    """
+    Open a dataset file for reading, streaming it from inside a zip or tar archive if necessary and
+    decompressing .gz files on the fly.
+    :param path: path to a file, which may be inside an archive
+    :param mode: 'r' for text, 'rb' for binary
+    :param file_buffers: optional Dict mapping file path to prefetched raw file bytes. Files in it are not re-read.
+    :return: file object.
+    """
+
+    if file_buffers and path in file_buffers:
+        stream = io.BytesIO(file_buffers[path])
+    else:
+        stream = _open_raw_dataset_file(path)
+
+    if path.endswith(compressed_extension):
+        stream = gzip.GzipFile(fileobj=stream)
+
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream)
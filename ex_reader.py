@@ -0,0 +1,299 @@
+import re
+
+import numpy as np
+
+
+_field_header = re.compile(r'\d+\) (.+), \w+, .*?(real|string|integer|element_xi), #Components=(\d+)')
+_component_values = re.compile(r'#Values=(\d+)')
+_string_token = re.compile(r'"(?:[^"\\]|\\.)*"|\S+')
+
+
+def _unquote_ex_string(token):
+    if token.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+    return token
+
+
+def _parse_identifier_ranges(lines):
+    """
+    :param lines: lines of comma separated identifiers and a..b identifier ranges, as written in EX group sections
+    :return: numpy array of identifiers.
+    """
+
+    identifier_arrays = []
+    for token in ''.join(lines).split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if '..' in token:
+            first, last = token.split('..')
+            identifier_arrays.append(np.arange(int(first), int(last) + 1))
+        else:
+            identifier_arrays.append(np.array([int(token)]))
+    if not identifier_arrays:
+        return np.zeros(0, dtype=int)
+    return np.concatenate(identifier_arrays)
+
+
+_node_run_end = re.compile(r'^(?!Node:| )', re.M)
+_element_run_end = re.compile(r'^(?!Element:| )', re.M)
+_identifier_run_end = re.compile(r'^(?![0-9])', re.M)
+_node_header = re.compile(r'^Node: (\d+)\n', re.M)
+_element_header = re.compile(r'^Element: (\d+)$', re.M)
+_element_nodes = re.compile(r'^ Nodes:\n(.*)$', re.M)
+
+
+def _parse_node_template(template_lines):
+    """
+    :param template_lines: lines of a node template definition, after its 'Define node template:' line
+    :return: list of (field name, value type, number of values) for each field of the template.
+    """
+
+    fields = []
+    for line in template_lines:
+        match = _field_header.match(line)
+        if match:
+            fields.append([match.group(1), match.group(2), 0])
+        elif fields and line.startswith(' '):
+            values_match = _component_values.search(line)
+            fields[-1][2] += int(values_match.group(1)) if values_match else 1
+    return [tuple(field) for field in fields]
+
+
+def _parse_node_run(node_run_text, fields):
+    """
+    Convert the text of a run of nodes sharing the same template in bulk.
+    :param node_run_text: EX text with 'Node: <identifier>' lines, each followed by the node values
+    :param fields: list of (field name, value type, number of values) from the node template
+    :return: array of node identifiers, Dict mapping field name to N x values array (real fields) or list of
+        values (string fields).
+    """
+
+    node_identifiers = np.array(_node_header.findall(node_run_text), dtype=int)
+    node_count = len(node_identifiers)
+    values_per_node = sum(value_count for _, _, value_count in fields)
+    if all(value_type == 'real' for _, value_type, _ in fields):
+        values = np.array(_node_header.sub(' ', node_run_text).split(), dtype=float).reshape(
+            node_count, values_per_node)
+    else:
+        node_texts = _node_header.split(node_run_text)[2::2]
+        values = np.array([_string_token.findall(node_text) for node_text in node_texts],
+                          dtype=object).reshape(node_count, values_per_node)
+
+    field_values = {}
+    offset = 0
+    for field_name, value_type, value_count in fields:
+        field_array = values[:, offset:offset + value_count]
+        if value_type == 'string':
+            field_values[field_name] = [_unquote_ex_string(token) for token in field_array[:, 0]]
+        else:
+            field_values[field_name] = field_array.astype(float)
+        offset += value_count
+    return node_identifiers, field_values
+
+
+def _merge_node_runs(node_runs):
+    """
+    :param node_runs: list of (node identifiers, field values) from _parse_node_run
+    :return: array of node identifiers, Dict mapping field name to values for all nodes. Real values are NaN for
+        nodes without the field, string values are None.
+    """
+
+    if not node_runs:
+        return np.zeros(0, dtype=int), {}
+    node_identifiers = np.concatenate([run_identifiers for run_identifiers, _ in node_runs])
+    field_names = {field_name for _, run_fields in node_runs for field_name in run_fields}
+    merged_fields = {}
+    for field_name in field_names:
+        run_values = [run_fields.get(field_name) for _, run_fields in node_runs]
+        if any(isinstance(values, list) for values in run_values):
+            merged_fields[field_name] = [value for (run_identifiers, _), values in zip(node_runs, run_values)
+                                         for value in (values if values is not None else
+                                                       [None] * len(run_identifiers))]
+            continue
+        value_count = max(values.shape[1] for values in run_values if values is not None)
+        merged_fields[field_name] = np.concatenate([
+            values if values is not None else np.full((len(run_identifiers), value_count), np.nan)
+            for (run_identifiers, _), values in zip(node_runs, run_values)])
+    return node_identifiers, merged_fields
+
+
+def read_exf_arrays(exf_file):
+    """
+    Read an EX file written by write_exf straight into numpy arrays, without loading it into a Zinc region.
+    Runs of nodes and elements are converted in bulk, so this is much faster than iterating a Zinc region.
+    :param exf_file: location of the EX file
+    :return: Dict with:
+        'node_identifiers': array of node identifiers,
+        'node_coordinates': N x 3 array of node coordinates,
+        'node_radius': array of node radius, NaN for nodes without radius,
+        'element_identifiers': array of element identifiers,
+        'element_nodes': E x 2 array of element node identifiers,
+        'node_groups', 'element_groups', 'datapoint_groups': Dicts mapping group name to array of identifiers,
+        'marker_identifiers': array of marker datapoint identifiers,
+        'marker_coordinates': M x 3 array of marker coordinates,
+        'marker_names': list of marker names.
+    """
+
+    with open(exf_file, 'r') as f:
+        text = f.read()
+
+    node_runs = {'nodes': [], 'datapoints': []}
+    element_identifier_arrays = []
+    element_node_arrays = []
+    groups = {'nodes': {}, 'elements': {}, 'datapoints': {}}
+
+    templates = {}
+    fields = []
+    template_lines = None
+    nodeset_name = 'nodes'
+    group_name = None
+    position = 0
+    text_length = len(text)
+    while position < text_length:
+        if text.startswith('Node:', position):
+            match = _node_run_end.search(text, position)
+            run_end = match.start() if match else text_length
+            node_runs.setdefault(nodeset_name, []).append(_parse_node_run(text[position:run_end], fields))
+            position = run_end
+            continue
+        if text.startswith('Element:', position):
+            match = _element_run_end.search(text, position)
+            run_end = match.start() if match else text_length
+            element_run_text = text[position:run_end]
+            element_identifier_arrays.append(np.array(_element_header.findall(element_run_text), dtype=int))
+            element_node_arrays.append(np.array(' '.join(_element_nodes.findall(element_run_text)).split(),
+                                                dtype=int).reshape(len(element_identifier_arrays[-1]), -1))
+            position = run_end
+            continue
+
+        line_end = text.find('\n', position)
+        if line_end < 0:
+            line_end = text_length
+        line = text[position:line_end]
+        position = line_end + 1
+        if template_lines is not None:
+            if line.startswith('Node template:'):
+                fields = _parse_node_template(template_lines)
+                templates[line[len('Node template:'):].strip()] = fields
+                template_lines = None
+            else:
+                template_lines.append(line)
+        elif line.startswith('!#nodeset '):
+            nodeset_name = line[len('!#nodeset '):].strip()
+        elif line.startswith('Define node template:'):
+            template_lines = []
+        elif line.startswith('Node template:'):
+            fields = templates[line[len('Node template:'):].strip()]
+        elif line.startswith('Group name:'):
+            group_name = line[len('Group name:'):].strip()
+            for group_type_groups in groups.values():
+                group_type_groups[group_name] = np.zeros(0, dtype=int)
+        elif line.startswith('Node group:') or line.startswith('Element group:'):
+            group_type = 'elements' if line.startswith('Element') else nodeset_name
+            match = _identifier_run_end.search(text, position)
+            run_end = match.start() if match else text_length
+            groups.setdefault(group_type, {})[group_name] = \
+                _parse_identifier_ranges(text[position:run_end].splitlines())
+            position = run_end
+
+    node_identifiers, node_fields = _merge_node_runs(node_runs['nodes'])
+    marker_identifiers, marker_fields = _merge_node_runs(node_runs['datapoints'])
+
+    return {
+        'node_identifiers': node_identifiers,
+        'node_coordinates': node_fields.get('coordinates', np.zeros((0, 3))),
+        'node_radius': node_fields['radius'][:, 0] if 'radius' in node_fields else
+        np.full(len(node_identifiers), np.nan),
+        'element_identifiers': np.concatenate(element_identifier_arrays) if element_identifier_arrays else
+        np.zeros(0, dtype=int),
+        'element_nodes': np.concatenate(element_node_arrays) if element_node_arrays else np.zeros((0, 2), dtype=int),
+        'node_groups': groups['nodes'],
+        'element_groups': groups['elements'],
+        'datapoint_groups': groups['datapoints'],
+        'marker_identifiers': marker_identifiers,
+        'marker_coordinates': marker_fields.get('coordinates', np.zeros((0, 3))),
+        'marker_names': marker_fields.get('marker_name', [])
+    }
+
+
+def get_group_node_counts(ex_data):
+    """
+    :param ex_data: Dict from read_exf_arrays
+    :return: Dict mapping group name to number of nodes in the group.
+    """
+
+    return {group_name: len(node_identifiers) for group_name, node_identifiers in ex_data['node_groups'].items()}
+
+
+def get_group_bounding_boxes(ex_data):
+    """
+    :param ex_data: Dict from read_exf_arrays
+    :return: Dict mapping group name to (minimum x, y, z, maximum x, y, z) of its node coordinates,
+        for groups with nodes.
+    """
+
+    node_indices = _get_node_indices(ex_data)
+    bounding_boxes = {}
+    for group_name, node_identifiers in ex_data['node_groups'].items():
+        if len(node_identifiers) > 0:
+            coordinates = ex_data['node_coordinates'][node_indices[node_identifiers]]
+            bounding_boxes[group_name] = (coordinates.min(axis=0), coordinates.max(axis=0))
+    return bounding_boxes
+
+
+def _get_node_indices(ex_data):
+    """
+    :return: array mapping node identifier to its index in the node arrays.
+    """
+
+    node_identifiers = ex_data['node_identifiers']
+    node_indices = np.full(node_identifiers.max() + 1 if len(node_identifiers) else 1, -1, dtype=int)
+    node_indices[node_identifiers] = np.arange(len(node_identifiers))
+    return node_indices
+
+
+def count_connected_components(node_identifiers, element_nodes):
+    """
+    :param node_identifiers: array of node identifiers
+    :param element_nodes: E x 2 array of element node identifiers, using only the given nodes
+    :return: number of connected pieces the elements form over the nodes.
+    """
+
+    if len(node_identifiers) == 0:
+        return 0
+    node_indices = np.searchsorted(np.sort(node_identifiers), element_nodes)
+    labels = np.arange(len(node_identifiers))
+    # propagate smallest label along elements until it no longer changes
+    while True:
+        element_labels = np.minimum(labels[node_indices[:, 0]], labels[node_indices[:, 1]])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, node_indices[:, 0], element_labels)
+        np.minimum.at(new_labels, node_indices[:, 1], element_labels)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return len(np.unique(labels))
+
+
+def find_disconnected_groups(ex_data):
+    """
+    :param ex_data: Dict from read_exf_arrays
+    :return: Dict mapping name of each group whose elements do not form a single connected piece
+        to its number of pieces.
+    """
+
+    element_identifiers = ex_data['element_identifiers']
+    element_indices = np.full(element_identifiers.max() + 1 if len(element_identifiers) else 1, -1, dtype=int)
+    element_indices[element_identifiers] = np.arange(len(element_identifiers))
+
+    disconnected_groups = {}
+    for group_name, group_element_identifiers in ex_data['element_groups'].items():
+        if len(group_element_identifiers) == 0:
+            continue
+        element_nodes = ex_data['element_nodes'][element_indices[group_element_identifiers]]
+        component_count = count_connected_components(np.unique(element_nodes), element_nodes)
+        if component_count > 1:
+            disconnected_groups[group_name] = component_count
+    return disconnected_groups
@@ -0,0 +1,413 @@
+import re
+
+from identifiers import allocate_identifier_ranges, count_segment_identifiers
+from output import get_branch_parent_node_identifier
+
+
+def format_ex_real(value, significant_digits=None):
+    """
+    :param value: real value
+    :param significant_digits: optional number of significant digits to write, otherwise full double precision
+    :return: real value formatted as written by Zinc in EX files.
+    """
+
+    if significant_digits:
+        return ' {:.{}e}'.format(value, significant_digits - 1)
+    return ' {:22.15e}'.format(value)
+
+
+def format_ex_string(value):
+    """
+    :return: string value formatted as written by Zinc in EX files, quoted if it is not a single word.
+    """
+
+    if re.fullmatch(r'[A-Za-z0-9_]+', value):
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace("'", "\\'") + '"'
+
+
+def merge_identifier_ranges(identifier_ranges):
+    """
+    :param identifier_ranges: list of ranges of identifiers, in any order and possibly overlapping
+    :return: sorted list of non-overlapping, non-adjacent identifier ranges covering the same identifiers.
+    """
+
+    merged_ranges = []
+    for identifier_range in sorted((r for r in identifier_ranges if len(r) > 0), key=lambda r: (r.start, r.stop)):
+        if merged_ranges and identifier_range.start <= merged_ranges[-1].stop:
+            merged_ranges[-1] = range(merged_ranges[-1].start, max(merged_ranges[-1].stop, identifier_range.stop))
+        else:
+            merged_ranges.append(identifier_range)
+    return merged_ranges
+
+
+def identifiers_to_ranges(identifiers):
+    """
+    :param identifiers: iterable of integer identifiers
+    :return: sorted list of identifier ranges covering the identifiers.
+    """
+
+    return merge_identifier_ranges([range(identifier, identifier + 1) for identifier in identifiers])
+
+
+def format_ex_identifier_ranges(identifier_ranges):
+    """
+    :param identifier_ranges: sorted list of non-overlapping identifier ranges
+    :return: lines listing the identifiers as written by Zinc in EX group sections, 10 per line.
+    """
+
+    tokens = [str(r.start) if len(r) == 1 else str(r.start) + '..' + str(r.stop - 1) for r in identifier_ranges]
+    lines = []
+    for index in range(0, len(tokens), 10):
+        line = ','.join(tokens[index:index + 10])
+        if index + 10 < len(tokens):
+            line += ','
+        lines.append(line + '\n')
+    return lines
+
+
+def _node_template_lines(template_number, field_names):
+    lines = [
+        'Define node template: node' + str(template_number) + '\n',
+        'Shape. Dimension=0\n',
+        '#Fields=' + str(len(field_names)) + '\n',
+        '1) coordinates, coordinate, rectangular cartesian, real, #Components=3\n',
+        ' x. #Values=1 (value)\n',
+        ' y. #Values=1 (value)\n',
+        ' z. #Values=1 (value)\n']
+    if 'radius' in field_names:
+        lines += ['2) radius, field, rectangular cartesian, real, #Components=1\n',
+                  ' 1. #Values=1 (value)\n']
+    if 'marker_name' in field_names:
+        lines += ['2) marker_name, field, string, #Components=1\n',
+                  ' 1. #Values=1 (value)\n']
+    lines.append('Node template: node' + str(template_number) + '\n')
+    return lines
+
+
+def _element_template_lines(template_number, field_names):
+    lines = [
+        'Define element template: element' + str(template_number) + '\n',
+        'Shape. Dimension=1, line\n',
+        '#Scale factor sets=0\n',
+        '#Nodes=2\n',
+        '#Fields=' + str(len(field_names)) + '\n']
+    component_lines = [
+        ' l.Lagrange, no modify, standard node based.\n',
+        '  #Nodes=2\n',
+        '  1. #Values=1\n',
+        '   Value labels: value\n',
+        '  2. #Values=1\n',
+        '   Value labels: value\n']
+    lines.append('1) coordinates, coordinate, rectangular cartesian, real, #Components=3\n')
+    for component_name in ['x', 'y', 'z']:
+        lines += [' ' + component_name + '.' + component_lines[0]] + component_lines[1:]
+    if 'radius' in field_names:
+        lines.append('2) radius, field, rectangular cartesian, real, #Components=1\n')
+        lines += [' 1.' + component_lines[0]] + component_lines[1:]
+    lines.append('Element template: element' + str(template_number) + '\n')
+    return lines
+
+
+def write_exf_streaming(output_file, marker_data, trunk_group_name, trunk_coordinates, trunk_radius,
+                        branch_names, branch_coordinates_data, branch_parent_indices, avg_branch_radius,
+                        orientation_markers, vagus_terms, fascicle_graph, identifier_ranges=None, chunk_size=100000,
+                        significant_digits=None, branch_radius_data=None):
+    """
+    Write the same EX file as write_exf by streaming EX format text in chunks straight from the segment data,
+    without building the model in a Zinc region first. Memory use for the output is bounded by chunk_size.
+    :param fascicle_graph: networkx graph with fascicle data for the segment, or None
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range),
+        including the fascicle group if there is a fascicle graph. Allocated from the group sizes if not supplied.
+    :param chunk_size: number of lines collected before they are written to the file
+    :param significant_digits: optional number of significant digits for real values, e.g. 8 for float32 data,
+        otherwise they are written at full double precision like Zinc does
+    :param branch_radius_data: optional dictionary mapping branch name to list of radius values for its
+        coordinates, for branches with morphology data. Other branches use avg_branch_radius.
+    See write_exf for the remaining parameters.
+    :return: identifier_ranges used for the output.
+    """
+
+    if identifier_ranges is None:
+        identifier_ranges = allocate_identifier_ranges(count_segment_identifiers(
+            trunk_group_name, trunk_coordinates, branch_names, branch_coordinates_data, branch_parent_indices,
+            orientation_markers))
+
+    def segment_groups():
+        yield 'trunk', trunk_group_name, (trunk_coordinates, trunk_radius, avg_branch_radius)
+        for branch_name in branch_names:
+            branch_data = (branch_coordinates_data[branch_name], branch_parent_indices[branch_name])
+            if branch_radius_data and branch_name in branch_radius_data:
+                branch_data += (branch_radius_data[branch_name],)
+            yield 'branch', branch_name, branch_data
+        if orientation_markers:
+            yield 'orientation', None, orientation_markers
+        if marker_data:
+            yield 'marker', 'vagal levels', marker_data
+
+    return write_exf_groups_streaming(output_file, segment_groups(), vagus_terms, fascicle_graph, identifier_ranges,
+                                      chunk_size, significant_digits)
+
+
+def write_exf_groups_streaming(output_file, segment_groups, vagus_terms, fascicle_graph, identifier_ranges=None,
+                               chunk_size=100000, significant_digits=None):
+    """
+    Write a segment EX file from groups produced one at a time, e.g. by iterate_stitched_segment_groups.
+    Nodes of each group are written as soon as it arrives and only identifier ranges are kept afterwards,
+    so the segment never needs to be in memory at once.
+    :param segment_groups: iterable of (group type, group name, group data) with the trunk before all branches:
+        ('trunk', trunk group name, (trunk coordinates, trunk radius list, radius used for branches or None)),
+        ('branch', branch name, (branch coordinates, (parent branch name, parent index))), optionally with
+            a list of radius values for the branch coordinates as third item, otherwise the trunk's branch radius,
+        ('orientation', None, Dict mapping orientation label to list of x, y, z coordinates), after all branches,
+        ('marker', group name, Dict mapping marker name to x, y, z coordinate) at any point.
+    :param vagus_terms: dictionary mapping trunk and branch names to annotation term
+    :param fascicle_graph: networkx graph with fascicle data for the segment, or None
+    :param identifier_ranges: optional dict mapping group name to (node identifier range, element identifier range).
+        Ranges for groups not in it are allocated in the order the groups arrive, and added to it.
+    :param chunk_size: number of lines collected before they are written to the file
+    :param significant_digits: optional number of significant digits for real values, e.g. 8 for float32 data,
+        otherwise they are written at full double precision like Zinc does
+    :return: identifier_ranges used for the output.
+    """
+
+    if identifier_ranges is None:
+        identifier_ranges = {}
+
+    def get_identifier_ranges(group_name, node_count, element_count):
+        if group_name not in identifier_ranges:
+            allocate_identifier_ranges([(group_name, node_count, element_count)], identifier_ranges)
+        return identifier_ranges[group_name]
+
+    fascicle_field_names = ['coordinates', 'radius']
+    segment_field_names = None
+    has_radius = False
+    branch_radius = 0.0
+    trunk_group_name = None
+    # list of (branch name, parent name, parent index) to write elements for after all nodes
+    branch_parents = []
+    marker_data = {}
+
+    # groups map group name to node, element and datapoint identifier ranges
+    groups = {}
+
+    def add_to_group(group_name, node_ranges=(), element_ranges=(), datapoint_ranges=()):
+        group = groups.setdefault(group_name, ([], [], []))
+        group[0].extend(node_ranges)
+        group[1].extend(element_ranges)
+        group[2].extend(datapoint_ranges)
+
+    with open(output_file, 'w', newline='\n') as output:
+        # lines are collected and written in chunks, so memory use is bounded by the chunk size
+        chunk_lines = []
+
+        def write(lines, flush=False):
+            chunk_lines.extend(lines)
+            if flush or len(chunk_lines) >= chunk_size:
+                output.write(''.join(chunk_lines))
+                chunk_lines.clear()
+
+        def write_nodes(node_range, points, radius_values):
+            for node_identifier, point, radius_value in zip(node_range, points, radius_values):
+                lines = ['Node: ' + str(node_identifier) + '\n'] + \
+                    [format_ex_real(x, significant_digits) + '\n' for x in point]
+                if radius_value is not None:
+                    lines.append(format_ex_real(radius_value, significant_digits) + '\n')
+                write(lines)
+
+        def segment_radius_values(count, value):
+            return [value] * count if has_radius else [None] * count
+
+        write(['EX Version: 3\n', 'Region: /\n'])
+
+        # nodes
+        node_template_number = 1
+        for group_type, group_name, group_data in segment_groups:
+            if group_type == 'marker':
+                marker_data.update(group_data)
+            elif group_type == 'trunk':
+                trunk_group_name = group_name
+                trunk_coordinates, trunk_radius, avg_branch_radius = group_data
+                has_radius = len(trunk_radius) > 0
+                segment_field_names = ['coordinates', 'radius'] if has_radius else ['coordinates']
+                branch_radius = avg_branch_radius if avg_branch_radius else 0.0
+                write(['!#nodeset nodes\n'])
+                write(_node_template_lines(node_template_number, segment_field_names))
+                trunk_point_count = len(trunk_coordinates)
+                trunk_node_range, _ = get_identifier_ranges(trunk_group_name, trunk_point_count,
+                                                            max(trunk_point_count - 1, 0))
+                write_nodes(trunk_node_range, trunk_coordinates,
+                            trunk_radius if has_radius else [None] * trunk_point_count)
+            elif group_type == 'branch':
+                branch_coordinates, (parent_name, parent_index) = group_data[:2]
+                node_count = len(branch_coordinates)
+                # stitched branches have an extra element linking the first branch node to the parent
+                element_count = node_count if parent_index is not None else max(node_count - 1, 0)
+                branch_node_range, _ = get_identifier_ranges(group_name, node_count, element_count)
+                if has_radius and len(group_data) > 2:
+                    branch_radius_values = group_data[2]
+                else:
+                    branch_radius_values = segment_radius_values(node_count, branch_radius)
+                write_nodes(branch_node_range, branch_coordinates, branch_radius_values)
+                branch_parents.append((group_name, parent_name, parent_index))
+            elif group_type == 'orientation':
+                for orientation_marker, orientation_points in group_data.items():
+                    orientation_node_range, _ = get_identifier_ranges(orientation_marker, len(orientation_points), 0)
+                    write_nodes(orientation_node_range, orientation_points,
+                                segment_radius_values(len(orientation_points), 0.0))
+                    add_to_group(orientation_marker, node_ranges=[orientation_node_range])
+            group_data = None
+
+        fascicle_node_identifiers = {}
+        if fascicle_graph is not None:
+            if fascicle_field_names != segment_field_names:
+                node_template_number += 1
+                write(_node_template_lines(node_template_number, fascicle_field_names))
+            node_identifier = get_identifier_ranges(
+                'fascicle', fascicle_graph.number_of_nodes(), fascicle_graph.number_of_edges())[0].start
+            for label, node_data in fascicle_graph.nodes(data=True):
+                fascicle_node_identifiers[label] = node_identifier
+                point = [node_data['centroid-0'], node_data['centroid-1'], node_data['frame']]
+                write_nodes([node_identifier], [point], [node_data['equivalent_diameter'] / 2])
+                node_identifier += 1
+
+        # elements
+        element_template_number = 1
+        write(['!#mesh mesh1d, dimension=1, nodeset=nodes\n'])
+        write(_element_template_lines(element_template_number, segment_field_names))
+
+        def write_element(element_identifier, node_identifiers):
+            write(['Element: ' + str(element_identifier) + '\n', ' Nodes:\n',
+                   ' ' + ' '.join(str(node_identifier) for node_identifier in node_identifiers) + '\n'])
+
+        trunk_node_range, trunk_element_range = identifier_ranges[trunk_group_name]
+        for element_identifier in trunk_element_range:
+            node_identifier = trunk_node_range.start + element_identifier - trunk_element_range.start
+            write_element(element_identifier, [node_identifier, node_identifier + 1])
+        add_to_group(trunk_group_name, node_ranges=[trunk_node_range] if len(trunk_element_range) else [],
+                     element_ranges=[trunk_element_range])
+
+        for branch_name, parent_name, parent_index in branch_parents:
+            branch_node_range, branch_element_range = identifier_ranges[branch_name]
+            node_identifiers = list(branch_node_range)
+            if parent_index is not None:
+                node_identifiers.insert(0, get_branch_parent_node_identifier(
+                    identifier_ranges[parent_name][0].start, parent_index))
+            for index, element_identifier in enumerate(branch_element_range):
+                write_element(element_identifier, node_identifiers[index:index + 2])
+            if len(branch_element_range) > 0:
+                add_to_group(branch_name, node_ranges=identifiers_to_ranges(node_identifiers),
+                             element_ranges=[branch_element_range])
+            else:
+                add_to_group(branch_name)
+
+        if fascicle_graph is not None:
+            if fascicle_field_names != segment_field_names:
+                element_template_number += 1
+                write(_element_template_lines(element_template_number, fascicle_field_names))
+            fascicle_element_range = identifier_ranges['fascicle'][1]
+            fascicle_element_node_identifiers = set()
+            for element_identifier, edge in zip(fascicle_element_range, fascicle_graph.edges()):
+                node_identifiers = [fascicle_node_identifiers[edge[0]], fascicle_node_identifiers[edge[1]]]
+                write_element(element_identifier, node_identifiers)
+                fascicle_element_node_identifiers.update(node_identifiers)
+            add_to_group('fascicle', node_ranges=identifiers_to_ranges(fascicle_element_node_identifiers),
+                         element_ranges=[fascicle_element_range])
+
+        # markers
+        add_to_group('marker')
+        if marker_data:
+            write(['!#nodeset datapoints\n'])
+            write(_node_template_lines(node_template_number + 1, ['coordinates', 'marker_name']))
+            for marker_identifier, (marker_name, marker_point) in enumerate(marker_data.items(), start=1):
+                write(['Node: ' + str(marker_identifier) + '\n'] +
+                      [format_ex_real(x, significant_digits) + '\n' for x in marker_point] +
+                      [' ' + format_ex_string(marker_name) + '\n'])
+            add_to_group('marker', datapoint_ranges=[range(1, len(marker_data) + 1)])
+
+        # annotation term groups have the same contents as the groups they annotate
+        if vagus_terms:
+            for group_name in [trunk_group_name] + [branch_name for branch_name, _, _ in branch_parents]:
+                if group_name in vagus_terms.keys():
+                    add_to_group(vagus_terms[group_name], *groups[group_name])
+
+        # groups, in the same name order as Zinc writes them
+        for group_name in sorted(groups.keys()):
+            node_ranges, element_ranges, datapoint_ranges = \
+                [merge_identifier_ranges(ranges) for ranges in groups[group_name]]
+            write(['Group name: ' + group_name + '\n'])
+            if node_ranges:
+                write(['!#nodeset nodes\n', 'Node group:\n'] + format_ex_identifier_ranges(node_ranges))
+            if element_ranges:
+                write(['!#mesh mesh1d, dimension=1, nodeset=nodes\n', 'Element group:\n'] +
+                      format_ex_identifier_ranges(element_ranges))
+            if datapoint_ranges:
+                write(['!#nodeset datapoints\n', 'Node group:\n'] +
+                      format_ex_identifier_ranges(datapoint_ranges))
+
+        write([], flush=True)
+
+    return identifier_ranges
+
+
+def write_fascicle_exf_streaming(output_file, fascicle_graph, identifier_ranges, chunk_size=100000,
+                                 significant_digits=None):
+    """
+    Write the same fascicles EX file as create_fascicle_graph_buffer, streamed straight from the fascicle graph.
+    :param fascicle_graph: networkx graph with fascicle data for the segment
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range).
+        The fascicle group range is allocated after the other groups if it is not in it, and added to it.
+    :param chunk_size: number of lines collected before they are written to the file
+    :param significant_digits: optional number of significant digits for real values, e.g. 8 for float32 data,
+        otherwise they are written at full double precision like Zinc does
+    :return: identifier_ranges used for the output.
+    """
+
+    if 'fascicle' not in identifier_ranges:
+        allocate_identifier_ranges([('fascicle', fascicle_graph.number_of_nodes(), fascicle_graph.number_of_edges())],
+                                   identifier_ranges)
+    fascicle_node_range, fascicle_element_range = identifier_ranges['fascicle']
+    field_names = ['coordinates', 'radius']
+
+    with open(output_file, 'w', newline='\n') as output:
+        chunk_lines = []
+
+        def write(lines, flush=False):
+            chunk_lines.extend(lines)
+            if flush or len(chunk_lines) >= chunk_size:
+                output.write(''.join(chunk_lines))
+                chunk_lines.clear()
+
+        # Zinc only writes the node and element templates if there are nodes and elements
+        write(['EX Version: 3\n', 'Region: /\n'])
+        if len(fascicle_node_range) > 0:
+            write(['!#nodeset nodes\n'])
+            write(_node_template_lines(1, field_names))
+        fascicle_node_identifiers = {}
+        for node_identifier, (label, node_data) in zip(fascicle_node_range, fascicle_graph.nodes(data=True)):
+            fascicle_node_identifiers[label] = node_identifier
+            point = [node_data['centroid-0'], node_data['centroid-1'], node_data['frame'],
+                     node_data['equivalent_diameter'] / 2]
+            write(['Node: ' + str(node_identifier) + '\n'] +
+                  [format_ex_real(x, significant_digits) + '\n' for x in point])
+
+        if len(fascicle_element_range) > 0:
+            write(['!#mesh mesh1d, dimension=1, nodeset=nodes\n'])
+            write(_element_template_lines(1, field_names))
+        element_node_identifiers = set()
+        for element_identifier, edge in zip(fascicle_element_range, fascicle_graph.edges()):
+            node_identifiers = [fascicle_node_identifiers[edge[0]], fascicle_node_identifiers[edge[1]]]
+            write(['Element: ' + str(element_identifier) + '\n', ' Nodes:\n',
+                   ' ' + ' '.join(str(node_identifier) for node_identifier in node_identifiers) + '\n'])
+            element_node_identifiers.update(node_identifiers)
+
+        # only nodes of fascicle elements are in the group, as Zinc adds them with the elements
+        write(['Group name: fascicle\n'])
+        if element_node_identifiers:
+            write(['!#nodeset nodes\n', 'Node group:\n'] +
+                  format_ex_identifier_ranges(identifiers_to_ranges(element_node_identifiers)))
+            write(['!#mesh mesh1d, dimension=1, nodeset=nodes\n', 'Element group:\n'] +
+                  format_ex_identifier_ranges([fascicle_element_range]))
+        write([], flush=True)
+
+    return identifier_ranges
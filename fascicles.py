@@ -1,4 +1,6 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+
 import networkx as nx
 
 from cmlibs.zinc.context import Context
@@ -8,69 +10,141 @@ from cmlibs.zinc.element import Element, Elementbasis
 
 from cmlibs.utils.zinc.field import find_or_create_field_coordinates, findOrCreateFieldGroup, find_or_create_field_finite_element
 
+from dataset_files import has_dataset_extension, is_dataset_dir, open_dataset_file, walk_dataset
+from ex_writer import write_fascicle_exf_streaming
+from identifiers import allocate_identifier_ranges
+from output import write_region_to_buffer
+
 
-def find_trunk_fascicle_file_for_segment(fascicle_path, segment_name, trunk_group_name):
+def find_trunk_fascicle_files_for_segment(fascicle_path, segment_name, trunk_group_name):
     """
+    Large segments may be exported as several graphml files, e.g. one for each block of frames.
     :param fascicle_path: path to the folder containing fascicles graphml files
     :param segment_name: name of the dataset segment (i.e. SR005-CL1)
     :param trunk_group_name: name of the trunk group used in that segment
-    :return: path to the graphml file with trunk fascicle data for that segment
+    :return: sorted list of paths to all graphml files with trunk fascicle data for that segment.
     """
 
-    fascicle_file_path = None
-    if os.path.isdir(fascicle_path):
-        fascicle_file_path = None
+    fascicle_file_paths = []
+    if is_dataset_dir(fascicle_path):
         trunk_keywords = trunk_group_name.split()
-        for rootpath, dirs, files in os.walk(fascicle_path):
+        for rootpath, dirs, files in walk_dataset(fascicle_path):
             for f in files:
-                if all([trunk_keyword in f for trunk_keyword in trunk_keywords]) and (segment_name in f) and f.endswith('.graphml'):
-                    fascicle_file_path = os.path.join(rootpath, f)
-                    break
-    return fascicle_file_path
+                if all([trunk_keyword in f for trunk_keyword in trunk_keywords]) and (segment_name in f) and \
+                        has_dataset_extension(f, '.graphml'):
+                    fascicle_file_paths.append(os.path.join(rootpath, f))
+    return sorted(fascicle_file_paths)
 
 
-def read_fascicle_file_into_region(fascicle_path, segment_name, output_path):
+def read_fascicle_graph(fascicle_path):
+    """
+    Fascicle values stay as networkx node attributes in double precision, as the dtype option for working storage
+    only applies to the numpy arrays of segment coordinates and radius.
+    :param fascicle_path: path to the graphml file with trunk fascicle data, which may be gzip compressed
+        or inside a zip or tar archive
+    :return: networkx graph with fascicle data.
     """
-    :param fascicle_path: path to the graphml file with trunk fascicle data for that segment
+
+    with open_dataset_file(fascicle_path, 'rb') as graphml_file:
+        G = nx.read_graphml(graphml_file)
+    return G
+
+
+def read_fascicle_graphs(fascicle_paths, max_workers=4):
+    """
+    Read the graphml files of a segment in separate processes, as parsing is bound by the Python interpreter.
+    :param fascicle_paths: list of paths to graphml files with trunk fascicle data
+    :param max_workers: maximum number of files parsed at the same time. If 0, files are read one after another.
+    :return: list of networkx graphs in the order of fascicle_paths.
+    """
+
+    if (not max_workers) or (len(fascicle_paths) < 2):
+        return [read_fascicle_graph(fascicle_path) for fascicle_path in fascicle_paths]
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(fascicle_paths))) as executor:
+        return list(executor.map(read_fascicle_graph, fascicle_paths))
+
+
+def merge_fascicle_graphs(graphs, fascicle_paths=None):
+    """
+    Merge fascicle graphs from several files of a segment into one graph, so they get one identifier range
+    and one fascicle group. Node names are prefixed with the index of their graph, as each file numbers its
+    nodes from the start.
+    :param graphs: list of networkx graphs with fascicle data
+    :param fascicle_paths: optional list of paths to the files each graph was read from. If given, the merged
+        graph attribute 'fascicle_files' maps the node name prefix of each graph to its file.
+    :return: merged networkx graph, the graph itself if there is only one, or None if there are none.
+    """
+
+    if not graphs:
+        return None
+    if len(graphs) == 1:
+        G = graphs[0]
+        prefixes = ['']
+    else:
+        prefixes = [str(index) + '-' for index in range(len(graphs))]
+        G = nx.union_all(graphs, rename=prefixes)
+    if fascicle_paths:
+        G.graph['fascicle_files'] = dict(zip(prefixes, fascicle_paths))
+    return G
+
+
+def write_fascicle_graph_into_region(G, segment_name, output_path, identifier_ranges, output_suffix='',
+                                     significant_digits=None):
+    """
+    :param G: networkx graph read from the graphml file with trunk fascicle data for that segment
     :param segment_name: name of the dataset segment (i.e. SR005-CL1)
     :param output_path: path to the folder where to save the output results
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+        already used by the segment. The fascicle group range is allocated after them and added in place.
+    :param output_suffix: optional suffix added to the output file name, e.g. for level of detail.
+    :param significant_digits: optional number of significant digits for real values. Uses the streaming EX
+        writer, as Zinc always writes full double precision.
     :return: path to file with Zinc region with nodes and elements from fascicle group.
     """
 
-    G = nx.read_graphml(fascicle_path)
+    if significant_digits:
+        fascicle_output_path = get_fascicle_output_path(segment_name, output_path, output_suffix)
+        write_fascicle_exf_streaming(fascicle_output_path, G, identifier_ranges,
+                                     significant_digits=significant_digits)
+        return fascicle_output_path
+    return write_fascicle_buffer(create_fascicle_graph_buffer(G, identifier_ranges), segment_name, output_path,
+                                 output_suffix)
+
+
+def get_fascicle_output_path(segment_name, output_path, output_suffix=''):
+    """
+    :param segment_name: name of the dataset segment (i.e. SR005-CL1)
+    :param output_path: path to the folder where to save the output results
+    :param output_suffix: optional suffix added to the output file name, e.g. for level of detail.
+    :return: path to the fascicles output file of the segment.
+    """
 
-    labels = []
-    internal_labels = []
-    x_nodes = []
-    y_nodes = []
-    z_nodes = []
+    return os.path.join(output_path, 'fascicles-' + segment_name + output_suffix + '.exf')
 
-    x_node_coords = nx.get_node_attributes(G, "centroid-0")
-    y_node_coords = nx.get_node_attributes(G, "centroid-1")
-    z_node_coords = nx.get_node_attributes(G, "frame")
 
-    for node in G.nodes(data=True):
-        labels.append(node[0]) # node id
-        internal_labels.append(node[1]['label'])
-        x_nodes.append(node[1]['centroid-0'])
-        y_nodes.append(node[1]['centroid-1'])
-        z_nodes.append(node[1]['frame'])
+def write_fascicle_buffer(fascicles_buffer, segment_name, output_path, output_suffix=''):
+    """
+    :param fascicles_buffer: EX format bytes buffer with Zinc region with nodes and elements from fascicle group
+    :param segment_name: name of the dataset segment (i.e. SR005-CL1)
+    :param output_path: path to the folder where to save the output results
+    :param output_suffix: optional suffix added to the output file name, e.g. for level of detail.
+    :return: path to file with Zinc region with nodes and elements from fascicle group.
+    """
 
-    # need to fill these with x, y, z coordinates
-    x_edges = []
-    y_edges = []
-    z_edges = []
+    fascicle_output_path = get_fascicle_output_path(segment_name, output_path, output_suffix)
+    with open(fascicle_output_path, 'wb') as fascicle_output_file:
+        fascicle_output_file.write(fascicles_buffer)
 
-    for edge in G.edges(data=True):
-        # format: [beginning, ending, None]
-        x_coords = [x_node_coords[edge[0]], x_node_coords[edge[1]], None]
-        x_edges += x_coords
+    return fascicle_output_path
 
-        y_coords = [y_node_coords[edge[0]], y_node_coords[edge[1]], None]
-        y_edges += y_coords
 
-        z_coords = [z_node_coords[edge[0]], z_node_coords[edge[1]], None]
-        z_edges += z_coords
+def create_fascicle_graph_buffer(G, identifier_ranges):
+    """
+    :param G: networkx graph read from the graphml file with trunk fascicle data for that segment
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+        already used by the segment. The fascicle group range is allocated after them and added in place.
+    :return: EX format bytes buffer with Zinc region with nodes and elements from fascicle group.
+    """
 
     # create region containing fascicles data
     context = Context("fascicles")
@@ -97,9 +171,13 @@ def read_fascicle_file_into_region(fascicle_path, segment_name, output_path):
     elementtemplate.defineField(coordinates, -1, eft)
     elementtemplate.defineField(radius, -1, eft)
 
+    # start fascicle identifiers after those used by the segment trunk, branches and orientation markers
+    allocate_identifier_ranges([('fascicle', G.number_of_nodes(), G.number_of_edges())], identifier_ranges)
+    fascicle_node_range, fascicle_element_range = identifier_ranges['fascicle']
+
     graph_node_to_node_map = {}
 
-    node_identifier = 500000
+    node_identifier = fascicle_node_range.start
     for node in G.nodes(data=True):
         label = node[0]
         graph_node_to_node_map[label] = node_identifier
@@ -120,7 +198,7 @@ def read_fascicle_file_into_region(fascicle_path, segment_name, output_path):
     fascicle_field_group.setSubelementHandlingMode(FieldGroup.SUBELEMENT_HANDLING_MODE_FULL)
     fascicle_mesh_group = fascicle_field_group.getOrCreateMeshGroup(mesh1d)
 
-    element_identifier = 500000
+    element_identifier = fascicle_element_range.start
     for edge in G.edges(data=True):
         nids = [
             graph_node_to_node_map[edge[0]],
@@ -131,9 +209,6 @@ def read_fascicle_file_into_region(fascicle_path, segment_name, output_path):
         fascicle_mesh_group.addElement(element)
         element_identifier += 1
 
-    fascicle_output_path = os.path.join(output_path, 'fascicles-' + segment_name + '.exf')
-    fascicles_region.writeFile(fascicle_output_path)
-
-    return fascicle_output_path
+    return write_region_to_buffer(fascicles_region)
 
 
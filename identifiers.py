@@ -0,0 +1,111 @@
+import csv
+
+
+def count_segment_identifiers(trunk_group_name, trunk_coordinates, branch_names, branch_coordinates_data,
+                              branch_parent_indices, orientation_markers):
+    """
+    :param trunk_group_name: name used for trunk group
+    :param trunk_coordinates: list with x, y, z trunk coordinates
+    :param branch_names: list with names of the branches, sorted from first level to second level, etc.
+    :param branch_coordinates_data: dictionary mapping branch name to list with x, y, z branch coordinates
+    :param branch_parent_indices: dictionary mapping branch name to
+        (parent branch name, index of parent coordinate where branch links to the parent)
+    :param orientation_markers: dictionary mapping orientation label to list of x, y, z coordinates
+    :return: List of (group name, number of nodes, number of elements) in the order write_exf creates them.
+    """
+
+    group_counts = [(trunk_group_name, len(trunk_coordinates), max(len(trunk_coordinates) - 1, 0))]
+
+    for branch_name in branch_names:
+        node_count = len(branch_coordinates_data[branch_name])
+        parent_name, parent_index = branch_parent_indices[branch_name]
+        # stitched branches have an extra element linking the first branch node to the parent
+        element_count = node_count if parent_index is not None else max(node_count - 1, 0)
+        group_counts.append((branch_name, node_count, element_count))
+
+    if orientation_markers:
+        for orientation_marker, orientation_points in orientation_markers.items():
+            group_counts.append((orientation_marker, len(orientation_points), 0))
+
+    return group_counts
+
+
+def next_free_identifiers(identifier_ranges):
+    """
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+    :return: first unused node identifier, first unused element identifier.
+    """
+
+    node_identifier = 1
+    element_identifier = 1
+    for node_range, element_range in identifier_ranges.values():
+        node_identifier = max(node_identifier, node_range.stop)
+        element_identifier = max(element_identifier, element_range.stop)
+    return node_identifier, element_identifier
+
+
+def allocate_identifier_ranges(group_counts, identifier_ranges=None):
+    """
+    Allocate consecutive node and element identifier ranges for each group, starting after the
+    highest identifiers already in identifier_ranges.
+    :param group_counts: list of (group name, number of nodes, number of elements)
+    :param identifier_ranges: optional dict of already allocated ranges, extended in place
+    :return: Dict mapping group name to (node identifier range, element identifier range)
+    """
+
+    if identifier_ranges is None:
+        identifier_ranges = {}
+
+    node_identifier, element_identifier = next_free_identifiers(identifier_ranges)
+    for group_name, node_count, element_count in group_counts:
+        identifier_ranges[group_name] = (range(node_identifier, node_identifier + node_count),
+                                         range(element_identifier, element_identifier + element_count))
+        node_identifier += node_count
+        element_identifier += element_count
+
+    return identifier_ranges
+
+
+def find_identifier_group(identifier_ranges, identifier, is_element=False):
+    """
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+    :param identifier: node or element identifier
+    :param is_element: True if identifier is an element identifier, False for node identifier
+    :return: name of the group the identifier was allocated to, or None if not allocated.
+    """
+
+    for group_name, (node_range, element_range) in identifier_ranges.items():
+        if identifier in (element_range if is_element else node_range):
+            return group_name
+    return None
+
+
+def write_identifier_ranges(output_file, identifier_ranges):
+    """
+    :param output_file: location of the csv file with identifier ranges
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+    """
+
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(['group', 'first node', 'last node', 'first element', 'last element'])
+        for group_name, (node_range, element_range) in identifier_ranges.items():
+            writer.writerow([group_name,
+                             node_range.start, node_range.stop - 1,
+                             element_range.start, element_range.stop - 1])
+
+
+def read_identifier_ranges(identifiers_file):
+    """
+    :param identifiers_file: location of the csv file written by write_identifier_ranges
+    :return: Dict mapping group name to (node identifier range, element identifier range)
+    """
+
+    identifier_ranges = {}
+    with open(identifiers_file, 'r') as csvfile:
+        plots = csv.reader(csvfile, delimiter=',')
+        next(plots, None)  # skip headers
+        for row in plots:
+            identifier_ranges[row[0]] = (range(int(row[1]), int(row[2]) + 1),
+                                         range(int(row[3]), int(row[4]) + 1))
+    return identifier_ranges
@@ -1,91 +1,125 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from csv_processing import find_tracing_csv_files, process_segment_csv_files
-from fascicles import find_trunk_fascicle_file_for_segment, read_fascicle_file_into_region
-from nerve_morphology import find_trunk_morphology_file_for_segment, process_trunk_morphology_file_radius
-from anatomy import read_vagus_branching_pattern_spreadsheet, create_orientation_markers
-from annotations import add_trunk_annotation_terms
-from output import write_exf
+from csv_processing import find_tracing_csv_files
+from pipeline import get_processing_options, process_dataset, write_dataset_streaming, write_segment_results
+from remote_dataset import configure_remote_dataset
+from subject import write_subject_result
+from validation import validate_dataset
+from work_queue import run_worker
 
 
 def main(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path, output_directory,
-         stitching_tolerance):
+         stitching_tolerance, options=None):
     """
+    Write <segment>.exf for each segment of the subject, with fascicles-<segment>.exf if it has fascicle data.
+    Each segment also gets <segment>-identifiers.csv with the node and element identifier ranges of its groups, and
+    <segment>-marker-projections.csv with the nearest trunk node and trunk position of each marker, if it has
+    markers and a trunk.
     :param anatomy_file_path: path to the folder that contains anatomy data
     :param microct_path: path to the folder with csv segmentation files
     :param nerve_morphology_path: path to the folder with csv morphology files
     :param fascicle_path: path to the folder with graphml fascicle files
+        Folders can also be zip or tar archives, or folders inside archives, and files can be gzip compressed.
+        Csv and graphml files of compressed tar archives are read into memory in one pass when the archive is
+        opened, so large datasets are better in zip or uncompressed tar archives.
+        They can also be http or https URLs of folders in a remote dataset with an index.json file listing its
+        files, which are then fetched when needed into a local cache.
     :param output_root_path: path to the folder where to save the output results
     :param stitching_tolerance: tolerance used for branch stitching
-    :return:
+    :param options: optional dict of processing options, defaults in pipeline.default_processing_options:
+        'levels_of_detail': optional list of node density reduction factors, e.g. [4, 16], to also write
+            <segment>-lod<factor>.exf files with reduced node density
+        'prefetch_workers': maximum number of csv files read concurrently. Reading ahead hides the latency of
+            network drives, but holds all csv files of a segment in memory. If 0 or None, files are read one after
+            another, which is the default.
+        'stage_workers': number of threads running independent stages of a segment concurrently, e.g. fascicle
+            parsing while branches are stitched, and writing a segment while the next one is processed.
+            If 0 or None, all stages run one after another, which is the default.
+        'streaming_output': if True, write <segment>.exf files with the streaming EX writer, which uses memory
+            bounded by its chunk size instead of building the whole model in a Zinc region first
+        'queue_directory': optional folder on a file system shared with other workers. If supplied, run as one of
+            several workers on this or other hosts, each processing the segments it claims in the queue folder.
+        'worker_name': name of this worker in the queue folder, by default host name and process id
+        'max_attempts': number of times queue workers try a segment which fails before giving up on it
+        'dtype': optional numpy dtype, e.g. 'float32', for working storage of coordinates and radius, which
+            halves their memory use. Stitching distances are still calculated in double precision. Fascicle graphs
+            are not affected, their values stay networkx node attributes.
+        'significant_digits': optional number of significant digits for real values in the output, e.g. 8 with
+            float32 data, to reduce output size. Output, including fascicles files, is then written with the
+            streaming EX writer.
+        'stream_segment_groups': if True, read, stitch and write each segment one group at a time, so peak memory
+            follows the largest groups rather than the whole segment. Levels of detail are not written in this
+            mode.
+        'remote_cache_directory': optional folder for the local cache of files fetched from remote datasets
+        'remote_cache_size': optional maximum total size in bytes of the remote file cache
+        'preflight': if True, first scan the names, headers and row counts of all dataset files, and stop with
+            a ValueError listing every problem found before any segment is processed
+        'subject_name': optional name of a subject output file. If supplied, also write <subject_name>.exf joining
+            all segments in one scaffold with unique identifiers, each trunk connected to the trunk it continues
+            into, and its identifier ranges to <subject_name>-identifiers.csv.
+            All segment results are then kept in memory until the end. Not written by queue workers or when
+            streaming segment groups.
+        'connection_tolerance': largest squared distance between a trunk end and the start of the trunk it
+            continues into, for the subject output. Defaults to the stitching tolerance.
+    :return: list of output file paths. Fascicle and csv files are only listed by queue workers.
     """
 
-    # read anatomy data (vagus branching pattern spreadsheet) with orientations and annotations
-    if anatomy_file_path:
-        vagus_orientations, vagus_branch_terms = read_vagus_branching_pattern_spreadsheet(anatomy_file_path)
+    options = get_processing_options(options)
+    configure_remote_dataset(options['remote_cache_directory'], options['remote_cache_size'])
+
+    if options['preflight']:
+        problems = validate_dataset(microct_path, nerve_morphology_path)
+        for problem in problems:
+            print('Problem:', problem)
+        if problems:
+            raise ValueError(str(len(problems)) + ' problems found in dataset files by pre-flight validation')
+
+    stage_workers = options['stage_workers']
+    subject_name = options['subject_name']
+    if options['stream_segment_groups'] and options['levels_of_detail']:
+        print('Warning: levels of detail are not written when streaming segment groups.')
+    if subject_name and (options['queue_directory'] or options['stream_segment_groups']):
+        print('Warning: subject output is not written by queue workers or when streaming segment groups.')
+    connection_tolerance = options['connection_tolerance']
+    if connection_tolerance is None:
+        connection_tolerance = stitching_tolerance
+
+    if options['queue_directory']:
+        if not stage_workers:
+            return run_worker(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path, output_directory,
+                              stitching_tolerance, options['queue_directory'], options)
+        with ThreadPoolExecutor(max_workers=stage_workers) as executor:
+            return run_worker(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path, output_directory,
+                              stitching_tolerance, options['queue_directory'], options, executor)
+
+    # process and write each segment one group at a time
+    if options['stream_segment_groups']:
+        return write_dataset_streaming(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path,
+                                       stitching_tolerance, output_directory, options)
+
+    # process each segment in memory, then write its output files
+    if not stage_workers:
+        segment_results = process_dataset(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path,
+                                          stitching_tolerance, options)
+        if subject_name:
+            segment_results = list(segment_results)
+        output_files = write_segment_results(segment_results, output_directory, options['levels_of_detail'],
+                                             streaming_output=options['streaming_output'],
+                                             significant_digits=options['significant_digits'])
     else:
-        print('Warning: no anatomy file found.')
-        vagus_orientations = None
-        vagus_branch_terms = {None: None}
-
-    # add trunk annotation groups in case they aren't in vagus terms
-    vagus_branch_terms.update(add_trunk_annotation_terms())
-
-    # read micro ct data
-    segment_files = find_tracing_csv_files(microct_path)
-    output_files = []
-    if len(segment_files) > 0:
-        for segment_name in segment_files.keys():
-            print(segment_name)
-            segment_csv_files = segment_files[segment_name]
-            if len(segment_csv_files) > 0:
-                marker_data, trunk_group_name, trunk_coordinates, branch_names, \
-                    branch_coordinates_data, branch_parent_indices = process_segment_csv_files(segment_csv_files,
-                                                                                               stitching_tolerance)
-
-                # find vagus terms used for annotating the segment data
-                vagus_terms = dict()
-                if vagus_branch_terms:
-                    vagus_terms[trunk_group_name] = vagus_branch_terms[trunk_group_name]
-                    for branch_name in branch_coordinates_data.keys():
-                        if branch_name in vagus_branch_terms.keys():
-                            vagus_terms[branch_name] = vagus_branch_terms[branch_name]
-
-                # calculate orientation markers
-                orientation_markers = None
-                if vagus_orientations:
-                    orientation_markers = create_orientation_markers(branch_coordinates_data, vagus_orientations)
-
-                # find morphology file corresponding to the segment to add the radius data
-                trunk_radius = []
-                avg_branch_radius = None
-                if nerve_morphology_path:
-                    morphology_file_path = find_trunk_morphology_file_for_segment(nerve_morphology_path,
-                                                                                  segment_name, trunk_group_name)
-                    print(segment_name, trunk_group_name, morphology_file_path)
-                    if morphology_file_path:
-                        trunk_radius, avg_trunk_radius = process_trunk_morphology_file_radius(morphology_file_path, trunk_coordinates)
-                        avg_branch_radius = avg_trunk_radius / 2
-
-                # find fascicles file corresponding to the segment
-                fascicles_region_path = None
-                if fascicle_path:
-                    fascicle_input_path = find_trunk_fascicle_file_for_segment(fascicle_path, segment_name, trunk_group_name)
-                    print(segment_name, trunk_group_name, fascicle_input_path)
-                    if fascicle_input_path:
-                        fascicles_region_path = read_fascicle_file_into_region(fascicle_input_path, segment_name, output_directory)
-
-                # write output file
-                output_filename = segment_name + ".exf"
-                output_file = os.path.join(output_directory, output_filename)
-                output_files.append(output_file)
-                write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, trunk_radius, branch_names,
-                          branch_coordinates_data, branch_parent_indices, avg_branch_radius, orientation_markers,
-                          vagus_terms, fascicles_region_path)
-            else:
-                print('Warning: no microct files found for segment', segment_name)
-    else:
-        print('Warning: no microct files found.')
+        with ThreadPoolExecutor(max_workers=stage_workers) as executor:
+            segment_results = process_dataset(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path,
+                                              stitching_tolerance, options, executor)
+            if subject_name:
+                segment_results = list(segment_results)
+            output_files = write_segment_results(segment_results, output_directory, options['levels_of_detail'],
+                                                 executor, options['streaming_output'], options['significant_digits'])
+
+    # join all segments from their in-memory results
+    if subject_name:
+        output_files.extend(write_subject_result(segment_results, output_directory, subject_name,
+                                                 connection_tolerance))
 
     return output_files
 
@@ -0,0 +1,209 @@
+import os
+
+from ex_writer import write_exf_streaming
+from fascicles import write_fascicle_graph_into_region
+from identifiers import allocate_identifier_ranges, count_segment_identifiers
+from output import write_exf
+
+
+def level_of_detail_suffix(level_of_detail):
+    """
+    :param level_of_detail: node density reduction factor, 1 for full resolution
+    :return: suffix added to output file names for that level of detail.
+    """
+
+    return '' if level_of_detail == 1 else '-lod' + str(level_of_detail)
+
+
+def decimate_indices(point_count, level_of_detail, keep_indices):
+    """
+    :param point_count: number of points in the group
+    :param level_of_detail: node density reduction factor, keeps every level_of_detail-th point
+    :param keep_indices: indices which must be kept, e.g. points where child branches attach
+    :return: sorted list of kept point indices, always including the first and last point.
+    """
+
+    kept_indices = set(range(0, point_count, level_of_detail))
+    kept_indices.update(index for index in keep_indices if 0 <= index < point_count)
+    if point_count > 0:
+        kept_indices.add(point_count - 1)
+    return sorted(kept_indices)
+
+
+def find_kept_group_indices(trunk_group_name, trunk_coordinates, branch_names, branch_coordinates_data,
+                            branch_parent_indices, level_of_detail):
+    """
+    :return: Dict mapping trunk and branch names to sorted list of point indices kept at the level of detail,
+        keeping the first and last point of every group and the parent points branches attach to.
+    See decimate_segment_data for parameters.
+    """
+
+    # write_exf links a branch to parent node index - 1 for parent indices > 1, so keep both parent points
+    # to link to the same node at every level of detail
+    keep_indices = {trunk_group_name: set()}
+    keep_indices.update({branch_name: set() for branch_name in branch_names})
+    for branch_name in branch_names:
+        parent_name, parent_index = branch_parent_indices[branch_name]
+        if parent_index is not None:
+            keep_indices[parent_name].update([parent_index, parent_index - 1])
+
+    kept_group_indices = {trunk_group_name: decimate_indices(len(trunk_coordinates), level_of_detail,
+                                                             keep_indices[trunk_group_name])}
+    for branch_name in branch_names:
+        kept_group_indices[branch_name] = decimate_indices(len(branch_coordinates_data[branch_name]),
+                                                           level_of_detail, keep_indices[branch_name])
+    return kept_group_indices
+
+
+def decimate_segment_data(trunk_group_name, trunk_coordinates, trunk_radius, branch_names, branch_coordinates_data,
+                          branch_parent_indices, level_of_detail):
+    """
+    Reduce node density of the trunk and branches while keeping the first and last point of every group and
+    the parent points branches attach to.
+    :param trunk_group_name: name used for trunk group
+    :param trunk_coordinates: list with x, y, z trunk coordinates
+    :param trunk_radius: list of radius values for trunk coordinates, can be empty
+    :param branch_names: list with names of the branches, sorted from first level to second level, etc.
+    :param branch_coordinates_data: dictionary mapping branch name to list with x, y, z branch coordinates
+    :param branch_parent_indices: dictionary mapping branch name to
+        (parent branch name, index of parent coordinate where branch links to the parent)
+    :param level_of_detail: node density reduction factor
+    :return:
+        trunk_coordinates: decimated trunk coordinates.
+        trunk_radius: decimated trunk radius.
+        branch_coordinates_data: dictionary mapping branch name to decimated branch coordinates.
+        branch_parent_indices: dictionary mapping branch name to (parent branch name, decimated parent index).
+    """
+
+    kept_group_indices = find_kept_group_indices(trunk_group_name, trunk_coordinates, branch_names,
+                                                 branch_coordinates_data, branch_parent_indices, level_of_detail)
+    kept_trunk_indices = kept_group_indices[trunk_group_name]
+    lod_trunk_coordinates = [trunk_coordinates[i] for i in kept_trunk_indices]
+    lod_trunk_radius = [trunk_radius[i] for i in kept_trunk_indices] if len(trunk_radius) > 0 else []
+
+    lod_branch_coordinates_data = {}
+    for branch_name in branch_names:
+        branch_coordinates = branch_coordinates_data[branch_name]
+        lod_branch_coordinates_data[branch_name] = [branch_coordinates[i] for i in kept_group_indices[branch_name]]
+
+    lod_branch_parent_indices = {}
+    for branch_name in branch_names:
+        parent_name, parent_index = branch_parent_indices[branch_name]
+        if parent_index is not None:
+            parent_index = kept_group_indices[parent_name].index(parent_index)
+        lod_branch_parent_indices[branch_name] = (parent_name, parent_index)
+
+    return lod_trunk_coordinates, lod_trunk_radius, lod_branch_coordinates_data, lod_branch_parent_indices
+
+
+def decimate_fascicle_graph(G, level_of_detail):
+    """
+    Reduce node density of the fascicle graph by removing nodes in the middle of unbranched fascicle paths
+    and joining their neighbours. Fascicle ends and branching/merging nodes are always kept.
+    :param G: networkx graph with fascicle data
+    :param level_of_detail: node density reduction factor, keeps every level_of_detail-th node along each path
+    :return: decimated copy of the graph.
+    """
+
+    lod_G = G.copy()
+    # paths follow edges in both directions in directed graphs, e.g. from graphml files with directed edges
+    undirected_G = G.to_undirected(as_view=True)
+    undirected_lod_G = lod_G.to_undirected(as_view=True)
+    visited_nodes = set()
+
+    def is_path_node(node):
+        # two different neighbours, so not an end, branching/merging node or self loop
+        return len(undirected_G[node]) == 2 and G.degree(node) == 2
+
+    def decimate_path(previous_node, node):
+        # walk along the path from previous_node, counting path nodes from it
+        index = 1
+        while is_path_node(node) and node not in visited_nodes:
+            visited_nodes.add(node)
+            next_node = [neighbour for neighbour in undirected_G.neighbors(node) if neighbour != previous_node][0]
+            if index % level_of_detail != 0:
+                neighbour_1, neighbour_2 = undirected_lod_G.neighbors(node)
+                if not undirected_lod_G.has_edge(neighbour_1, neighbour_2):
+                    # keep the direction of the path through the removed node
+                    if lod_G.is_directed() and lod_G.has_edge(node, neighbour_1):
+                        neighbour_1, neighbour_2 = neighbour_2, neighbour_1
+                    lod_G.remove_node(node)
+                    lod_G.add_edge(neighbour_1, neighbour_2)
+            previous_node, node = node, next_node
+            index += 1
+
+    # paths start at fascicle ends and branching/merging nodes
+    for node in G.nodes():
+        if not is_path_node(node):
+            for neighbour in undirected_G.neighbors(node):
+                decimate_path(node, neighbour)
+    # closed loops without such nodes start at their first node in graph order, which is kept
+    for node in G.nodes():
+        if is_path_node(node) and node not in visited_nodes:
+            visited_nodes.add(node)
+            decimate_path(node, next(iter(undirected_G.neighbors(node))))
+    return lod_G
+
+
+def write_levels_of_detail(output_directory, segment_name, levels_of_detail, marker_data, trunk_group_name,
+                           trunk_coordinates, trunk_radius, branch_names, branch_coordinates_data,
+                           branch_parent_indices, avg_branch_radius, orientation_markers, vagus_terms,
+                           fascicle_graph, streaming_output=False, significant_digits=None,
+                           branch_radius_data=None):
+    """
+    Write reduced node density versions of the segment output, built from the same in-memory data.
+    :param output_directory: path to the folder where to save the output results
+    :param segment_name: name of the dataset segment (i.e. SR005-CL1)
+    :param levels_of_detail: list of node density reduction factors, e.g. [4, 16]. Factor 1 is skipped as the
+        full resolution output is written separately.
+    :param fascicle_graph: networkx graph with fascicle data for the segment, or None
+    :param streaming_output: if True, write with the streaming EX writer instead of building a Zinc region
+    :param significant_digits: optional number of significant digits for real values, uses the streaming EX writer
+    :param branch_radius_data: optional dictionary mapping branch name to list of radius values for its
+        coordinates, for branches with morphology data
+    See write_exf for the remaining parameters.
+    :return: list of level of detail output file paths.
+    """
+
+    output_files = []
+    for level_of_detail in levels_of_detail:
+        if level_of_detail == 1:
+            continue
+        suffix = level_of_detail_suffix(level_of_detail)
+        lod_trunk_coordinates, lod_trunk_radius, lod_branch_coordinates_data, lod_branch_parent_indices = \
+            decimate_segment_data(trunk_group_name, trunk_coordinates, trunk_radius, branch_names,
+                                  branch_coordinates_data, branch_parent_indices, level_of_detail)
+        lod_branch_radius_data = None
+        if branch_radius_data:
+            kept_group_indices = find_kept_group_indices(trunk_group_name, trunk_coordinates, branch_names,
+                                                         branch_coordinates_data, branch_parent_indices,
+                                                         level_of_detail)
+            lod_branch_radius_data = {branch_name: [branch_radius[i] for i in kept_group_indices[branch_name]]
+                                      for branch_name, branch_radius in branch_radius_data.items()}
+
+        identifier_ranges = allocate_identifier_ranges(count_segment_identifiers(
+            trunk_group_name, lod_trunk_coordinates, branch_names, lod_branch_coordinates_data,
+            lod_branch_parent_indices, orientation_markers))
+
+        lod_fascicle_graph = None
+        fascicles_region_path = None
+        if fascicle_graph is not None:
+            lod_fascicle_graph = decimate_fascicle_graph(fascicle_graph, level_of_detail)
+            fascicles_region_path = write_fascicle_graph_into_region(
+                lod_fascicle_graph, segment_name, output_directory, identifier_ranges, suffix, significant_digits)
+
+        output_file = os.path.join(output_directory, segment_name + suffix + ".exf")
+        if streaming_output or significant_digits:
+            write_exf_streaming(output_file, marker_data, trunk_group_name, lod_trunk_coordinates, lod_trunk_radius,
+                                branch_names, lod_branch_coordinates_data, lod_branch_parent_indices,
+                                avg_branch_radius, orientation_markers, vagus_terms, lod_fascicle_graph,
+                                identifier_ranges, significant_digits=significant_digits,
+                                branch_radius_data=lod_branch_radius_data)
+        else:
+            write_exf(output_file, marker_data, trunk_group_name, lod_trunk_coordinates, lod_trunk_radius,
+                      branch_names, lod_branch_coordinates_data, lod_branch_parent_indices, avg_branch_radius,
+                      orientation_markers, vagus_terms, fascicles_region_path, identifier_ranges,
+                      lod_branch_radius_data)
+        output_files.append(output_file)
+
+    return output_files
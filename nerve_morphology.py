@@ -1,7 +1,10 @@
 import os
 import csv
 
-from cmlibs.maths.vectorops import magnitude_squared, sub
+import numpy as np
+from scipy.spatial import cKDTree
+
+from dataset_files import has_dataset_extension, is_dataset_dir, open_dataset_file, walk_dataset
 
 
 def find_trunk_morphology_file_for_segment(nerve_morphology_path, segment_name, trunk_group_name):
@@ -12,29 +15,49 @@ def find_trunk_morphology_file_for_segment(nerve_morphology_path, segment_name,
     :return: path to the csv file with trunk morphology data for that segment
     """
 
-    if os.path.isdir(nerve_morphology_path):
+    if is_dataset_dir(nerve_morphology_path):
         morphology_file_path = None
         trunk_keywords = trunk_group_name.split()
-        for rootpath, dirs, files in os.walk(nerve_morphology_path):
+        for rootpath, dirs, files in walk_dataset(nerve_morphology_path):
             for f in files:
-                if all([trunk_keyword in f for trunk_keyword in trunk_keywords]) and (segment_name in f) and f.endswith('.csv'):
+                if all([trunk_keyword in f for trunk_keyword in trunk_keywords]) and (segment_name in f) and \
+                        has_dataset_extension(f, '.csv'):
                     morphology_file_path = os.path.join(rootpath, f)
                     break
     return morphology_file_path
 
 
-def process_trunk_morphology_file_radius(morphology_file_path, trunk_coordinates):
+def find_branch_morphology_files_for_segment(nerve_morphology_path, segment_name, branch_names):
+    """
+    :param nerve_morphology_path: path to the folder containing nerve morphology csv files
+    :param segment_name: name of the dataset segment (i.e. SR005-CL1)
+    :param branch_names: names of the branches in that segment
+    :return: Dict mapping branch name to path to the csv file with its morphology data, for branches with one.
+        File names contain the branch name with underscores for spaces, e.g. SR005-CL1-left_cardiac_branch-...
+    """
+
+    branch_morphology_files = {}
+    if is_dataset_dir(nerve_morphology_path):
+        branch_file_keys = {'-' + branch_name.replace(' ', '_') + '-': branch_name for branch_name in branch_names}
+        for rootpath, dirs, files in walk_dataset(nerve_morphology_path):
+            for f in files:
+                if (segment_name in f) and has_dataset_extension(f, '.csv'):
+                    for branch_file_key, branch_name in branch_file_keys.items():
+                        if branch_file_key in f:
+                            branch_morphology_files[branch_name] = os.path.join(rootpath, f)
+    return branch_morphology_files
+
+
+def read_morphology_file(morphology_file_path, dtype=None):
     """
     :param morphology_file_path: path to the csv morphology file
-    :param trunk_coordinates: list of x, y, z coordinates for trunk group.
-    :return:
-        trunk_radius: List of values for radius, associated with trunk coordinates.
-        avg_trunk_radius: Average value from trunk_radius. Used later for estimating average branch radius.
+    :param dtype: optional numpy dtype, e.g. 'float32', to store radius values as a numpy array
+    :return: N x 3 array of morphology centre points, list (or array with dtype) of radius at those points.
     """
 
     coords_data = []
     radius_data = []
-    with open(morphology_file_path, 'r') as csvfile:
+    with open_dataset_file(morphology_file_path) as csvfile:
         plots = csv.reader(csvfile, delimiter=',')
         next(plots, None)  # skip headers
         for row in plots:
@@ -45,20 +68,114 @@ def process_trunk_morphology_file_radius(morphology_file_path, trunk_coordinates
                 # radius_data.append(min(float(row[6]), float(row[7])) / 2)
                 radius_data.append(float(row[3]) / 2)
 
-    trunk_radius = []
-    for index, trunk_coordinate in enumerate(trunk_coordinates):
-        # find the nearest trunk point for each point in the morphology data
-        min_dsq = float('inf')
-        for i in range(len(coords_data)):
-            morphology_trunk_node = coords_data[i]
-            distance_squared = magnitude_squared(sub(morphology_trunk_node, trunk_coordinate))
-            if distance_squared <= min_dsq:
-                min_dsq = distance_squared
-                closest_morphology_node_index = i
+    coords_data = np.array(coords_data, dtype=dtype if dtype else np.float64).reshape(-1, 3)
+    if dtype:
+        radius_data = np.array(radius_data, dtype=dtype)
+    return coords_data, radius_data
 
-        trunk_radius.append(radius_data[closest_morphology_node_index])
 
-    avg_trunk_radius = sum(trunk_radius)/len(trunk_radius)
-    return trunk_radius, avg_trunk_radius
+def _find_nearest_point_indices_brute_force(points, reference_points, chunk_size=2 ** 18):
+    """
+    Compare every point with every reference point, in chunks of points so that the distance matrix stays below
+    chunk_size values. See find_nearest_point_indices for parameters.
+    """
+
+    reference_count = len(reference_points)
+    # reversed, so argmin finds the last of equally close points
+    reference_components = [np.ascontiguousarray(component, dtype=np.float64)
+                            for component in reference_points[::-1].T]
+    nearest_indices = np.zeros(len(points), dtype=np.intp)
+    points_per_chunk = max(1, chunk_size // max(1, reference_count))
+    for start in range(0, len(points), points_per_chunk):
+        chunk_points = points[start:start + points_per_chunk]
+        # summed in the same order as np.sum over x, y, z, so distances are identical
+        distances_squared = None
+        for component, reference_component in zip(chunk_points.T, reference_components):
+            differences = reference_component[np.newaxis, :] - component[:, np.newaxis]
+            differences *= differences
+            if distances_squared is None:
+                distances_squared = differences
+            else:
+                distances_squared += differences
+        nearest_indices[start:start + points_per_chunk] = \
+            reference_count - 1 - np.argmin(distances_squared, axis=1)
+    return nearest_indices
+
+
+def find_nearest_point_indices(points, reference_points, candidate_count=8, chunk_size=2 ** 18):
+    """
+    Find the nearest reference point for many points at once with a k-d tree of the reference points.
+    The nearest candidate_count reference points of each point are compared again with the same arithmetic as a
+    brute force search, and points whose candidates may not include all equally close reference points are
+    searched by brute force, so results are identical to it.
+    :param points: list or array of x, y, z coordinates to find nearest reference points for
+    :param reference_points: N x 3 array of reference point coordinates
+    :param candidate_count: number of nearest reference points found in the k-d tree for each point
+    :param chunk_size: maximum number of point distances calculated at once in a brute force search
+    :return: array with index of the nearest reference point for each point. Distances are calculated in double
+        precision and the last of equally close reference points is used, as found by a sequential search.
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    reference_points = np.asarray(reference_points, dtype=np.float64).reshape(-1, 3)
+    candidate_count = min(candidate_count, len(reference_points))
+    if len(points) == 0 or candidate_count == len(reference_points):
+        return _find_nearest_point_indices_brute_force(points, reference_points, chunk_size)
+
+    tree_distances, candidate_indices = cKDTree(reference_points).query(points, k=candidate_count)
+    tree_distances = tree_distances.reshape(len(points), -1)
+    candidate_indices = candidate_indices.reshape(len(points), -1)
+    candidate_distances_squared = np.sum((reference_points[candidate_indices] - points[:, np.newaxis, :]) ** 2,
+                                         axis=2)
+    is_nearest = candidate_distances_squared == np.min(candidate_distances_squared, axis=1)[:, np.newaxis]
+    nearest_indices = np.max(np.where(is_nearest, candidate_indices, -1), axis=1)
+
+    # further reference points may be as close as the farthest candidate, e.g. repeated points
+    unresolved = tree_distances[:, -1] <= tree_distances[:, 0] * (1.0 + 1.0E-9)
+    if np.any(unresolved):
+        nearest_indices[unresolved] = _find_nearest_point_indices_brute_force(points[unresolved], reference_points,
+                                                                             chunk_size)
+    return nearest_indices
+
+
+def map_morphology_radius(group_coordinates, group_morphology, dtype=None):
+    """
+    Map radius from morphology data to the points of several groups, with one nearest point search per group as
+    each group is only matched to its own morphology points.
+    :param group_coordinates: Dict mapping group name to list of x, y, z coordinates
+    :param group_morphology: Dict mapping group name to (morphology points, radius) from read_morphology_file,
+        for the groups with morphology data
+    :param dtype: optional numpy dtype, e.g. 'float32', to return radius values as numpy arrays
+    :return: Dict mapping group name to list (or array with dtype) of radius for each point, for groups in both.
+    """
+
+    group_radius = {}
+    for group_name, (morphology_points, radius_data) in group_morphology.items():
+        if group_name not in group_coordinates or len(morphology_points) == 0:
+            continue
+        nearest_indices = find_nearest_point_indices(group_coordinates[group_name], morphology_points)
+        if dtype:
+            group_radius[group_name] = np.asarray(radius_data, dtype=dtype)[nearest_indices]
+        else:
+            group_radius[group_name] = [radius_data[index] for index in nearest_indices]
+    return group_radius
 
 
+def process_trunk_morphology_file_radius(morphology_file_path, trunk_coordinates, dtype=None):
+    """
+    :param morphology_file_path: path to the csv morphology file
+    :param trunk_coordinates: list of x, y, z coordinates for trunk group.
+    :param dtype: optional numpy dtype, e.g. 'float32', to store morphology data and trunk radius as numpy arrays.
+    :return:
+        trunk_radius: List of values for radius, associated with trunk coordinates.
+        avg_trunk_radius: Average value from trunk_radius. Used later for estimating average branch radius.
+    """
+
+    trunk_radius = map_morphology_radius({'trunk': trunk_coordinates},
+                                         {'trunk': read_morphology_file(morphology_file_path, dtype)},
+                                         dtype).get('trunk', [])
+    if dtype:
+        avg_trunk_radius = float(np.mean(trunk_radius, dtype=np.float64))
+    else:
+        avg_trunk_radius = sum(trunk_radius)/len(trunk_radius)
+    return trunk_radius, avg_trunk_radius
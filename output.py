@@ -7,10 +7,13 @@ from cmlibs.utils.zinc.field import findOrCreateFieldCoordinates, findOrCreateFi
     find_or_create_field_finite_element
 from cmlibs.utils.zinc.group import group_add_group_local_contents
 
+from identifiers import allocate_identifier_ranges, count_segment_identifiers
+
 
 def write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, trunk_radius,
               branch_names, branch_coordinates_data, branch_parent_indices, avg_branch_radius,
-              orientation_markers, vagus_terms, fascicles_region_path):
+              orientation_markers, vagus_terms, fascicles_region_path, identifier_ranges=None,
+              branch_radius_data=None):
     """
     :param output_file: location of the output file
     :param marker_data: dict mapping marker names to marker coordinates
@@ -22,13 +25,90 @@ def write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, tru
         (parent branch name, index of parent coordinate where branch links to the parent)
     :param orientation_markers: dictionary mapping 8 orientations to list of x, y, z coordinates used for orientation
     :param vagus_terms: dictionary mapping branch name to annotation term
-    :param fascicles_region_path: path to file with Zinc region with nodes and elements from fascicle group
+    :param fascicles_region_path: path to file, or EX format bytes buffer, with Zinc region with nodes and elements
+        from fascicle group
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range).
+        Allocated from the group sizes if not supplied.
+    :param branch_radius_data: optional dictionary mapping branch name to list of radius values for its
+        coordinates, for branches with morphology data. Other branches use avg_branch_radius.
+    :return: identifier_ranges used for the output.
     """
 
     # writing out data as a single exf file
-    # set up zinc region
     context = Context("data_region")
     data_region = context.getDefaultRegion()
+    identifier_ranges = create_segment_region(
+        data_region, marker_data, trunk_group_name, trunk_coordinates, trunk_radius, branch_names,
+        branch_coordinates_data, branch_parent_indices, avg_branch_radius, orientation_markers, vagus_terms,
+        fascicles_region_path, identifier_ranges, branch_radius_data)
+
+    sir = data_region.createStreaminformationRegion()
+    srf = sir.createStreamresourceFile(output_file)
+    result = data_region.write(sir)
+
+    return identifier_ranges
+
+
+def get_branch_parent_node_identifier(parent_start_node_identifier, parent_index):
+    """
+    :param parent_start_node_identifier: identifier of the first node of the parent group
+    :param parent_index: index of parent coordinate where branch links to the parent
+    :return: identifier of the parent node the first branch element starts from.
+    """
+
+    parent_node_id = parent_start_node_identifier + parent_index
+    if parent_index > 1:
+        # trunk is not a parent group
+        parent_node_id -= 1
+    return parent_node_id
+
+
+def write_region_to_buffer(region):
+    """
+    :param region: Zinc region
+    :return: bytes buffer with the region in EX format, as it would be written to an .exf file.
+    """
+
+    sir = region.createStreaminformationRegion()
+    srm = sir.createStreamresourceMemory()
+    region.write(sir)
+    result, buffer = srm.getBuffer()
+    return buffer
+
+
+def read_region_from_buffer(region, buffer):
+    """
+    :param region: Zinc region to read into
+    :param buffer: bytes buffer with a region in EX format
+    :return: Zinc result code
+    """
+
+    sir = region.createStreaminformationRegion()
+    sir.createStreamresourceMemoryBuffer(buffer)
+    return region.read(sir)
+
+
+def create_segment_region(data_region, marker_data, trunk_group_name, trunk_coordinates, trunk_radius,
+                          branch_names, branch_coordinates_data, branch_parent_indices, avg_branch_radius,
+                          orientation_markers, vagus_terms, fascicles_region, identifier_ranges=None,
+                          branch_radius_data=None, first_marker_identifier=1):
+    """
+    Create segment nodes, elements, groups and markers in a Zinc region.
+    :param data_region: empty Zinc region to add the segment data to, or a region with other segments using
+        different identifiers, whose groups of the same name are merged with the segment groups
+    :param fascicles_region: path to file, or EX format bytes buffer, with Zinc region with nodes and elements
+        from fascicle group
+    :param first_marker_identifier: identifier of the first marker datapoint
+    See write_exf for the remaining parameters.
+    :return: identifier_ranges used for the region.
+    """
+
+    if identifier_ranges is None:
+        identifier_ranges = allocate_identifier_ranges(count_segment_identifiers(
+            trunk_group_name, trunk_coordinates, branch_names, branch_coordinates_data, branch_parent_indices,
+            orientation_markers))
+
+    # set up zinc region
     fieldmodule = data_region.getFieldmodule()
     fieldcache = fieldmodule.createFieldcache()
 
@@ -63,20 +143,20 @@ def write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, tru
 
     # add markers to zinc region
     marker_fieldgroup = findOrCreateFieldGroup(fieldmodule, 'marker')
-    marker_nodesetgroup = marker_fieldgroup.createNodesetGroup(datapoints)
+    marker_nodesetgroup = marker_fieldgroup.getOrCreateNodesetGroup(datapoints)
 
-    marker_node_identifier = 1
+    marker_node_identifier = first_marker_identifier
     for marker_name, marker_point in marker_data.items():
         node = datapoints.createNode(marker_node_identifier, dnodetemplate)
         fieldcache.setNode(node)
-        coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, marker_point)
+        coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, [float(x) for x in marker_point])
         marker_names.assignString(fieldcache, marker_name)
         marker_nodesetgroup.addNode(node)
         marker_node_identifier += 1
 
-    # add nodes to zinc region
-    node_identifier = 1
-    element_identifier = 1
+    # add nodes to zinc region, with values converted from numpy float32 working storage as Zinc needs floats
+    node_identifier = identifier_ranges[trunk_group_name][0].start
+    element_identifier = identifier_ranges[trunk_group_name][1].start
 
     # rename trunk group - temporarily
     # if 'left' in trunk_group_name:
@@ -94,9 +174,9 @@ def write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, tru
     for index, trunk_point in enumerate(trunk_coordinates):
         node = nodes.createNode(node_identifier, nodetemplate)
         fieldcache.setNode(node)
-        coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, trunk_point)
+        coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, [float(x) for x in trunk_point])
         if len(trunk_radius) > 0:
-            radius.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, trunk_radius[index])
+            radius.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, float(trunk_radius[index]))
 
         if index > 0:
             element = mesh1d.createElement(element_identifier, elementtemplate)
@@ -117,25 +197,28 @@ def write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, tru
         branch_field_group.setSubelementHandlingMode(FieldGroup.SUBELEMENT_HANDLING_MODE_FULL)
         branch_mesh_group = branch_field_group.getOrCreateMeshGroup(mesh1d)
 
+        node_identifier = identifier_ranges[branch_name][0].start
+        element_identifier = identifier_ranges[branch_name][1].start
+
         # used for temporary stitching
         group_start_nodes[branch_name] = node_identifier
         parent_name, parent_index = branch_parent_indices[branch_name]
+        branch_radius = branch_radius_data.get(branch_name) if branch_radius_data else None
 
         for index, branch_point in enumerate(branch_coordinates):
             node = nodes.createNode(node_identifier, nodetemplate)
             fieldcache.setNode(node)
-            coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, branch_point)
-            if avg_branch_radius:
+            coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, [float(x) for x in branch_point])
+            if len(trunk_radius) > 0 and branch_radius is not None:
+                radius.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, float(branch_radius[index]))
+            elif avg_branch_radius:
                 radius.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, avg_branch_radius)
 
             nids = None
             if parent_index is not None:
                 if index == 0:
                     # get parent node id to add to branch group
-                    parent_node_id = group_start_nodes[parent_name] + parent_index
-                    if parent_index > 1:
-                        # trunk is not a parent group
-                        parent_node_id -= 1
+                    parent_node_id = get_branch_parent_node_identifier(group_start_nodes[parent_name], parent_index)
 
                     # print(branch_name, '->', parent_name, group_start_nodes[parent_name], parent_index)
                     nids = [parent_node_id, node_identifier]
@@ -160,20 +243,21 @@ def write_exf(output_file, marker_data, trunk_group_name, trunk_coordinates, tru
     if orientation_markers:
         for orientation_marker, orientation_points in orientation_markers.items():
             orientation_fieldgroup = findOrCreateFieldGroup(fieldmodule, orientation_marker)
-            orientation_nodesetgroup = orientation_fieldgroup.createNodesetGroup(nodes)
+            orientation_nodesetgroup = orientation_fieldgroup.getOrCreateNodesetGroup(nodes)
 
+            node_identifier = identifier_ranges[orientation_marker][0].start
             for orientation_point in orientation_points:
                 node = nodes.createNode(node_identifier, nodetemplate)
                 fieldcache.setNode(node)
-                coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1, orientation_point)
+                coordinates.setNodeParameters(fieldcache, -1, Node.VALUE_LABEL_VALUE, 1,
+                                              [float(x) for x in orientation_point])
                 orientation_nodesetgroup.addNode(node)
                 node_identifier += 1
 
     # add fascicles data
-    if fascicles_region_path:
-        data_region.readFile(fascicles_region_path)
+    if isinstance(fascicles_region, bytes):
+        read_region_from_buffer(data_region, fascicles_region)
+    elif fascicles_region:
+        data_region.readFile(fascicles_region)
 
-    # write all data in one exf file
-    sir = data_region.createStreaminformationRegion()
-    srf = sir.createStreamresourceFile(output_file)
-    result = data_region.write(sir)
+    return identifier_ranges
@@ -0,0 +1,608 @@
+import os
+from functools import partial
+
+import numpy as np
+
+from cmlibs.zinc.context import Context
+
+from csv_processing import find_branch_group_names, find_tracing_csv_files, find_trunk_group_name, \
+    iterate_stitched_segment_groups, process_segment_csv_files
+from dataset_files import prefetch_dataset_files
+from ex_writer import write_exf_groups_streaming, write_exf_streaming
+from fascicles import find_trunk_fascicle_files_for_segment, read_fascicle_graphs, merge_fascicle_graphs, \
+    create_fascicle_graph_buffer, write_fascicle_buffer, write_fascicle_graph_into_region
+from nerve_morphology import find_branch_morphology_files_for_segment, find_trunk_morphology_file_for_segment, \
+    map_morphology_radius, process_trunk_morphology_file_radius, read_morphology_file
+from anatomy import read_vagus_branching_pattern_spreadsheet, create_orientation_markers
+from annotations import add_trunk_annotation_terms
+from identifiers import allocate_identifier_ranges, count_segment_identifiers, write_identifier_ranges
+from level_of_detail import write_levels_of_detail
+from output import create_segment_region, write_exf, write_region_to_buffer
+from stages import run_stages
+from trunk_projection import project_markers_to_trunk, write_marker_projections
+
+
+# processing options of init.main, which documents them. Concurrency is off unless workers are requested.
+default_processing_options = {
+    'levels_of_detail': None,
+    'prefetch_workers': 0,
+    'stage_workers': 0,
+    'streaming_output': False,
+    'queue_directory': None,
+    'worker_name': None,
+    'max_attempts': 1,
+    'dtype': None,
+    'significant_digits': None,
+    'stream_segment_groups': False,
+    'remote_cache_directory': None,
+    'remote_cache_size': None,
+    'preflight': False,
+    'subject_name': None,
+    'connection_tolerance': None
+}
+
+
+def get_processing_options(options=None):
+    """
+    :param options: optional dict of processing options, a subset of default_processing_options
+    :return: new dict with all processing options, the defaults for those not in options.
+    """
+
+    processing_options = dict(default_processing_options)
+    if options:
+        unknown_names = [name for name in options.keys() if name not in default_processing_options]
+        if unknown_names:
+            raise ValueError('Unknown processing options: ' + ', '.join(sorted(unknown_names)))
+        processing_options.update(options)
+    return processing_options
+
+
+def read_anatomy_data(anatomy_file_path):
+    """
+    :param anatomy_file_path: path to the vagus branching pattern spreadsheet, or None
+    :return:
+        vagus_orientations: Dict mapping branch_name to branch_orientation label, or None.
+        vagus_branch_terms: Dict mapping branch and trunk names to annotation terms.
+    """
+
+    # read anatomy data (vagus branching pattern spreadsheet) with orientations and annotations
+    if anatomy_file_path:
+        vagus_orientations, vagus_branch_terms = read_vagus_branching_pattern_spreadsheet(anatomy_file_path)
+    else:
+        print('Warning: no anatomy file found.')
+        vagus_orientations = None
+        vagus_branch_terms = {None: None}
+
+    # add trunk annotation groups in case they aren't in vagus terms
+    vagus_branch_terms.update(add_trunk_annotation_terms())
+
+    return vagus_orientations, vagus_branch_terms
+
+
+def find_segment_vagus_terms(vagus_branch_terms, segment_csv_data):
+    """
+    :param vagus_branch_terms: Dict mapping branch and trunk names to annotation terms
+    :param segment_csv_data: tuple returned by process_segment_csv_files
+    :return: dictionary mapping trunk and branch names of the segment to annotation term.
+    """
+
+    marker_data, trunk_group_name, trunk_coordinates, branch_names, \
+        branch_coordinates_data, branch_parent_indices = segment_csv_data
+
+    # find vagus terms used for annotating the segment data
+    vagus_terms = dict()
+    if vagus_branch_terms:
+        vagus_terms[trunk_group_name] = vagus_branch_terms[trunk_group_name]
+        for branch_name in branch_coordinates_data.keys():
+            if branch_name in vagus_branch_terms.keys():
+                vagus_terms[branch_name] = vagus_branch_terms[branch_name]
+    return vagus_terms
+
+
+def find_segment_orientation_markers(vagus_orientations, segment_csv_data):
+    """
+    :param vagus_orientations: Dict mapping branch_name to branch_orientation label, or None
+    :param segment_csv_data: tuple returned by process_segment_csv_files
+    :return: dictionary mapping orientation label to list of x, y, z coordinates, or None.
+    """
+
+    # calculate orientation markers
+    orientation_markers = None
+    if vagus_orientations:
+        orientation_markers = create_orientation_markers(segment_csv_data[4], vagus_orientations)
+    return orientation_markers
+
+
+def project_segment_markers(segment_csv_data):
+    """
+    :param segment_csv_data: tuple returned by process_segment_csv_files
+    :return: Dict mapping marker name to its nearest trunk point and projection onto the trunk,
+        see project_markers_to_trunk.
+    """
+
+    marker_data, trunk_group_name, trunk_coordinates = segment_csv_data[:3]
+    return project_markers_to_trunk(marker_data, trunk_coordinates)
+
+
+def process_trunk_radius(nerve_morphology_path, segment_name, trunk_group_name, trunk_coordinates, dtype=None):
+    """
+    :param nerve_morphology_path: path to the folder with csv morphology files, or None
+    :param segment_name: name of the dataset segment (i.e. CL1)
+    :param trunk_group_name: name used for trunk group
+    :param trunk_coordinates: list of x, y, z coordinates for trunk group
+    :param dtype: optional numpy dtype, e.g. 'float32', to store radius values in a numpy array
+    :return: list of trunk radius values (empty if no morphology data), radius used for branches or None.
+    """
+
+    # find morphology file corresponding to the segment to add the radius data
+    trunk_radius = []
+    avg_branch_radius = None
+    if nerve_morphology_path:
+        morphology_file_path = find_trunk_morphology_file_for_segment(nerve_morphology_path,
+                                                                      segment_name, trunk_group_name)
+        print(segment_name, trunk_group_name, morphology_file_path)
+        if morphology_file_path:
+            trunk_radius, avg_trunk_radius = process_trunk_morphology_file_radius(morphology_file_path,
+                                                                                  trunk_coordinates, dtype)
+            avg_branch_radius = avg_trunk_radius / 2
+    return trunk_radius, avg_branch_radius
+
+
+def read_branch_morphology(nerve_morphology_path, segment_name, branch_names, dtype=None):
+    """
+    :param nerve_morphology_path: path to the folder with csv morphology files, or None
+    :param segment_name: name of the dataset segment (i.e. CL1)
+    :param branch_names: names of the branches in the segment
+    :param dtype: optional numpy dtype, e.g. 'float32', to store radius values in numpy arrays
+    :return: Dict mapping branch name to (morphology points, radius) for branches with morphology data.
+    """
+
+    branch_morphology = {}
+    if nerve_morphology_path:
+        branch_morphology_files = find_branch_morphology_files_for_segment(nerve_morphology_path, segment_name,
+                                                                           branch_names)
+        for branch_name, morphology_file_path in branch_morphology_files.items():
+            print(segment_name, branch_name, morphology_file_path)
+            branch_morphology[branch_name] = read_morphology_file(morphology_file_path, dtype)
+    return branch_morphology
+
+
+def fill_trunk_radius(trunk_radius, trunk_coordinates, dtype=None):
+    """
+    The radius field is defined for a segment if its trunk has radius, so a trunk without morphology data gets
+    zero radius when branches have radius.
+    :param trunk_radius: list of trunk radius values, empty if the trunk has no morphology data
+    :param trunk_coordinates: list of x, y, z coordinates for trunk group
+    :param dtype: optional numpy dtype, e.g. 'float32', to store radius values in a numpy array
+    :return: trunk_radius, or zero radius for each trunk point if it is empty.
+    """
+
+    if len(trunk_radius) > 0:
+        return trunk_radius
+    if dtype:
+        return np.zeros(len(trunk_coordinates), dtype=dtype)
+    return [0.0] * len(trunk_coordinates)
+
+
+def process_segment_radius(nerve_morphology_path, segment_name, segment_csv_data, dtype=None):
+    """
+    :param nerve_morphology_path: path to the folder with csv morphology files, or None
+    :param segment_name: name of the dataset segment (i.e. CL1)
+    :param segment_csv_data: tuple returned by process_segment_csv_files
+    :param dtype: optional numpy dtype, e.g. 'float32', to store radius values in a numpy array
+    :return: list of trunk radius values (empty if no group has morphology data, zero if only branches have),
+        radius used for branches without morphology data or None, Dict mapping branch name to list of radius
+        values for branches with morphology data.
+    """
+
+    trunk_radius, avg_branch_radius = process_trunk_radius(nerve_morphology_path, segment_name, segment_csv_data[1],
+                                                           segment_csv_data[2], dtype)
+    # branches are mapped to their own morphology data whether or not the trunk has any
+    branch_coordinates_data = segment_csv_data[4]
+    branch_morphology = read_branch_morphology(nerve_morphology_path, segment_name,
+                                               branch_coordinates_data.keys(), dtype)
+    branch_radius_data = map_morphology_radius(branch_coordinates_data, branch_morphology, dtype)
+    if branch_radius_data:
+        trunk_radius = fill_trunk_radius(trunk_radius, segment_csv_data[2], dtype)
+    return trunk_radius, avg_branch_radius, branch_radius_data
+
+
+def allocate_segment_identifiers(segment_csv_data, orientation_markers):
+    """
+    :param segment_csv_data: tuple returned by process_segment_csv_files
+    :param orientation_markers: dictionary mapping orientation label to list of x, y, z coordinates, or None
+    :return: dict mapping group name to (node identifier range, element identifier range).
+    """
+
+    marker_data, trunk_group_name, trunk_coordinates, branch_names, \
+        branch_coordinates_data, branch_parent_indices = segment_csv_data
+
+    # allocate node and element identifiers from the actual group sizes
+    return allocate_identifier_ranges(count_segment_identifiers(
+        trunk_group_name, trunk_coordinates, branch_names, branch_coordinates_data,
+        branch_parent_indices, orientation_markers))
+
+
+def read_segment_fascicle_graph(fascicle_path, segment_name, trunk_group_name):
+    """
+    :param fascicle_path: path to the folder with graphml fascicle files, or None
+    :param segment_name: name of the dataset segment (i.e. CL1)
+    :param trunk_group_name: name used for trunk group
+    :return: networkx graph with fascicle data from all fascicle files of the segment, or None. Its graph attribute
+        'fascicle_files' maps the node name prefix of each file to its path.
+    """
+
+    # find fascicles files corresponding to the segment, which are read and merged
+    fascicle_graph = None
+    if fascicle_path:
+        fascicle_input_paths = find_trunk_fascicle_files_for_segment(fascicle_path, segment_name, trunk_group_name)
+        print(segment_name, trunk_group_name, fascicle_input_paths)
+        fascicle_graph = merge_fascicle_graphs(read_fascicle_graphs(fascicle_input_paths),
+                                               fascicle_input_paths)
+    return fascicle_graph
+
+
+def create_segment_fascicles_buffer(fascicle_graph, identifier_ranges):
+    """
+    :param fascicle_graph: networkx graph with fascicle data, or None
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+    :return: identifier ranges including the fascicle group, EX format bytes buffer with fascicles or None.
+    """
+
+    identifier_ranges = dict(identifier_ranges)
+    fascicles_buffer = None
+    if fascicle_graph is not None:
+        fascicles_buffer = create_fascicle_graph_buffer(fascicle_graph, identifier_ranges)
+    return identifier_ranges, fascicles_buffer
+
+
+def process_segment(segment_name, segment_csv_files, vagus_orientations, vagus_branch_terms, nerve_morphology_path,
+                    fascicle_path, stitching_tolerance, file_buffers=None, executor=None, dtype=None):
+    """
+    Run the processing pipeline for one segment without writing any files.
+    Fascicle files are found and parsed from the trunk name in the csv file names, so they are read at the same
+    time as the csv files are processed and stitched if an executor is supplied.
+    :param segment_name: name of the dataset segment (i.e. CL1)
+    :param segment_csv_files: list with paths to csv files of the segment
+    :param vagus_orientations: Dict mapping branch_name to branch_orientation label, or None
+    :param vagus_branch_terms: Dict mapping branch and trunk names to annotation terms
+    :param nerve_morphology_path: path to the folder with csv morphology files, or None
+    :param fascicle_path: path to the folder with graphml fascicle files, or None
+    :param stitching_tolerance: tolerance used for branch stitching
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes
+    :param executor: optional concurrent.futures executor to run independent stages concurrently
+    :param dtype: optional numpy dtype, e.g. 'float32', for working storage of coordinates and radius.
+        Coordinates and radius are then numpy arrays instead of lists.
+    :return: Dict with segment result:
+        segment_name: name of the dataset segment.
+        marker_data: dict mapping marker names to marker coordinates.
+        trunk_group_name: name used for trunk group.
+        trunk_coordinates: list with x, y, z trunk coordinates.
+        trunk_radius: list of radius values for trunk coordinates, empty if no morphology data.
+        branch_names: list with names of the branches, sorted from first level to second level, etc.
+        branch_coordinates_data: dictionary mapping branch name to list with x, y, z branch coordinates.
+        branch_parent_indices: dictionary mapping branch name to
+            (parent branch name, index of parent coordinate where branch links to the parent).
+        avg_branch_radius: radius used for branches without morphology data, or None.
+        branch_radius_data: dictionary mapping branch name to list of radius values for branch coordinates,
+            for branches with morphology data.
+        orientation_markers: dictionary mapping orientation label to list of x, y, z coordinates, or None.
+        vagus_terms: dictionary mapping trunk and branch names to annotation term.
+        marker_projections: dictionary mapping marker name to (index of nearest trunk point, index of trunk
+            element the marker projects onto, xi on that element, arc length along the trunk, projected x, y, z).
+        identifier_ranges: dict mapping group name to (node identifier range, element identifier range).
+        fascicle_graph: networkx graph with fascicle data, or None.
+        fascicles_buffer: EX format bytes buffer with fascicle nodes and elements, or None.
+    """
+
+    stages = {
+        'csv': (partial(process_segment_csv_files, segment_csv_files, stitching_tolerance, file_buffers, dtype), []),
+        'fascicle graph': (partial(read_segment_fascicle_graph, fascicle_path, segment_name,
+                                   find_trunk_group_name(segment_csv_files)), []),
+        'terms': (partial(find_segment_vagus_terms, vagus_branch_terms), ['csv']),
+        'orientation': (partial(find_segment_orientation_markers, vagus_orientations), ['csv']),
+        'marker projections': (project_segment_markers, ['csv']),
+        'radius': (partial(process_segment_radius, nerve_morphology_path, segment_name, dtype=dtype), ['csv']),
+        'identifiers': (allocate_segment_identifiers, ['csv', 'orientation']),
+        'fascicles': (create_segment_fascicles_buffer, ['fascicle graph', 'identifiers'])
+    }
+    results = run_stages(stages, executor)
+
+    marker_data, trunk_group_name, trunk_coordinates, branch_names, \
+        branch_coordinates_data, branch_parent_indices = results['csv']
+    trunk_radius, avg_branch_radius, branch_radius_data = results['radius']
+    identifier_ranges, fascicles_buffer = results['fascicles']
+
+    return {
+        'segment_name': segment_name,
+        'marker_data': marker_data,
+        'trunk_group_name': trunk_group_name,
+        'trunk_coordinates': trunk_coordinates,
+        'trunk_radius': trunk_radius,
+        'branch_names': branch_names,
+        'branch_coordinates_data': branch_coordinates_data,
+        'branch_parent_indices': branch_parent_indices,
+        'avg_branch_radius': avg_branch_radius,
+        'branch_radius_data': branch_radius_data,
+        'orientation_markers': results['orientation'],
+        'vagus_terms': results['terms'],
+        'marker_projections': results['marker projections'],
+        'identifier_ranges': identifier_ranges,
+        'fascicle_graph': results['fascicle graph'],
+        'fascicles_buffer': fascicles_buffer
+    }
+
+
+def process_dataset(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path, stitching_tolerance,
+                    options=None, executor=None):
+    """
+    Run the processing pipeline for all segments without writing any files.
+    See init.main for parameters.
+    :param options: optional dict of processing options, see init.main. Uses prefetch_workers, the maximum number
+        of csv files read concurrently: all csv files of a segment and of the next segment are read ahead into
+        memory. If 0, files are read one after another while parsing. Uses dtype for working storage.
+    :param executor: optional concurrent.futures executor to run independent segment stages concurrently
+    :return: generator of segment result dicts (see process_segment), one segment at a time.
+    """
+
+    options = get_processing_options(options)
+    vagus_orientations, vagus_branch_terms = read_anatomy_data(anatomy_file_path)
+
+    # read micro ct data
+    segment_files = find_tracing_csv_files(microct_path)
+    if len(segment_files) > 0:
+        segment_names = list(segment_files.keys())
+        segment_file_buffers = prefetch_dataset_files([segment_files[segment_name] for segment_name in segment_names],
+                                                      options['prefetch_workers'])
+        for segment_name, file_buffers in zip(segment_names, segment_file_buffers):
+            print(segment_name)
+            segment_csv_files = segment_files[segment_name]
+            if len(segment_csv_files) > 0:
+                yield process_segment(segment_name, segment_csv_files, vagus_orientations, vagus_branch_terms,
+                                      nerve_morphology_path, fascicle_path, stitching_tolerance, file_buffers,
+                                      executor, options['dtype'])
+            else:
+                print('Warning: no microct files found for segment', segment_name)
+    else:
+        print('Warning: no microct files found.')
+
+
+def create_segment_result_region(segment_result, region):
+    """
+    :param segment_result: segment result dict from process_segment
+    :param region: empty Zinc region to add the segment nodes, elements, groups and markers to
+    """
+
+    create_segment_region(region, segment_result['marker_data'], segment_result['trunk_group_name'],
+                          segment_result['trunk_coordinates'], segment_result['trunk_radius'],
+                          segment_result['branch_names'], segment_result['branch_coordinates_data'],
+                          segment_result['branch_parent_indices'], segment_result['avg_branch_radius'],
+                          segment_result['orientation_markers'], segment_result['vagus_terms'],
+                          segment_result['fascicles_buffer'], segment_result['identifier_ranges'],
+                          segment_result['branch_radius_data'])
+
+
+def segment_result_to_buffer(segment_result):
+    """
+    :param segment_result: segment result dict from process_segment
+    :return: bytes buffer with the segment in EX format, identical to the <segment>.exf output file.
+    """
+
+    context = Context("data_region")
+    data_region = context.getDefaultRegion()
+    create_segment_result_region(segment_result, data_region)
+    return write_region_to_buffer(data_region)
+
+
+def write_segment_result(segment_result, output_directory, levels_of_detail=None, streaming_output=False,
+                         significant_digits=None):
+    """
+    Write segment result to <segment>.exf, with fascicles, identifier ranges, marker projections and level of
+    detail files.
+    :param segment_result: segment result dict from process_segment
+    :param output_directory: path to the folder where to save the output results
+    :param levels_of_detail: optional list of node density reduction factors, e.g. [4, 16]
+    :param streaming_output: if True, write <segment>.exf with the streaming EX writer instead of building
+        a Zinc region, for segments with millions of nodes
+    :param significant_digits: optional number of significant digits for real values, e.g. 8 for float32 data,
+        also used for the fascicles file. Uses the streaming EX writer, as Zinc always writes full double precision.
+    :return: list of output file paths.
+    """
+
+    segment_name = segment_result['segment_name']
+    if significant_digits and (segment_result['fascicle_graph'] is not None):
+        write_fascicle_graph_into_region(segment_result['fascicle_graph'], segment_name, output_directory,
+                                         dict(segment_result['identifier_ranges']),
+                                         significant_digits=significant_digits)
+    elif segment_result['fascicles_buffer']:
+        write_fascicle_buffer(segment_result['fascicles_buffer'], segment_name, output_directory)
+
+    # write output file
+    output_filename = segment_name + ".exf"
+    output_file = os.path.join(output_directory, output_filename)
+    output_files = [output_file]
+    if significant_digits:
+        streaming_output = True
+    if streaming_output:
+        write_exf_streaming(output_file, segment_result['marker_data'], segment_result['trunk_group_name'],
+                            segment_result['trunk_coordinates'], segment_result['trunk_radius'],
+                            segment_result['branch_names'], segment_result['branch_coordinates_data'],
+                            segment_result['branch_parent_indices'], segment_result['avg_branch_radius'],
+                            segment_result['orientation_markers'], segment_result['vagus_terms'],
+                            segment_result['fascicle_graph'], segment_result['identifier_ranges'],
+                            significant_digits=significant_digits,
+                            branch_radius_data=segment_result['branch_radius_data'])
+    else:
+        write_exf(output_file, segment_result['marker_data'], segment_result['trunk_group_name'],
+                  segment_result['trunk_coordinates'], segment_result['trunk_radius'], segment_result['branch_names'],
+                  segment_result['branch_coordinates_data'], segment_result['branch_parent_indices'],
+                  segment_result['avg_branch_radius'], segment_result['orientation_markers'],
+                  segment_result['vagus_terms'], segment_result['fascicles_buffer'], segment_result['identifier_ranges'],
+                  segment_result['branch_radius_data'])
+
+    # save identifier ranges so node and element identifiers can be mapped back to their group
+    write_identifier_ranges(os.path.join(output_directory, segment_name + "-identifiers.csv"),
+                            segment_result['identifier_ranges'])
+
+    # save nearest trunk node and trunk position of markers so they are not searched for again
+    if segment_result['marker_projections']:
+        write_marker_projections(os.path.join(output_directory, segment_name + "-marker-projections.csv"),
+                                 segment_result['marker_projections'],
+                                 segment_result['identifier_ranges'][segment_result['trunk_group_name']])
+
+    # write reduced node density versions for fast overview loading
+    if levels_of_detail:
+        output_files.extend(write_levels_of_detail(
+            output_directory, segment_name, levels_of_detail, segment_result['marker_data'],
+            segment_result['trunk_group_name'], segment_result['trunk_coordinates'], segment_result['trunk_radius'],
+            segment_result['branch_names'], segment_result['branch_coordinates_data'],
+            segment_result['branch_parent_indices'], segment_result['avg_branch_radius'],
+            segment_result['orientation_markers'], segment_result['vagus_terms'], segment_result['fascicle_graph'],
+            streaming_output, significant_digits, segment_result['branch_radius_data']))
+
+    return output_files
+
+
+def write_segment_results(segment_results, output_directory, levels_of_detail=None, executor=None,
+                          streaming_output=False, significant_digits=None):
+    """
+    Write segment results as they are produced.
+    :param segment_results: iterable of segment result dicts, e.g. generator from process_dataset
+    :param output_directory: path to the folder where to save the output results
+    :param levels_of_detail: optional list of node density reduction factors, e.g. [4, 16]
+    :param executor: optional concurrent.futures executor. If supplied, each segment is written while the next
+        segment is processed, with at most one segment waiting to be written.
+    :param streaming_output: if True, write segments with the streaming EX writer
+    :param significant_digits: optional number of significant digits for real values
+    :return: list of output file paths.
+    """
+
+    output_files = []
+    pending_write = None
+    for segment_result in segment_results:
+        if executor is None:
+            output_files.extend(write_segment_result(segment_result, output_directory, levels_of_detail,
+                                                     streaming_output, significant_digits))
+            continue
+        if pending_write is not None:
+            output_files.extend(pending_write.result())
+        pending_write = executor.submit(write_segment_result, segment_result, output_directory, levels_of_detail,
+                                        streaming_output, significant_digits)
+
+    if pending_write is not None:
+        output_files.extend(pending_write.result())
+
+    return output_files
+
+
+def write_segment_streaming(segment_name, segment_csv_files, vagus_orientations, vagus_branch_terms,
+                            nerve_morphology_path, fascicle_path, stitching_tolerance, output_directory,
+                            file_buffers=None, dtype=None, significant_digits=None):
+    """
+    Process and write one segment group at a time: each group is read, stitched and written to <segment>.exf as
+    soon as its data and its parent's data are available, then released. Peak memory follows the largest groups
+    rather than the whole segment. Output files are the same as from process_segment and write_segment_result
+    with streaming_output, except that levels of detail are not supported.
+    See process_segment and write_segment_result for parameters.
+    :return: list of output file paths.
+    """
+
+    trunk_group_name = find_trunk_group_name(segment_csv_files)
+    fascicle_graph = read_segment_fascicle_graph(fascicle_path, segment_name, trunk_group_name)
+
+    # filled with morphology data of branches once the trunk has radius
+    branch_morphology = {}
+    # filled as groups are written, used by the writer for the annotation groups at the end
+    vagus_terms = dict()
+    # only the first point of each branch is needed for orientation markers
+    branch_first_points = {}
+    # markers and trunk are kept until both are read, to project the markers onto the trunk
+    marker_trunk_data = {}
+    marker_projections = {}
+
+    def segment_groups():
+        for group_type, group_name, group_data in iterate_stitched_segment_groups(
+                segment_csv_files, stitching_tolerance, file_buffers, dtype):
+            if group_type in ['marker', 'trunk']:
+                marker_trunk_data[group_type] = group_data
+                if len(marker_trunk_data) == 2:
+                    marker_projections.update(project_markers_to_trunk(marker_trunk_data['marker'],
+                                                                       marker_trunk_data['trunk']))
+                    marker_trunk_data.clear()
+            if group_type == 'trunk':
+                if vagus_branch_terms:
+                    vagus_terms[group_name] = vagus_branch_terms[group_name]
+                trunk_radius, avg_branch_radius = process_trunk_radius(nerve_morphology_path, segment_name,
+                                                                       group_name, group_data, dtype)
+                # branch names are known from the csv file names before any branch is read
+                branch_morphology.update(read_branch_morphology(nerve_morphology_path, segment_name,
+                                                                find_branch_group_names(segment_csv_files), dtype))
+                if any(len(morphology_points) > 0 for morphology_points, _ in branch_morphology.values()):
+                    trunk_radius = fill_trunk_radius(trunk_radius, group_data, dtype)
+                group_data = (group_data, trunk_radius, avg_branch_radius)
+            elif group_type == 'branch':
+                if vagus_branch_terms and group_name in vagus_branch_terms.keys():
+                    vagus_terms[group_name] = vagus_branch_terms[group_name]
+                branch_first_points[group_name] = group_data[0][:1]
+                if group_name in branch_morphology:
+                    branch_radius = map_morphology_radius({group_name: group_data[0]},
+                                                          {group_name: branch_morphology.pop(group_name)}, dtype)
+                    group_data = group_data + (branch_radius[group_name],)
+            yield group_type, group_name, group_data
+        if vagus_orientations:
+            yield 'orientation', None, create_orientation_markers(branch_first_points, vagus_orientations)
+
+    output_file = os.path.join(output_directory, segment_name + ".exf")
+    identifier_ranges = write_exf_groups_streaming(output_file, segment_groups(), vagus_terms, fascicle_graph,
+                                                   significant_digits=significant_digits)
+
+    if fascicle_graph is not None:
+        segment_identifier_ranges = {group_name: ranges for group_name, ranges in identifier_ranges.items()
+                                     if group_name != 'fascicle'}
+        write_fascicle_graph_into_region(fascicle_graph, segment_name, output_directory, segment_identifier_ranges,
+                                         significant_digits=significant_digits)
+
+    # save identifier ranges so node and element identifiers can be mapped back to their group
+    write_identifier_ranges(os.path.join(output_directory, segment_name + "-identifiers.csv"), identifier_ranges)
+
+    if marker_projections:
+        write_marker_projections(os.path.join(output_directory, segment_name + "-marker-projections.csv"),
+                                 marker_projections, identifier_ranges[trunk_group_name])
+
+    return [output_file]
+
+
+def write_dataset_streaming(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path,
+                            stitching_tolerance, output_directory, options=None):
+    """
+    Process and write all segments with write_segment_streaming.
+    See init.main and process_dataset for parameters. Uses the prefetch_workers, dtype and significant_digits
+    options. Prefetching reads all csv files of the next segment into memory, which defeats the bounded memory
+    use of streaming.
+    :return: list of output file paths.
+    """
+
+    options = get_processing_options(options)
+
+    vagus_orientations, vagus_branch_terms = read_anatomy_data(anatomy_file_path)
+
+    output_files = []
+    segment_files = find_tracing_csv_files(microct_path)
+    if len(segment_files) > 0:
+        segment_names = list(segment_files.keys())
+        segment_file_buffers = prefetch_dataset_files([segment_files[segment_name] for segment_name in segment_names],
+                                                      options['prefetch_workers'])
+        for segment_name, file_buffers in zip(segment_names, segment_file_buffers):
+            print(segment_name)
+            segment_csv_files = segment_files[segment_name]
+            if len(segment_csv_files) > 0:
+                output_files.extend(write_segment_streaming(
+                    segment_name, segment_csv_files, vagus_orientations, vagus_branch_terms, nerve_morphology_path,
+                    fascicle_path, stitching_tolerance, output_directory, file_buffers, options['dtype'],
+                    options['significant_digits']))
+            else:
+                print('Warning: no microct files found for segment', segment_name)
+    else:
+        print('Warning: no microct files found.')
+
+    return output_files
@@ -0,0 +1,361 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+import uuid
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import quote, urlsplit
+
+
+remote_schemes = ('http://', 'https://')
+# name of the JSON file listing the files of a remote dataset folder, with their size and sha256 digest:
+# {"files": [{"path": "MicroCT/sam-SR042-CL1/...csv", "size": 1234, "sha256": "..."}, ...]}
+remote_index_name = 'index.json'
+
+_remote_settings = {
+    'cache_directory': os.path.join(tempfile.gettempdir(), 'vagus-remote-cache'),
+    # total size of cached files in bytes, least recently used files are removed above it
+    'max_cache_size': 10 * 1024 ** 3,
+    # files larger than this are fetched in parts of this size with parallel range requests
+    'range_size': 8 * 1024 ** 2,
+    'range_workers': 4,
+    'max_idle_connections': 16,
+    'timeout': 60.0,
+    # seconds after which a temporary file still being written to the cache is left over from a stopped process
+    'temporary_file_timeout': 3600.0
+}
+
+# idle keep-alive connections for each (scheme, host), reused by all threads
+_idle_connections = {}
+_connection_lock = threading.Lock()
+_cache_lock = threading.Lock()
+# total size of cached files as last counted plus files added since, None until first counted
+_cache_state = {'size': None}
+# URLs of folders with an index found so far
+_remote_index_roots = set()
+_index_lock = threading.Lock()
+
+
+def configure_remote_dataset(cache_directory=None, max_cache_size=None, range_size=None, range_workers=None):
+    """
+    Set options for reading remote datasets. Options which are None are left unchanged.
+    :param cache_directory: folder of the local cache of fetched files
+    :param max_cache_size: total size of cached files in bytes, least recently used files are removed above it
+    :param range_size: files larger than this are fetched in parts of this many bytes with parallel range requests
+    :param range_workers: maximum number of range requests for one file at the same time
+    """
+
+    for name, value in [('cache_directory', cache_directory), ('max_cache_size', max_cache_size),
+                        ('range_size', range_size), ('range_workers', range_workers)]:
+        if value is not None:
+            _remote_settings[name] = value
+    if cache_directory is not None:
+        _cache_state['size'] = None
+
+
+def is_remote_path(path):
+    """
+    :param path: path or URL of a dataset folder or file
+    :return: True if the path is an http or https URL.
+    """
+
+    return isinstance(path, str) and path.lower().startswith(remote_schemes)
+
+
+def normalise_remote_path(url):
+    """
+    :param url: URL of a remote dataset folder or file, possibly built with os.path.join
+    :return: URL with forward slashes only and without trailing slash.
+    """
+
+    return url.replace('\\', '/').rstrip('/')
+
+
+def _acquire_connection(scheme, netloc):
+    with _connection_lock:
+        connections = _idle_connections.get((scheme, netloc))
+        if connections:
+            return connections.pop()
+    connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+    return connection_class(netloc, timeout=_remote_settings['timeout'])
+
+
+def _release_connection(scheme, netloc, connection):
+    with _connection_lock:
+        connections = _idle_connections.setdefault((scheme, netloc), [])
+        if len(connections) < _remote_settings['max_idle_connections']:
+            connections.append(connection)
+            return
+    connection.close()
+
+
+def close_remote_connections():
+    """
+    Close all idle pooled connections.
+    """
+
+    with _connection_lock:
+        for connections in _idle_connections.values():
+            for connection in connections:
+                connection.close()
+        _idle_connections.clear()
+
+
+def request_remote(url, headers=None):
+    """
+    GET a URL through a pooled keep-alive connection.
+    :param url: http or https URL, with its path not percent-encoded, e.g. with spaces in file names
+    :param headers: optional Dict of request headers, e.g. Range
+    :return: HTTP status code, response body bytes.
+    """
+
+    parts = urlsplit(url)
+    target = '/'.join(quote(name) for name in parts.path.split('/')) + ('?' + parts.query if parts.query else '')
+    # a pooled connection may have been closed by the server, so retry once on a new connection
+    for attempt in range(2):
+        connection = _acquire_connection(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', target, headers=headers or {})
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if attempt == 1:
+                raise
+            continue
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            _release_connection(parts.scheme, parts.netloc, connection)
+        return response.status, body
+
+
+@lru_cache(maxsize=None)
+def _read_remote_index_file(index_url):
+    status, body = request_remote(index_url)
+    if status == 404:
+        return None
+    if status != 200:
+        raise OSError('HTTP ' + str(status) + ' reading remote dataset index ' + index_url)
+    return {entry['path']: (entry['size'], entry['sha256']) for entry in json.loads(body)['files']}
+
+
+def find_remote_index(url):
+    """
+    Find the index of the remote dataset containing url, in its folder or the nearest parent folder.
+    Indexes already found are used without further requests for all URLs inside their folder.
+    :param url: URL of a remote dataset folder or file
+    :return: URL of the folder containing the index, Dict mapping file path relative to it to (size, sha256),
+        or None, None if there is no index.
+    """
+
+    url = normalise_remote_path(url)
+    with _index_lock:
+        known_root_urls = sorted(_remote_index_roots, key=len, reverse=True)
+    for root_url in known_root_urls:
+        if url == root_url or url.startswith(root_url + '/'):
+            return root_url, _read_remote_index_file(root_url + '/' + remote_index_name)
+
+    parts = urlsplit(url)
+    folder_names = [name for name in parts.path.split('/') if name]
+    for count in range(len(folder_names), -1, -1):
+        root_url = parts.scheme + '://' + parts.netloc + ''.join('/' + name for name in folder_names[:count])
+        files = _read_remote_index_file(root_url + '/' + remote_index_name)
+        if files is not None:
+            with _index_lock:
+                _remote_index_roots.add(root_url)
+            return root_url, files
+    return None, None
+
+
+def split_remote_path(url):
+    """
+    :param url: URL of a remote dataset folder or file
+    :return: URL of the folder containing the index, path of url relative to it ('' for the index folder),
+        Dict mapping file path to (size, sha256). None, url, None if there is no index.
+    """
+
+    url = normalise_remote_path(url)
+    root_url, files = find_remote_index(url)
+    if root_url is None:
+        return None, url, None
+    return root_url, url[len(root_url):].lstrip('/'), files
+
+
+def _get_cache_file(sha256):
+    return os.path.join(_remote_settings['cache_directory'], sha256[:2], sha256)
+
+
+def read_cached_file(sha256):
+    """
+    :param sha256: hex sha256 digest of the file contents
+    :return: bytes of the cached file, or None if not cached.
+    """
+
+    cache_file = _get_cache_file(sha256)
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+        # modification time records the last use for least recently used eviction
+        os.utime(cache_file)
+    except FileNotFoundError:
+        return None
+    return data
+
+
+def evict_cached_files(max_cache_size):
+    """
+    Remove least recently used files from the cache until their total size is at most max_cache_size.
+    Temporary files may be written by other processes sharing the cache, so they are neither counted nor evicted,
+    and only removed once they are older than the temporary file timeout.
+    :return: total size of the remaining cached files.
+    """
+
+    cache_directory = _remote_settings['cache_directory']
+    stale_time = time.time() - _remote_settings['temporary_file_timeout']
+    cached_files = []
+    for rootpath, dirs, files in os.walk(cache_directory):
+        for f in files:
+            cache_file = os.path.join(rootpath, f)
+            try:
+                stat = os.stat(cache_file)
+                if f.endswith('.tmp'):
+                    if stat.st_mtime < stale_time:
+                        os.remove(cache_file)
+                    continue
+            except FileNotFoundError:
+                continue
+            cached_files.append((stat.st_mtime, stat.st_size, cache_file))
+
+    total_size = sum(size for _, size, _ in cached_files)
+    for _, size, cache_file in sorted(cached_files):
+        if total_size <= max_cache_size:
+            break
+        try:
+            os.remove(cache_file)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+    return total_size
+
+
+def write_cached_file(sha256, data):
+    """
+    Add file contents to the cache under their sha256 digest, then evict least recently used files.
+    """
+
+    cache_file = _get_cache_file(sha256)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # other processes sharing the cache never see partially written files
+    temporary_file = cache_file + '.' + uuid.uuid4().hex + '.tmp'
+    with open(temporary_file, 'wb') as f:
+        f.write(data)
+    os.replace(temporary_file, cache_file)
+    with _cache_lock:
+        # the cache folder is only scanned when it may have grown too large, not for every added file
+        if _cache_state['size'] is None:
+            _cache_state['size'] = evict_cached_files(_remote_settings['max_cache_size'])
+        else:
+            _cache_state['size'] += len(data)
+            if _cache_state['size'] > _remote_settings['max_cache_size']:
+                _cache_state['size'] = evict_cached_files(_remote_settings['max_cache_size'])
+
+
+def _fetch_remote_range(url, start, stop):
+    """
+    :return: HTTP status, body: 206 with bytes start to stop, or 200 with the whole file if the server does not
+        support range requests.
+    """
+
+    status, body = request_remote(url, {'Range': 'bytes=' + str(start) + '-' + str(stop - 1)})
+    if status == 404:
+        raise FileNotFoundError(url)
+    if status not in [200, 206]:
+        raise OSError('HTTP ' + str(status) + ' reading ' + url)
+    return status, body
+
+
+def _fetch_remote_range_bytes(url, start, stop):
+    status, body = _fetch_remote_range(url, start, stop)
+    return body[start:stop] if status == 200 else body
+
+
+def fetch_remote_file(url, size, sha256=None):
+    """
+    Fetch a remote file, in parts with parallel range requests if it is larger than the range size.
+    :param url: URL of the file
+    :param size: size of the file in bytes
+    :param sha256: optional hex sha256 digest the file contents are checked against
+    :return: file bytes.
+    """
+
+    range_size = _remote_settings['range_size']
+    if size <= range_size:
+        status, data = request_remote(url)
+        if status == 404:
+            raise FileNotFoundError(url)
+        if status != 200:
+            raise OSError('HTTP ' + str(status) + ' reading ' + url)
+    else:
+        # the first part shows whether the server supports range requests, otherwise it sent the whole file
+        status, data = _fetch_remote_range(url, 0, range_size)
+        if status == 206:
+            starts = range(range_size, size, range_size)
+            with ThreadPoolExecutor(max_workers=_remote_settings['range_workers']) as executor:
+                parts = executor.map(
+                    lambda start: _fetch_remote_range_bytes(url, start, min(start + range_size, size)), starts)
+                data = b''.join([data] + list(parts))
+
+    if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError('Remote file ' + url + ' does not match its sha256 digest in the dataset index')
+    return data
+
+
+def read_remote_file_bytes(url):
+    """
+    Read a file listed in a remote dataset index, from the local cache if it was fetched before.
+    :param url: URL of the file
+    :return: raw file bytes.
+    """
+
+    root_url, file_path, files = split_remote_path(url)
+    if files is None or file_path not in files:
+        raise FileNotFoundError(url)
+    size, sha256 = files[file_path]
+    data = read_cached_file(sha256)
+    if data is None:
+        data = fetch_remote_file(root_url + '/' + file_path, size, sha256)
+        write_cached_file(sha256, data)
+    return data
+
+
+def write_remote_index(dataset_path):
+    """
+    Write the index file listing all files in a local dataset folder, to serve the folder as a remote dataset.
+    :param dataset_path: path to the local dataset folder
+    :return: path to the index file.
+    """
+
+    files = []
+    for rootpath, dirs, file_names in os.walk(dataset_path):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(rootpath, file_name)
+            relative_path = os.path.relpath(file_path, dataset_path).replace(os.sep, '/')
+            if relative_path == remote_index_name:
+                continue
+            with open(file_path, 'rb') as f:
+                sha256 = hashlib.sha256(f.read()).hexdigest()
+            files.append({'path': relative_path, 'size': os.path.getsize(file_path), 'sha256': sha256})
+
+    index_file = os.path.join(dataset_path, remote_index_name)
+    with open(index_file, 'w') as f:
+        json.dump({'files': files}, f, indent=1)
+    return index_file
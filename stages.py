@@ -0,0 +1,41 @@
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+def run_stages(stages, executor=None):
+    """
+    Run processing stages as soon as the stages they depend on have finished, so independent stages run
+    concurrently.
+    :param stages: Dict mapping stage name to (function, list of names of stages it depends on). The function is
+        called with the results of its dependency stages as arguments, in the listed order.
+    :param executor: optional concurrent.futures executor used to run the stages. A ProcessPoolExecutor needs
+        picklable functions (e.g. functools.partial of module functions) and results.
+        If None, stages run one after another in dependency order.
+    :return: Dict mapping stage name to stage result.
+    """
+
+    results = {}
+    pending_stages = dict(stages)
+    running_stages = {}
+    while pending_stages or running_stages:
+        ready_stage_names = [stage_name for stage_name, (function, dependencies) in pending_stages.items()
+                             if all(dependency in results for dependency in dependencies)]
+        for stage_name in ready_stage_names:
+            function, dependencies = pending_stages.pop(stage_name)
+            arguments = [results[dependency] for dependency in dependencies]
+            if executor is None:
+                results[stage_name] = function(*arguments)
+            else:
+                running_stages[executor.submit(function, *arguments)] = stage_name
+
+        if executor is None:
+            if not ready_stage_names and pending_stages:
+                raise ValueError('Stages have missing or cyclic dependencies: ' + ', '.join(pending_stages.keys()))
+            continue
+
+        if not running_stages:
+            raise ValueError('Stages have missing or cyclic dependencies: ' + ', '.join(pending_stages.keys()))
+        finished, _ = wait(running_stages, return_when=FIRST_COMPLETED)
+        for future in finished:
+            results[running_stages.pop(future)] = future.result()
+
+    return results
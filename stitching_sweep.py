@@ -0,0 +1,206 @@
+import os
+import csv
+import glob
+import argparse
+import hashlib
+
+from csv_processing import find_branch_parent, find_closest_parent_point, find_tracing_csv_files, \
+    read_segment_csv_files, sort_branch_names
+from dataset_files import dataset_file_signature, prefetch_dataset_files
+
+
+def compute_segment_stitching_table(csv_files, file_buffers=None):
+    """
+    Compute closest parent distances for every branch of a segment once, so that any stitching tolerance can be
+    evaluated later without re-reading or re-searching the data.
+    Stitching a branch removes its first point and may reverse it, which changes the closest point search for its
+    child branches, so branches with a branch parent get one row for each possible parent state.
+    :param csv_files: List with paths to csv files.
+    :param file_buffers: optional Dict mapping csv file path to prefetched raw file bytes.
+    :return: List of rows in branch processing order:
+        (branch name, parent name, parent state, min_dsq, closest parent index, branch reversed)
+        where parent state is '' for the trunk, otherwise 'unstitched', 'stitched' or 'stitched reversed'.
+    """
+
+    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
+    marker_data, trunk_group_name, trunk_coordinates, branch_coordinates_data = \
+        read_segment_csv_files(csv_files, file_buffers)
+
+    stitching_table = []
+    for branch_name in sort_branch_names(branch_coordinates_data.keys()):
+        branch_coordinates = branch_coordinates_data[branch_name]
+        branch_start_point = branch_coordinates[1]
+        branch_end_point = branch_coordinates[-1]
+
+        parent_name, parent_coordinates = find_branch_parent(branch_name, side_label, trunk_group_name,
+                                                             trunk_coordinates, branch_coordinates_data)
+        if parent_name == trunk_group_name:
+            parent_states = [('', parent_coordinates)]
+        else:
+            parent_states = [('unstitched', parent_coordinates)]
+            # reversal of the parent can depend on its own parent state, so add all that were found
+            parent_reversals = {row[5] for row in stitching_table if row[0] == parent_name}
+            if False in parent_reversals:
+                parent_states.append(('stitched', parent_coordinates[1:]))
+            if True in parent_reversals:
+                parent_states.append(('stitched reversed', parent_coordinates[1:][::-1]))
+
+        for parent_state, coordinates in parent_states:
+            min_dsq, closest_branch_point, closest_parent_index = find_closest_parent_point(
+                branch_start_point, branch_end_point, coordinates)
+            branch_reversed = closest_branch_point is not None and \
+                tuple(closest_branch_point) == tuple(branch_end_point)
+            stitching_table.append((branch_name, parent_name, parent_state, min_dsq, closest_parent_index,
+                                    branch_reversed))
+
+    return stitching_table
+
+
+def evaluate_stitching_table(stitching_table, stitching_tolerance):
+    """
+    :param stitching_table: list of rows from compute_segment_stitching_table
+    :param stitching_tolerance: tolerance used for branch stitching
+    :return: Dict mapping branch name to (parent branch name, index of parent coordinate where branch links to
+        the parent), or (None, None) for branches too far away to be stitched. Same as process_segment_csv_files.
+    """
+
+    branch_parent_indices = {}
+    branch_states = {}
+    for branch_name, parent_name, parent_state, min_dsq, closest_parent_index, branch_reversed in stitching_table:
+        # only use the row matching the state of the parent branch when this branch is processed
+        if parent_state and parent_state != branch_states.get(parent_name, 'unstitched'):
+            continue
+        if min_dsq < stitching_tolerance:
+            branch_parent_indices[branch_name] = (parent_name, closest_parent_index)
+            branch_states[branch_name] = 'stitched reversed' if branch_reversed else 'stitched'
+        else:
+            branch_parent_indices[branch_name] = (None, None)
+            branch_states[branch_name] = 'unstitched'
+
+    return branch_parent_indices
+
+
+def write_stitching_table(output_file, stitching_table):
+    """
+    :param output_file: location of the csv file with stitching distances
+    :param stitching_table: list of rows from compute_segment_stitching_table
+    """
+
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(['branch', 'parent', 'parent state', 'min dsq', 'closest parent index', 'reversed'])
+        for branch_name, parent_name, parent_state, min_dsq, closest_parent_index, branch_reversed \
+                in stitching_table:
+            writer.writerow([branch_name, parent_name, parent_state, repr(min_dsq),
+                             '' if closest_parent_index is None else closest_parent_index, int(branch_reversed)])
+
+
+def read_stitching_table(stitching_file):
+    """
+    :param stitching_file: location of the csv file written by write_stitching_table
+    :return: list of rows, see compute_segment_stitching_table.
+    """
+
+    stitching_table = []
+    with open(stitching_file, 'r') as csvfile:
+        plots = csv.reader(csvfile, delimiter=',')
+        next(plots, None)  # skip headers
+        for row in plots:
+            stitching_table.append((row[0], row[1], row[2], float(row[3]), None if row[4] == '' else int(row[4]),
+                                    bool(int(row[5]))))
+    return stitching_table
+
+
+def get_stitching_cache_key(csv_files):
+    """
+    :param csv_files: List with paths to csv files of a segment.
+    :return: hex digest of the paths and signatures of the csv files, which changes when any of them changes.
+    """
+
+    digest = hashlib.sha256()
+    for csv_file in sorted(csv_files):
+        digest.update((csv_file + '\n' + dataset_file_signature(csv_file) + '\n').encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def load_stitching_tables(microct_path, cache_directory, prefetch_workers=8):
+    """
+    :param microct_path: path to the folder with csv segmentation files
+    :param cache_directory: folder with <segment>-stitching-<key>.csv files, where key is from the sizes and
+        modification times of the segment csv files. Missing or outdated tables are computed and saved there.
+    :param prefetch_workers: maximum number of csv files read concurrently
+    :return: Dict mapping segment name to stitching table.
+    """
+
+    stitching_tables = {}
+    segment_files = find_tracing_csv_files(microct_path)
+    stitching_files = {segment_name: os.path.join(cache_directory, segment_name + '-stitching-' +
+                                                  get_stitching_cache_key(csv_files) + '.csv')
+                       for segment_name, csv_files in segment_files.items()}
+    missing_segment_names = []
+    for segment_name in segment_files.keys():
+        stitching_file = stitching_files[segment_name]
+        if os.path.isfile(stitching_file):
+            stitching_tables[segment_name] = read_stitching_table(stitching_file)
+        else:
+            missing_segment_names.append(segment_name)
+
+    segment_file_buffers = prefetch_dataset_files(
+        [segment_files[segment_name] for segment_name in missing_segment_names], prefetch_workers)
+    for segment_name, file_buffers in zip(missing_segment_names, segment_file_buffers):
+        print(segment_name)
+        stitching_table = compute_segment_stitching_table(segment_files[segment_name], file_buffers)
+        # remove tables of earlier versions of the segment files
+        for outdated_file in glob.glob(os.path.join(glob.escape(cache_directory),
+                                                    glob.escape(segment_name) + '-stitching-*.csv')):
+            os.remove(outdated_file)
+        write_stitching_table(stitching_files[segment_name], stitching_table)
+        stitching_tables[segment_name] = stitching_table
+
+    return {segment_name: stitching_tables[segment_name] for segment_name in segment_files.keys()}
+
+
+def sweep_stitching_tolerances(microct_path, stitching_tolerances, output_directory, prefetch_workers=8):
+    """
+    Report stitched and unstitched branches of every segment for many stitching tolerances. Distances are computed
+    once per segment and cached in output_directory, so later sweeps do not read the csv files again unless they
+    have changed.
+    :param microct_path: path to the folder with csv segmentation files
+    :param stitching_tolerances: list of tolerances to evaluate
+    :param output_directory: path to the folder for the cached distances and stitching-sweep.csv report
+    :param prefetch_workers: maximum number of csv files read concurrently
+    :return: path to the report csv file.
+    """
+
+    stitching_tables = load_stitching_tables(microct_path, output_directory, prefetch_workers)
+
+    report_file = os.path.join(output_directory, 'stitching-sweep.csv')
+    with open(report_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(['segment', 'stitching tolerance', 'stitched', 'unstitched', 'unstitched branches'])
+        for segment_name, stitching_table in stitching_tables.items():
+            for stitching_tolerance in stitching_tolerances:
+                branch_parent_indices = evaluate_stitching_table(stitching_table, stitching_tolerance)
+                unstitched_branches = [branch_name for branch_name, (parent_name, _) in branch_parent_indices.items()
+                                       if parent_name is None]
+                writer.writerow([segment_name, stitching_tolerance,
+                                 len(branch_parent_indices) - len(unstitched_branches), len(unstitched_branches),
+                                 '; '.join(unstitched_branches)])
+
+    return report_file
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Report stitched and unstitched branches of every segment for '
+                                                 'many stitching tolerances.')
+    parser.add_argument('microct_path', help='path to the folder with csv segmentation files')
+    parser.add_argument('output_directory', help='folder for the cached distances and stitching-sweep.csv report')
+    parser.add_argument('stitching_tolerances', nargs='+', type=float, help='tolerances to evaluate')
+    parser.add_argument('--prefetch-workers', type=int, default=8,
+                        help='maximum number of csv files read concurrently')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    print(sweep_stitching_tolerances(args.microct_path, args.stitching_tolerances, args.output_directory,
+                                     args.prefetch_workers))
@@ -0,0 +1,197 @@
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from cmlibs.zinc.context import Context
+from cmlibs.zinc.element import Element, Elementbasis
+from cmlibs.utils.zinc.field import findOrCreateFieldCoordinates, findOrCreateFieldGroup
+
+from fascicles import create_fascicle_graph_buffer
+from identifiers import next_free_identifiers, write_identifier_ranges
+from output import create_segment_region
+
+
+def find_segment_connections(segment_results, connection_tolerance):
+    """
+    Find the segment each segment trunk continues into, e.g. cervical into thoracic trunk, by matching trunk end
+    points to trunk start points of other segments on the same side in one batched k-d tree search. All trunk
+    starts within the tolerance are candidates, so a trunk end still connects when its own start or the nearest
+    other start is closer, e.g. for segments shorter than the gap between segments.
+    :param segment_results: list of segment result dicts from process_segment
+    :param connection_tolerance: largest squared distance between a trunk end and the next trunk start,
+        in the same units as the stitching tolerance
+    :return: Dict mapping segment name to name of the segment its trunk continues into, for connected segments.
+    """
+
+    connections = {}
+    for side_label in ['left', 'right']:
+        side_results = [segment_result for segment_result in segment_results
+                        if segment_result['trunk_group_name'] and side_label in segment_result['trunk_group_name']
+                        and len(segment_result['trunk_coordinates']) > 0]
+        if len(side_results) < 2:
+            continue
+        start_points = np.array([segment_result['trunk_coordinates'][0] for segment_result in side_results],
+                                dtype=np.float64)
+        end_points = np.array([segment_result['trunk_coordinates'][-1] for segment_result in side_results],
+                              dtype=np.float64)
+        # candidates beyond the tolerance are returned with the number of start points as index
+        _, candidate_indices = cKDTree(start_points).query(
+            end_points, k=len(start_points), distance_upper_bound=np.sqrt(connection_tolerance) * (1.0 + 1.0E-9))
+        candidates = []
+        for index, next_indices in enumerate(candidate_indices):
+            for next_index in next_indices:
+                if (next_index == len(start_points)) or (next_index == index):
+                    continue
+                distance_squared = np.sum((start_points[next_index] - end_points[index]) ** 2)
+                if distance_squared < connection_tolerance:
+                    candidates.append((distance_squared, index, int(next_index)))
+
+        # closest matches first, so each trunk end continues into at most one trunk start and vice versa
+        connected_indices = set()
+        for _, index, next_index in sorted(candidates):
+            segment_name = side_results[index]['segment_name']
+            if (segment_name in connections) or (next_index in connected_indices):
+                continue
+            connected_indices.add(next_index)
+            connections[segment_name] = side_results[next_index]['segment_name']
+
+    return connections
+
+
+def sort_connected_segments(segment_names, connections):
+    """
+    :param segment_names: list of segment names
+    :param connections: Dict mapping segment name to name of the segment its trunk continues into
+    :return: list of segment names with each connected segment following the segment it continues.
+    """
+
+    previous_segment_names = set(connections.values())
+    sorted_segment_names = []
+    for segment_name in segment_names:
+        if segment_name in previous_segment_names:
+            continue
+        while segment_name is not None and segment_name not in sorted_segment_names:
+            sorted_segment_names.append(segment_name)
+            segment_name = connections.get(segment_name)
+    # segments in a closed loop of connections have no first segment
+    sorted_segment_names.extend([segment_name for segment_name in segment_names
+                                 if segment_name not in sorted_segment_names])
+    return sorted_segment_names
+
+
+def offset_identifier_ranges(identifier_ranges, node_offset, element_offset):
+    """
+    :param identifier_ranges: dict mapping group name to (node identifier range, element identifier range)
+    :param node_offset: number added to all node identifiers
+    :param element_offset: number added to all element identifiers
+    :return: new dict with the offset identifier ranges.
+    """
+
+    return {group_name: (range(node_range.start + node_offset, node_range.stop + node_offset),
+                         range(element_range.start + element_offset, element_range.stop + element_offset))
+            for group_name, (node_range, element_range) in identifier_ranges.items()}
+
+
+def create_subject_region(data_region, segment_results, connection_tolerance):
+    """
+    Create one continuous scaffold of all segments of a subject in a Zinc region. Each segment gets node, element
+    and marker identifiers following those of the previous segments, groups of the same name are merged, and each
+    trunk is joined to the trunk it continues into with an element added to the later trunk group.
+    :param data_region: empty Zinc region to add the subject data to
+    :param segment_results: list of segment result dicts from process_segment
+    :param connection_tolerance: largest squared distance between a trunk end and the next trunk start
+    :return: Dict mapping <segment name>/<group name> to (node identifier range, element identifier range),
+        including a <segment name>/<next segment name> connection entry with the element joining the trunks.
+    """
+
+    connections = find_segment_connections(segment_results, connection_tolerance)
+    segment_results_by_name = {segment_result['segment_name']: segment_result for segment_result in segment_results}
+    segment_names = sort_connected_segments(list(segment_results_by_name.keys()), connections)
+
+    subject_identifier_ranges = {}
+    segment_identifier_ranges = {}
+    marker_identifier = 1
+    for segment_name in segment_names:
+        segment_result = segment_results_by_name[segment_name]
+        node_identifier, element_identifier = next_free_identifiers(subject_identifier_ranges)
+        identifier_ranges = offset_identifier_ranges(
+            {group_name: ranges for group_name, ranges in segment_result['identifier_ranges'].items()
+             if group_name != 'fascicle'}, node_identifier - 1, element_identifier - 1)
+        # fascicle identifiers are written into the buffer, so it is created again after the new ranges
+        fascicles_buffer = None
+        if segment_result['fascicle_graph'] is not None:
+            fascicles_buffer = create_fascicle_graph_buffer(segment_result['fascicle_graph'], identifier_ranges)
+        create_segment_region(data_region, segment_result['marker_data'], segment_result['trunk_group_name'],
+                              segment_result['trunk_coordinates'], segment_result['trunk_radius'],
+                              segment_result['branch_names'], segment_result['branch_coordinates_data'],
+                              segment_result['branch_parent_indices'], segment_result['avg_branch_radius'],
+                              segment_result['orientation_markers'], segment_result['vagus_terms'], fascicles_buffer,
+                              identifier_ranges, segment_result['branch_radius_data'], marker_identifier)
+        marker_identifier += len(segment_result['marker_data'])
+        segment_identifier_ranges[segment_name] = identifier_ranges
+        for group_name, ranges in identifier_ranges.items():
+            subject_identifier_ranges[segment_name + '/' + group_name] = ranges
+
+    # join connected trunks
+    fieldmodule = data_region.getFieldmodule()
+    coordinates = findOrCreateFieldCoordinates(fieldmodule).castFiniteElement()
+    radius = fieldmodule.findFieldByName('radius').castFiniteElement()
+    mesh1d = fieldmodule.findMeshByDimension(1)
+    linear_basis = fieldmodule.createElementbasis(1, Elementbasis.FUNCTION_TYPE_LINEAR_LAGRANGE)
+    eft = mesh1d.createElementfieldtemplate(linear_basis)
+    for segment_name in segment_names:
+        next_segment_name = connections.get(segment_name)
+        if next_segment_name is None:
+            continue
+        segment_result = segment_results_by_name[segment_name]
+        next_segment_result = segment_results_by_name[next_segment_name]
+        trunk_node_range = segment_identifier_ranges[segment_name][segment_result['trunk_group_name']][0]
+        next_trunk_group_name = next_segment_result['trunk_group_name']
+        next_trunk_node_range = segment_identifier_ranges[next_segment_name][next_trunk_group_name][0]
+
+        node_identifier, element_identifier = next_free_identifiers(subject_identifier_ranges)
+        subject_identifier_ranges[segment_name + '/' + next_segment_name + ' connection'] = \
+            (range(node_identifier, node_identifier), range(element_identifier, element_identifier + 1))
+
+        elementtemplate = mesh1d.createElementtemplate()
+        elementtemplate.setElementShapeType(Element.SHAPE_TYPE_LINE)
+        elementtemplate.defineField(coordinates, -1, eft)
+        if len(segment_result['trunk_radius']) > 0 and len(next_segment_result['trunk_radius']) > 0:
+            elementtemplate.defineField(radius, -1, eft)
+        element = mesh1d.createElement(element_identifier, elementtemplate)
+        element.setNodesByIdentifier(eft, [trunk_node_range.stop - 1, next_trunk_node_range.start])
+
+        group_names = [next_trunk_group_name]
+        vagus_terms = next_segment_result['vagus_terms']
+        if vagus_terms and next_trunk_group_name in vagus_terms:
+            group_names.append(vagus_terms[next_trunk_group_name])
+        for group_name in group_names:
+            findOrCreateFieldGroup(fieldmodule, group_name).getOrCreateMeshGroup(mesh1d).addElement(element)
+
+    return subject_identifier_ranges
+
+
+def write_subject_result(segment_results, output_directory, subject_name, connection_tolerance):
+    """
+    Write all segments of a subject as one continuous scaffold <subject_name>.exf, with its identifier ranges
+    in <subject_name>-identifiers.csv. The segments are assembled from their in-memory results.
+    :param segment_results: list of segment result dicts from process_segment
+    :param output_directory: path to the folder where to save the output results
+    :param subject_name: name of the subject output files
+    :param connection_tolerance: largest squared distance between a trunk end and the next trunk start
+    :return: list of output file paths.
+    """
+
+    context = Context("data_region")
+    data_region = context.getDefaultRegion()
+    subject_identifier_ranges = create_subject_region(data_region, segment_results, connection_tolerance)
+
+    output_file = os.path.join(output_directory, subject_name + ".exf")
+    sir = data_region.createStreaminformationRegion()
+    srf = sir.createStreamresourceFile(output_file)
+    result = data_region.write(sir)
+
+    write_identifier_ranges(os.path.join(output_directory, subject_name + "-identifiers.csv"),
+                            subject_identifier_ranges)
+    return [output_file]
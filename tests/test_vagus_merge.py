@@ -1,5 +1,15 @@
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import networkx as nx
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 from cmlibs.utils.zinc.field import get_group_list
 from cmlibs.utils.zinc.group import groups_have_same_local_contents
@@ -7,17 +17,70 @@ from cmlibs.zinc.context import Context
 from cmlibs.zinc.field import Field
 from cmlibs.zinc.result import RESULT_OK
 
-from init import find_orientation_spreadsheet, find_tracing_csv_files, main
-from annotations import read_case_vagus_termslist
-from anatomy import read_vagus_branching_pattern_spreadsheet
-from csv_processing import branch_is_non_vagal, suggest_parent_name
+from init import find_tracing_csv_files, main
+from csv_processing import branch_is_non_vagal, find_branch_group_names, process_segment_csv_files, \
+    read_segment_csv_files, suggest_parent_name
+import dataset_files
+from dataset_files import close_dataset_archives, prefetch_dataset_files
+from ex_reader import find_disconnected_groups, get_group_bounding_boxes, get_group_node_counts, read_exf_arrays
+from ex_writer import format_ex_real, write_exf_streaming, write_fascicle_exf_streaming
+from identifiers import allocate_identifier_ranges, find_identifier_group, next_free_identifiers, \
+    read_identifier_ranges
+from level_of_detail import decimate_fascicle_graph, decimate_segment_data
+from nerve_morphology import find_nearest_point_indices
+from output import write_exf
+from remote_dataset import close_remote_connections, configure_remote_dataset, write_remote_index
+from pipeline import process_dataset, process_segment, read_anatomy_data, segment_result_to_buffer, \
+    write_segment_result, write_segment_streaming
+from stages import run_stages
+from stitching_sweep import compute_segment_stitching_table, evaluate_stitching_table, read_stitching_table, \
+    sweep_stitching_tolerances, write_stitching_table
+from subject import find_segment_connections, write_subject_result
+from trunk_projection import project_markers_to_trunk, read_marker_projections
+from validation import validate_dataset, validate_morphology_file
+from work_queue import run_worker, claim_work_item, fail_work_item, is_work_item_finished, owns_work_item, \
+    release_work_item, start_heartbeat
 
 here = os.path.abspath(os.path.dirname(__file__))
 
 
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Stand-in for a data portal: serves files with keep-alive connections and range requests, recording requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    supports_ranges = True
+
+    def do_GET(self):
+        file_path = self.translate_path(self.path)
+        range_header = self.headers.get('Range')
+        RangeRequestHandler.requests.append((self.path, range_header, self.client_address))
+        if not os.path.isfile(file_path):
+            self.send_error(404)
+            return
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        status = 200
+        if range_header and RangeRequestHandler.supports_ranges:
+            start, stop = [int(value) for value in re.match(r'bytes=(\d+)-(\d+)', range_header).groups()]
+            data = data[start:stop + 1]
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
 class VagusMergeTestCase(unittest.TestCase):
 
     def test_read_terms(self):
+        # imported here so the other tests run without these
+        from annotations import read_case_vagus_termslist
         terms_path = os.path.join(here, "resources", "terms.xlsx")
         _, vagus_branch_terms = read_case_vagus_termslist(terms_path)
         self.assertNotEqual(vagus_branch_terms, {})
@@ -30,6 +93,8 @@ class VagusMergeTestCase(unittest.TestCase):
         self.assertFalse('right hypoglossal nerve' in vagus_branch_terms.keys())
 
     def test_read_anatomy(self):
+        from anatomy import read_vagus_branching_pattern_spreadsheet
+        from init import find_orientation_spreadsheet
         root_path = os.path.join(here, "resources", "sub-SR000")
         anatomy_path = os.path.join(root_path, "Anatomy")
         anatomy_file = find_orientation_spreadsheet(anatomy_path)
@@ -49,6 +114,235 @@ class VagusMergeTestCase(unittest.TestCase):
             any(['CR1-right_cervical_trunk' in segment_file for segment_file in segment_files['sam-SR000-CR1']]))
         self.assertEqual(segment_files['sam-SR000-TR2'], [])
 
+    def test_read_tracing_from_archive(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        with tempfile.TemporaryDirectory() as temp_directory:
+            archive_path = shutil.make_archive(os.path.join(temp_directory, "sub-SR000"), "zip", root_path)
+            segment_files = find_tracing_csv_files(os.path.join(archive_path, "MicroCT"))
+            directory_segment_files = find_tracing_csv_files(os.path.join(root_path, "MicroCT"))
+            self.assertEqual(sorted(segment_files.keys()), sorted(directory_segment_files.keys()))
+            self.assertEqual(len(segment_files['CR1']), len(directory_segment_files['CR1']))
+
+            cr1_files = sorted(segment_files['CR1'])
+            _, trunk_group_name, trunk_coordinates, _ = read_segment_csv_files(cr1_files)
+            _, _, directory_trunk_coordinates, _ = read_segment_csv_files(sorted(directory_segment_files['CR1']))
+            self.assertEqual(trunk_group_name, 'right cervical trunk')
+            self.assertEqual(trunk_coordinates, directory_trunk_coordinates)
+
+            # compressed tar members in any order, with archives closed and opened again between reads
+            tar_archive_path = shutil.make_archive(os.path.join(temp_directory, "sub-SR000"), "gztar", root_path)
+            tar_cr1_files = sorted(find_tracing_csv_files(os.path.join(tar_archive_path, "MicroCT"))['CR1'])
+            self.assertEqual([os.path.relpath(f, tar_archive_path) for f in tar_cr1_files],
+                             [os.path.relpath(f, archive_path) for f in cr1_files])
+            max_open_archives = dataset_files.max_open_archives
+            dataset_files.max_open_archives = 1
+            try:
+                for tar_file, zip_file in reversed(list(zip(tar_cr1_files, cr1_files))):
+                    self.assertEqual(dataset_files.read_dataset_file_bytes(tar_file),
+                                     dataset_files.read_dataset_file_bytes(zip_file))
+                self.assertEqual(read_segment_csv_files(tar_cr1_files)[2], directory_trunk_coordinates)
+            finally:
+                dataset_files.max_open_archives = max_open_archives
+                close_dataset_archives()
+
+            # only csv and graphml files of compressed tars are kept in memory, other files are read when opened
+            anatomy_file_name = os.listdir(os.path.join(root_path, 'Anatomy'))[0]
+            with open(os.path.join(root_path, 'Anatomy', anatomy_file_name), 'rb') as f:
+                anatomy_bytes = f.read()
+            self.assertEqual(dataset_files.read_dataset_file_bytes(
+                os.path.join(tar_archive_path, 'Anatomy', anatomy_file_name)), anatomy_bytes)
+            member_contents = dataset_files._open_archives[tar_archive_path][1][2]
+            self.assertIn(os.path.relpath(tar_cr1_files[0], tar_archive_path).replace(os.sep, '/'), member_contents)
+            self.assertFalse(any(member_name.startswith('Anatomy') for member_name in member_contents))
+
+            # members of uncompressed tars are read concurrently, each through its own file handle
+            plain_tar_path = shutil.make_archive(os.path.join(temp_directory, "sub-SR000"), "tar", root_path)
+            plain_tar_cr1_files = sorted(find_tracing_csv_files(os.path.join(plain_tar_path, "MicroCT"))['CR1'])
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                self.assertEqual(list(executor.map(dataset_files.read_dataset_file_bytes, plain_tar_cr1_files)),
+                                 [dataset_files.read_dataset_file_bytes(f) for f in cr1_files])
+
+            # archives are listed again when replaced
+            shutil.make_archive(os.path.join(temp_directory, "sub-SR000"), "tar", os.path.join(root_path, 'MicroCT'))
+            os.utime(plain_tar_path, (time.time() + 10.0, time.time() + 10.0))
+            self.assertEqual(find_tracing_csv_files(os.path.join(plain_tar_path, "MicroCT")), {})
+            close_dataset_archives()
+
+            # archives inside plain folders are not walked, so segments are only found on disk
+            shutil.copytree(root_path, os.path.join(temp_directory, 'sub-SR000'))
+            shutil.copy(archive_path, os.path.join(temp_directory, 'sub-SR000', 'MicroCT'))
+            self.assertEqual(find_tracing_csv_files(os.path.join(temp_directory, 'sub-SR000', 'MicroCT')),
+                             {segment_name: [os.path.join(temp_directory, os.path.relpath(f, os.path.join(here, 'resources')))
+                                             for f in csv_files]
+                              for segment_name, csv_files in directory_segment_files.items()})
+
+    def test_prefetch_tracing_files(self):
+        microct_path = os.path.join(here, "resources", "sub-SR000", "MicroCT")
+        segment_files = find_tracing_csv_files(microct_path)
+        segment_names = list(segment_files.keys())
+        prefetched = list(prefetch_dataset_files([segment_files[name] for name in segment_names], 4))
+        self.assertEqual(len(prefetched), len(segment_names))
+        for segment_name, file_buffers in zip(segment_names, prefetched):
+            self.assertEqual(list(file_buffers.keys()), segment_files[segment_name])
+            self.assertEqual(read_segment_csv_files(segment_files[segment_name], file_buffers),
+                             read_segment_csv_files(segment_files[segment_name]))
+
+    def test_preflight_validation(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        self.assertEqual(validate_dataset(os.path.join(root_path, "MicroCT")), [])
+
+        temporary_directory = tempfile.mkdtemp()
+        try:
+            microct_path = os.path.join(temporary_directory, "MicroCT")
+            shutil.copytree(os.path.join(root_path, "MicroCT"), microct_path)
+            cl2_path = os.path.join(microct_path, "sam-SR000-CL2", "SR000-CL2-Annotations")
+            with open(os.path.join(cl2_path, "SUB01-CL2-left_cervical_trunk.csv"), 'a') as f:
+                f.write('1.0,2.0\n')
+            with open(os.path.join(cl2_path, "SUB01-CL2-left_hypoglossal_nerve.csv"), 'r') as f:
+                lines = f.readlines()
+            with open(os.path.join(cl2_path, "SUB01-CL2-left_hypoglossal_nerve.csv"), 'w') as f:
+                f.writelines(lines[:2])
+            open(os.path.join(cl2_path, "SUB01-CL2-notes.csv"), 'w').close()
+            os.rename(os.path.join(microct_path, "sam-SR000-TR1"), os.path.join(microct_path, "sam-SR000-R1"))
+
+            problems = validate_dataset(microct_path)
+            self.assertEqual(sorted(problem[len(microct_path) + 1:] for problem in problems), [
+                'sam-SR000-CL2/SR000-CL2-Annotations/SUB01-CL2-left_cervical_trunk.csv: 23029 separators for 7677 '
+                'rows of 4 columns, some rows have missing or extra columns or are empty',
+                'sam-SR000-CL2/SR000-CL2-Annotations/SUB01-CL2-left_hypoglossal_nerve.csv: branch has 1 rows, '
+                'at least 2 needed',
+                'sam-SR000-CL2/SR000-CL2-Annotations/SUB01-CL2-notes.csv: group notes is not a marker, trunk or '
+                'branch file',
+                'sam-SR000-R1: segment folder name has no CL/CR/TL/TR label'])
+            with self.assertRaises(ValueError):
+                main(None, microct_path, None, None, temporary_directory, 110000.0, {'preflight': True})
+
+            # morphology columns are read by position, whatever their header names
+            morphology_file = os.path.join(temporary_directory, 'SR000-CL2-left_cervical_trunk-morphology.csv')
+            with open(morphology_file, 'w') as f:
+                f.write('frame,Area,Perimeter,Diameter,X,Y,major,minor,angle\n'
+                        '1,5.0,8.0,2.5,10.0,20.0,1,1,0\n'
+                        '2,,,,,,,,\n')
+            self.assertEqual(validate_morphology_file(morphology_file), [])
+            with open(morphology_file, 'a') as f:
+                f.write('3,5.0,8.0,2.5,x,20.0,1,1,0\n')
+            self.assertEqual(validate_morphology_file(morphology_file), [
+                morphology_file + ': 1 rows without numbers in columns 1 (index), 4 (eq_diameter), 5 (center_x), '
+                '6 (center_y), first on line 4'])
+        finally:
+            shutil.rmtree(temporary_directory)
+
+    def test_remote_dataset(self):
+        microct_path = os.path.join(here, "resources", "sub-SR000", "MicroCT")
+        temporary_directory = tempfile.mkdtemp()
+        server = None
+        try:
+            dataset_path = os.path.join(temporary_directory, 'sub-SR000')
+            # space in the folder name, which must be quoted in requests
+            shutil.copytree(microct_path, os.path.join(dataset_path, 'Micro CT'))
+            write_remote_index(dataset_path)
+            server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=dataset_path))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            remote_microct_path = 'http://127.0.0.1:' + str(server.server_address[1]) + '/Micro CT'
+            cache_directory = os.path.join(temporary_directory, 'cache')
+            configure_remote_dataset(cache_directory, max_cache_size=10 ** 9, range_size=256 * 1024)
+
+            RangeRequestHandler.requests = []
+            segment_files = find_tracing_csv_files(microct_path)
+            remote_segment_files = find_tracing_csv_files(remote_microct_path)
+            self.assertEqual(sorted(remote_segment_files.keys()), sorted(segment_files.keys()))
+            for segment_name in ['CL2', 'CR1']:
+                self.assertEqual(process_segment_csv_files(sorted(remote_segment_files[segment_name]), 110000.0),
+                                 process_segment_csv_files(sorted(segment_files[segment_name]), 110000.0))
+
+            # large files are fetched in parts, through a few reused connections
+            self.assertTrue(any(range_header for _, range_header, _ in RangeRequestHandler.requests))
+            client_addresses = {client_address for _, _, client_address in RangeRequestHandler.requests}
+            self.assertLess(len(client_addresses), len(RangeRequestHandler.requests) / 4)
+
+            # files fetched before are read from the cache
+            RangeRequestHandler.requests = []
+            remote_files = remote_segment_files['CL2']
+            list(prefetch_dataset_files([remote_files], 4))
+            self.assertEqual(RangeRequestHandler.requests, [])
+
+            # least recently used files are removed from the cache above its size, but not files another process
+            # is still writing, while those left over by a stopped process are removed after a timeout
+            in_flight_file = os.path.join(cache_directory, 'in-flight.tmp')
+            stale_file = os.path.join(cache_directory, 'stale.tmp')
+            for temporary_file in [in_flight_file, stale_file]:
+                with open(temporary_file, 'wb') as f:
+                    f.write(b'0' * 1000)
+            stale_time = time.time() - 7200.0
+            os.utime(stale_file, (stale_time, stale_time))
+            configure_remote_dataset(max_cache_size=1)
+            list(prefetch_dataset_files([remote_segment_files['TL1'][:1]], 1))
+            self.assertEqual([os.path.join(rootpath, f) for rootpath, _, files in os.walk(cache_directory)
+                              for f in files], [in_flight_file])
+            os.remove(in_flight_file)
+
+            # a server without range requests sends the whole file for the first range, which is then used
+            RangeRequestHandler.supports_ranges = False
+            RangeRequestHandler.requests = []
+            configure_remote_dataset(os.path.join(temporary_directory, 'cache2'), max_cache_size=10 ** 9)
+            self.assertEqual(process_segment_csv_files(sorted(remote_segment_files['CR1']), 110000.0),
+                             process_segment_csv_files(sorted(segment_files['CR1']), 110000.0))
+            self.assertTrue(any(range_header for _, range_header, _ in RangeRequestHandler.requests))
+            request_paths = [path for path, _, _ in RangeRequestHandler.requests if path.endswith('.csv')]
+            self.assertEqual(len(request_paths), len(set(request_paths)))
+        finally:
+            RangeRequestHandler.supports_ranges = True
+            close_remote_connections()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            shutil.rmtree(temporary_directory)
+
+    def test_stitching_tolerance_sweep(self):
+        microct_path = os.path.join(here, "resources", "sub-SR000", "MicroCT")
+        segment_files = find_tracing_csv_files(microct_path)
+        stitching_table = compute_segment_stitching_table(segment_files['CR1'])
+        with tempfile.TemporaryDirectory() as temp_directory:
+            stitching_file = os.path.join(temp_directory, 'CR1-stitching.csv')
+            write_stitching_table(stitching_file, stitching_table)
+            self.assertEqual(read_stitching_table(stitching_file), stitching_table)
+
+        for stitching_tolerance in [1.0e4, 1.1e5]:
+            _, _, _, _, _, branch_parent_indices = process_segment_csv_files(segment_files['CR1'], stitching_tolerance)
+            self.assertEqual(evaluate_stitching_table(stitching_table, stitching_tolerance), branch_parent_indices)
+        self.assertEqual(evaluate_stitching_table(stitching_table, 1.0e4)['right hypoglossal nerve'], (None, None))
+
+        with tempfile.TemporaryDirectory() as temp_directory:
+            dataset_path = os.path.join(temp_directory, 'MicroCT')
+            output_directory = os.path.join(temp_directory, 'sweep')
+            shutil.copytree(microct_path, dataset_path)
+            os.makedirs(output_directory)
+            stitching_tolerances = [1.0e4, 1.1e5]
+            report_file = sweep_stitching_tolerances(dataset_path, stitching_tolerances, output_directory)
+            with open(report_file, 'r') as f:
+                report_rows = [line.rstrip('\n').split(',') for line in f.readlines()[1:]]
+            self.assertEqual(sorted((row[0], float(row[1])) for row in report_rows),
+                             sorted((segment_name, stitching_tolerance) for segment_name in segment_files.keys()
+                                    for stitching_tolerance in stitching_tolerances))
+            for row in report_rows:
+                branch_parent_indices = process_segment_csv_files(segment_files[row[0]], float(row[1]))[5]
+                self.assertEqual(int(row[3]), sum(parent_name is None
+                                                  for parent_name, _ in branch_parent_indices.values()))
+
+            # cached tables are used until the segment files change
+            cache_files = sorted(f for f in os.listdir(output_directory) if f != 'stitching-sweep.csv')
+            self.assertEqual(len(cache_files), len(segment_files))
+            sweep_stitching_tolerances(dataset_path, stitching_tolerances, output_directory)
+            self.assertEqual(sorted(f for f in os.listdir(output_directory) if f != 'stitching-sweep.csv'),
+                             cache_files)
+            changed_file = find_tracing_csv_files(dataset_path)['CR1'][0]
+            changed_time = os.stat(changed_file).st_mtime + 10.0
+            os.utime(changed_file, (changed_time, changed_time))
+            sweep_stitching_tolerances(dataset_path, stitching_tolerances, output_directory)
+            changed_cache_files = sorted(f for f in os.listdir(output_directory) if f != 'stitching-sweep.csv')
+            self.assertEqual(len(changed_cache_files), len(segment_files))
+            self.assertEqual([f for f in changed_cache_files if f not in cache_files][0][:4], 'CR1-')
+
     def test_non_vagus_filtering(self):
 
         branch_name = 'left hypoglossal nerve'
@@ -100,7 +394,529 @@ class VagusMergeTestCase(unittest.TestCase):
         self.assertEqual(suggest_parent_name(branch_name, 'left', trunk_group_name),
                          'left glossopharyngeal nerve')
 
+    def test_identifier_allocation(self):
+        group_counts = [('left vagus nerve', 600000, 599999), ('left cervical cardiac branch', 10, 10)]
+        identifier_ranges = allocate_identifier_ranges(group_counts)
+        self.assertEqual(identifier_ranges['left vagus nerve'], (range(1, 600001), range(1, 600000)))
+        self.assertEqual(identifier_ranges['left cervical cardiac branch'],
+                         (range(600001, 600011), range(600000, 600010)))
+
+        # fascicle identifiers start after the segment identifiers, even for segments with > 500000 points
+        allocate_identifier_ranges([('fascicle', 20, 19)], identifier_ranges)
+        self.assertEqual(identifier_ranges['fascicle'], (range(600011, 600031), range(600010, 600029)))
+        self.assertEqual(find_identifier_group(identifier_ranges, 500000), 'left vagus nerve')
+        self.assertEqual(find_identifier_group(identifier_ranges, 600020), 'fascicle')
+        self.assertEqual(find_identifier_group(identifier_ranges, 600005, is_element=True),
+                         'left cervical cardiac branch')
+        self.assertIsNone(find_identifier_group(identifier_ranges, 600031))
+
+    def test_level_of_detail_keeps_attach_points(self):
+        trunk_group_name = 'left vagus nerve'
+        trunk_coordinates = [[0.0, 0.0, float(z)] for z in range(100)]
+        branch_names = ['left cervical cardiac branch', 'branch of left cervical cardiac branch']
+        branch_coordinates_data = {
+            'left cervical cardiac branch': [[float(x), 0.0, 37.0] for x in range(1, 30)],
+            'branch of left cervical cardiac branch': [[10.0, float(y), 37.0] for y in range(1, 20)]}
+        branch_parent_indices = {
+            'left cervical cardiac branch': (trunk_group_name, 38),
+            'branch of left cervical cardiac branch': ('left cervical cardiac branch', 10)}
+
+        lod_trunk_coordinates, _, lod_branch_coordinates_data, lod_branch_parent_indices = decimate_segment_data(
+            trunk_group_name, trunk_coordinates, [], branch_names, branch_coordinates_data, branch_parent_indices, 16)
+        self.assertEqual(lod_trunk_coordinates[0], trunk_coordinates[0])
+        self.assertEqual(lod_trunk_coordinates[-1], trunk_coordinates[-1])
+        self.assertLess(len(lod_trunk_coordinates), 15)
+        parent_name, parent_index = lod_branch_parent_indices['left cervical cardiac branch']
+        self.assertEqual(parent_name, trunk_group_name)
+        self.assertEqual(lod_trunk_coordinates[parent_index - 1], trunk_coordinates[37])
+        parent_name, parent_index = lod_branch_parent_indices['branch of left cervical cardiac branch']
+        self.assertEqual(lod_branch_coordinates_data[parent_name][parent_index - 1],
+                         branch_coordinates_data[parent_name][9])
+
+    def test_decimate_fascicle_graph(self):
+        # fascicle with a branch at node 5, its nodes in the graph in a different order to the path
+        path_nodes = [str(index) for index in range(11)]
+        G = nx.Graph()
+        G.add_nodes_from(path_nodes[-2:0:-3] + path_nodes + ['b1', 'b2'])
+        G.add_edges_from(zip(path_nodes[:-1], path_nodes[1:]))
+        G.add_edges_from([('5', 'b1'), ('b1', 'b2')])
+        # closed loop of path nodes
+        loop_nodes = ['l' + str(index) for index in range(6)]
+        G.add_edges_from(zip(loop_nodes, loop_nodes[1:] + loop_nodes[:1]))
+
+        lod_G = decimate_fascicle_graph(G, 2)
+        self.assertEqual({frozenset(edge) for edge in lod_G.edges()}, {frozenset(edge) for edge in [
+            ('0', '2'), ('2', '4'), ('4', '5'), ('5', '7'), ('7', '9'), ('9', '10'), ('5', 'b2'),
+            ('l0', 'l2'), ('l2', 'l4'), ('l4', 'l0')]})
+        self.assertEqual(G.number_of_nodes(), 19)
+
+        # graphml files with directed edges are read as directed graphs, decimated the same way keeping direction
+        chain_nodes = [str(index) for index in range(21)]
+        directed_G = nx.DiGraph()
+        directed_G.add_edges_from(zip(chain_nodes[:-1], chain_nodes[1:]))
+        lod_directed_G = decimate_fascicle_graph(directed_G, 4)
+        self.assertEqual(sorted(lod_directed_G.edges()), sorted(zip(chain_nodes[:-1:4], chain_nodes[4::4])))
+        self.assertEqual(decimate_fascicle_graph(directed_G.to_undirected(), 4).number_of_nodes(), 6)
+
+    def test_process_dataset_in_memory(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        microct_path = os.path.join(root_path, "MicroCT")
+        segment_results = {segment_result['segment_name']: segment_result
+                           for segment_result in process_dataset(None, microct_path, None, None, 110000.0)}
+        self.assertEqual(len(segment_results), 4)
+        cl2_result = segment_results['CL2']
+        self.assertEqual(cl2_result['trunk_group_name'], 'left cervical trunk')
+        self.assertEqual(len(cl2_result['trunk_coordinates']), 7676)
+        self.assertEqual(cl2_result['branch_parent_indices']['left hypoglossal nerve'], (None, None))
+
+        context = Context("CL2 Segment Buffer Test")
+        region = context.getDefaultRegion()
+        sir = region.createStreaminformationRegion()
+        sir.createStreamresourceMemoryBuffer(segment_result_to_buffer(cl2_result))
+        self.assertEqual(region.read(sir), RESULT_OK)
+        nodes = region.getFieldmodule().findNodesetByFieldDomainType(Field.DOMAIN_TYPE_NODES)
+        self.assertEqual(nodes.getSize(), next_free_identifiers(cl2_result['identifier_ranges'])[0] - 1)
+
+    def test_subject_scaffold(self):
+        microct_path = os.path.join(here, "resources", "sub-SR000", "MicroCT")
+        # an orientation marker in every segment, so all segments add to the same orientation group
+        vagus_orientations = {'right superior laryngeal nerve': 'anterior',
+                              'right recurrent laryngeal nerve': 'anterior',
+                              'left cervical cardiac branch': 'anterior',
+                              'left recurrent laryngeal nerve': 'anterior'}
+        segment_results = [process_segment(segment_name, segment_csv_files, vagus_orientations, None, None, None,
+                                           110000.0)
+                           for segment_name, segment_csv_files in find_tracing_csv_files(microct_path).items()]
+        # move thoracic segment so its trunk starts next to the end of the cervical trunk
+        cr1_result, tr1_result = [[segment_result for segment_result in segment_results
+                                   if segment_result['segment_name'] == segment_name][0]
+                                  for segment_name in ['CR1', 'TR1']]
+        offset = np.array(cr1_result['trunk_coordinates'][-1]) - np.array(tr1_result['trunk_coordinates'][0]) + \
+            np.array([100.0, 0.0, 0.0])
+        tr1_result['trunk_coordinates'] = [list(np.array(point) + offset) for point in tr1_result['trunk_coordinates']]
+        self.assertEqual(find_segment_connections(segment_results, 110000.0), {'CR1': 'TR1'})
+        self.assertEqual(find_segment_connections(segment_results, 10000.0), {})
+
+        # A is shorter than the gap to D, and B's start is taken by the closer end of C
+        short_segment_results = [
+            {'segment_name': segment_name, 'trunk_group_name': 'left cervical trunk', 'trunk_coordinates': coordinates}
+            for segment_name, coordinates in [('A', [[0.0, 0.0, 0.0], [10.0, 0.0, 0.0]]),
+                                              ('B', [[40.0, 0.0, 0.0], [100.0, 0.0, 0.0]]),
+                                              ('C', [[-500.0, 0.0, 0.0], [42.0, 0.0, 0.0]]),
+                                              ('D', [[10.0, 50.0, 0.0], [10.0, 400.0, 0.0]])]]
+        self.assertEqual(find_segment_connections(short_segment_results, 3000.0), {'C': 'B', 'A': 'D'})
+        self.assertEqual(find_segment_connections(short_segment_results, 1000.0), {'C': 'B'})
+
+        output_directory = tempfile.mkdtemp()
+        try:
+            output_files = write_subject_result(segment_results, output_directory, 'SR000', 110000.0)
+            self.assertEqual(output_files, [os.path.join(output_directory, 'SR000.exf')])
+            ex_data = read_exf_arrays(output_files[0])
+            identifier_ranges = read_identifier_ranges(os.path.join(output_directory, 'SR000-identifiers.csv'))
+            self.assertEqual(len(ex_data['node_identifiers']), sum(
+                next_free_identifiers(segment_result['identifier_ranges'])[0] - 1
+                for segment_result in segment_results))
+            self.assertEqual(len(ex_data['node_identifiers']), len(np.unique(ex_data['node_identifiers'])))
+            self.assertEqual(len(ex_data['marker_names']), sum(
+                len(segment_result['marker_data']) for segment_result in segment_results))
+            # marker and orientation groups contain the markers of all segments
+            self.assertEqual(sorted(ex_data['datapoint_groups']['marker']), list(ex_data['marker_identifiers']))
+            orientation_labels = {label for segment_result in segment_results
+                                  for label in segment_result['orientation_markers']}
+            self.assertTrue(orientation_labels)
+            for orientation_label in orientation_labels:
+                orientation_node_identifiers = []
+                for segment_result in segment_results:
+                    if orientation_label in segment_result['orientation_markers']:
+                        orientation_node_identifiers.extend(identifier_ranges[
+                            segment_result['segment_name'] + '/' + orientation_label][0])
+                self.assertEqual(len(orientation_node_identifiers), 4)
+                self.assertEqual(sorted(ex_data['node_groups'][orientation_label]),
+                                 sorted(orientation_node_identifiers))
+
+            # thoracic trunk follows the cervical trunk, joined by an element in the thoracic trunk group
+            cr1_trunk_nodes = identifier_ranges['CR1/right cervical trunk'][0]
+            tr1_trunk_nodes = identifier_ranges['TR1/right thoracic trunk'][0]
+            self.assertEqual(tr1_trunk_nodes.start, next_free_identifiers(cr1_result['identifier_ranges'])[0] +
+                             cr1_trunk_nodes.start - 1)
+            connection_element = identifier_ranges['CR1/TR1 connection'][1].start
+            element_index = list(ex_data['element_identifiers']).index(connection_element)
+            self.assertEqual(list(ex_data['element_nodes'][element_index]),
+                             [cr1_trunk_nodes.stop - 1, tr1_trunk_nodes.start])
+            self.assertIn(connection_element, ex_data['element_groups']['right thoracic trunk'])
+            self.assertNotIn('right thoracic trunk', find_disconnected_groups(ex_data))
+        finally:
+            shutil.rmtree(output_directory)
+
+    def test_streaming_exf_matches_zinc(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        microct_path = os.path.join(root_path, "MicroCT")
+        segment_files = find_tracing_csv_files(microct_path)
+        marker_data, trunk_group_name, trunk_coordinates, branch_names, branch_coordinates_data, \
+            branch_parent_indices = process_segment_csv_files(segment_files['CL2'], 110000.0)
+        trunk_radius = [10.0] * len(trunk_coordinates)
+
+        output_directory = tempfile.mkdtemp()
+        try:
+            zinc_file = os.path.join(output_directory, 'CL2-zinc.exf')
+            streaming_file = os.path.join(output_directory, 'CL2-streaming.exf')
+            write_exf(zinc_file, marker_data, trunk_group_name, trunk_coordinates, trunk_radius, branch_names,
+                      branch_coordinates_data, branch_parent_indices, 5.0, {}, None, None)
+            write_exf_streaming(streaming_file, marker_data, trunk_group_name, trunk_coordinates, trunk_radius,
+                                branch_names, branch_coordinates_data, branch_parent_indices, 5.0, {}, None, None,
+                                chunk_size=1000)
+            with open(zinc_file, 'r') as zinc_output, open(streaming_file, 'r') as streaming_output:
+                self.assertEqual(zinc_output.read(), streaming_output.read())
+        finally:
+            shutil.rmtree(output_directory)
+
+    def test_multiple_fascicle_files(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        segment_csv_files = find_tracing_csv_files(os.path.join(root_path, "MicroCT"))['CL2']
+
+        output_directory = tempfile.mkdtemp()
+        try:
+            # segment exported in two blocks of frames, each numbering its nodes from 0
+            fascicle_path = os.path.join(output_directory, 'fascicles')
+            os.makedirs(fascicle_path)
+            for part, frames in [(1, range(0, 5)), (2, range(5, 12))]:
+                G = nx.Graph()
+                for index, frame in enumerate(frames):
+                    G.add_node(str(index), label=1, **{'centroid-0': 10.0, 'centroid-1': 20.0, 'frame': float(frame),
+                                                      'equivalent_diameter': 4.0})
+                    if index > 0:
+                        G.add_edge(str(index - 1), str(index))
+                nx.write_graphml(G, os.path.join(fascicle_path, 'CL2-left_cervical_trunk-part%d.graphml' % part))
+
+            segment_result = process_segment('CL2', segment_csv_files, None, None, None, fascicle_path, 110000.0)
+            self.assertEqual(segment_result['fascicle_graph'].number_of_nodes(), 12)
+            self.assertEqual(segment_result['fascicle_graph'].number_of_edges(), 10)
+            # nodes of the second file keep their prefix mapped to that file
+            fascicle_files = segment_result['fascicle_graph'].graph['fascicle_files']
+            self.assertEqual(os.path.basename(fascicle_files['1-']), 'CL2-left_cervical_trunk-part2.graphml')
+            self.assertEqual(segment_result['fascicle_graph'].nodes['1-6']['frame'], 11.0)
+            write_segment_result(segment_result, output_directory)
+            ex_data = read_exf_arrays(os.path.join(output_directory, 'CL2.exf'))
+            with open(os.path.join(output_directory, 'fascicles-CL2.exf'), 'r') as fascicles_file:
+                zinc_fascicles = fascicles_file.read()
+
+            # fascicles file written without Zinc matches it, and is written with reduced precision on request
+            streaming_directory = os.path.join(output_directory, 'streaming')
+            os.makedirs(streaming_directory)
+            write_fascicle_exf_streaming(os.path.join(streaming_directory, 'fascicles-CL2.exf'),
+                                         segment_result['fascicle_graph'], dict(segment_result['identifier_ranges']))
+            with open(os.path.join(streaming_directory, 'fascicles-CL2.exf'), 'r') as fascicles_file:
+                self.assertEqual(fascicles_file.read(), zinc_fascicles)
+            write_segment_result(segment_result, streaming_directory, significant_digits=8)
+            with open(os.path.join(streaming_directory, 'fascicles-CL2.exf'), 'r') as fascicles_file:
+                self.assertIn(' 1.0000000e+01\n', fascicles_file.read())
+        finally:
+            shutil.rmtree(output_directory)
+
+        fascicle_node_range, fascicle_element_range = segment_result['identifier_ranges']['fascicle']
+        self.assertEqual(list(ex_data['node_groups']['fascicle']), list(fascicle_node_range))
+        self.assertEqual(list(ex_data['element_groups']['fascicle']), list(fascicle_element_range))
+        self.assertEqual(len(set(ex_data['node_identifiers'])), len(ex_data['node_identifiers']))
+        self.assertEqual(find_disconnected_groups(ex_data)['fascicle'], 2)
+
+    def test_branch_morphology_radius(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        segment_csv_files = find_tracing_csv_files(os.path.join(root_path, "MicroCT"))['CL2']
+        trunk_coordinates, branch_coordinates_data = process_segment_csv_files(segment_csv_files, 110000.0)[2:5:2]
+        branch_name = 'left cervical cardiac branch'
+        # morphology files are looked up for branches only, not the trunk
+        self.assertEqual(sorted(find_branch_group_names(segment_csv_files)), sorted(branch_coordinates_data.keys()))
+
+        output_directory = tempfile.mkdtemp()
+        try:
+            # morphology centres at every 10th point, with diameter increasing along the group
+            morphology_path = os.path.join(output_directory, 'morphology')
+            os.makedirs(morphology_path)
+            for group_name, coordinates in [('left cervical trunk', trunk_coordinates),
+                                            (branch_name, branch_coordinates_data[branch_name])]:
+                file_name = 'SR000-CL2-' + group_name.replace(' ', '_') + '-morphology.csv'
+                with open(os.path.join(morphology_path, file_name), 'w') as f:
+                    f.write('index,area,perimeter,eq_diameter,center_x,center_y,major_axis,minor_axis,angle\n')
+                    for index in range(0, len(coordinates), 10):
+                        x, y, z = coordinates[index]
+                        f.write('%r,1,1,%r,%r,%r,1,1,0\n' % (z, float(index), x, y))
+
+            segment_result = process_segment('CL2', segment_csv_files, None, None, morphology_path, None, 110000.0)
+            branch_radius = segment_result['branch_radius_data'][branch_name]
+            self.assertEqual(list(segment_result['branch_radius_data'].keys()), [branch_name])
+            self.assertEqual(list(branch_radius[::10]), [index / 2 for index in range(0, len(branch_radius), 10)])
+
+            write_segment_result(segment_result, output_directory)
+            ex_data = read_exf_arrays(os.path.join(output_directory, 'CL2.exf'))
+            branch_node_range = segment_result['identifier_ranges'][branch_name][0]
+            node_indices = np.searchsorted(ex_data['node_identifiers'], list(branch_node_range))
+            self.assertEqual(list(ex_data['node_radius'][node_indices]), branch_radius)
+            other_branch_node_range = segment_result['identifier_ranges']['left hypoglossal nerve'][0]
+            self.assertEqual(ex_data['node_radius'][np.searchsorted(ex_data['node_identifiers'],
+                                                                    other_branch_node_range.start)],
+                             segment_result['avg_branch_radius'])
+
+            # streaming writers give the same output
+            with open(os.path.join(output_directory, 'CL2.exf'), 'r') as f:
+                zinc_output = f.read()
+            write_segment_result(segment_result, output_directory, streaming_output=True)
+            with open(os.path.join(output_directory, 'CL2.exf'), 'r') as f:
+                self.assertEqual(f.read(), zinc_output)
+            write_segment_streaming('CL2', segment_csv_files, None, None, morphology_path, None, 110000.0,
+                                    output_directory)
+            with open(os.path.join(output_directory, 'CL2.exf'), 'r') as f:
+                self.assertEqual(f.read(), zinc_output)
+
+            # branch radius is mapped without trunk morphology data, with zero trunk radius
+            os.remove(os.path.join(morphology_path, 'SR000-CL2-left_cervical_trunk-morphology.csv'))
+            segment_result = process_segment('CL2', segment_csv_files, None, None, morphology_path, None, 110000.0)
+            self.assertEqual(list(segment_result['branch_radius_data'][branch_name]), branch_radius)
+            self.assertEqual(list(segment_result['trunk_radius']), [0.0] * len(trunk_coordinates))
+            self.assertIsNone(segment_result['avg_branch_radius'])
+            write_segment_result(segment_result, output_directory)
+            ex_data = read_exf_arrays(os.path.join(output_directory, 'CL2.exf'))
+            self.assertEqual(list(ex_data['node_radius'][node_indices]), branch_radius)
+            with open(os.path.join(output_directory, 'CL2.exf'), 'r') as f:
+                zinc_output = f.read()
+            write_segment_streaming('CL2', segment_csv_files, None, None, morphology_path, None, 110000.0,
+                                    output_directory)
+            with open(os.path.join(output_directory, 'CL2.exf'), 'r') as f:
+                self.assertEqual(f.read(), zinc_output)
+        finally:
+            shutil.rmtree(output_directory)
+
+    def test_nearest_point_search(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        segment_csv_files = find_tracing_csv_files(os.path.join(root_path, "MicroCT"))['CL2']
+        trunk_coordinates, branch_coordinates_data = process_segment_csv_files(segment_csv_files, 110000.0)[2:5:2]
+        reference_points = np.array(trunk_coordinates, dtype=np.float64)
+        # repeated points, more than the k-d tree candidates, so the last of equally close points must be found
+        reference_points = np.concatenate([reference_points, np.repeat(reference_points[::50], 10, axis=0),
+                                           reference_points[::-7]])
+        points = np.concatenate([np.array(branch_coordinates_data['left cervical cardiac branch']),
+                                 reference_points[::3], reference_points[::11] + 0.5])
+
+        nearest_indices = find_nearest_point_indices(points, reference_points)
+        for point, nearest_index in zip(points, nearest_indices):
+            distances_squared = np.sum((reference_points - point) ** 2, axis=1)
+            self.assertEqual(nearest_index, np.flatnonzero(distances_squared == np.min(distances_squared))[-1])
+
+    def test_stream_segment_groups(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        microct_path = os.path.join(root_path, "MicroCT")
+        segment_csv_files = find_tracing_csv_files(microct_path)['CL2']
+        _, vagus_branch_terms = read_anatomy_data(None)
+        vagus_orientations = {'left cervical cardiac branch': 'anterior', 'left hypoglossal nerve': 'lateral'}
+
+        output_directory = tempfile.mkdtemp()
+        try:
+            segment_directory = os.path.join(output_directory, 'segment')
+            streaming_directory = os.path.join(output_directory, 'streaming')
+            os.makedirs(segment_directory)
+            os.makedirs(streaming_directory)
+            segment_result = process_segment('CL2', segment_csv_files, vagus_orientations, vagus_branch_terms,
+                                             None, None, 110000.0)
+            write_segment_result(segment_result, segment_directory, streaming_output=True)
+            write_segment_streaming('CL2', segment_csv_files, vagus_orientations, vagus_branch_terms, None, None,
+                                    110000.0, streaming_directory)
+            for file_name in ['CL2.exf', 'CL2-identifiers.csv', 'CL2-marker-projections.csv']:
+                with open(os.path.join(segment_directory, file_name), 'r') as segment_output, \
+                        open(os.path.join(streaming_directory, file_name), 'r') as streaming_output:
+                    self.assertEqual(segment_output.read(), streaming_output.read())
+        finally:
+            shutil.rmtree(output_directory)
+
+    def test_marker_trunk_projection(self):
+        trunk_coordinates = [[0.0, 0.0, 0.0], [10.0, 0.0, 0.0], [10.0, 0.0, 0.0], [10.0, 10.0, 0.0]]
+        marker_data = {'a': [4.0, 3.0, 0.0], 'b': [12.0, 6.0, 0.0], 'c': [-5.0, 1.0, 0.0]}
+        self.assertEqual(project_markers_to_trunk(marker_data, trunk_coordinates), {
+            'a': (0, 0, 0.4, 4.0, [4.0, 0.0, 0.0]),
+            'b': (3, 2, 0.6, 16.0, [10.0, 6.0, 0.0]),
+            'c': (0, 0, 0.0, 0.0, [0.0, 0.0, 0.0])})
+        self.assertEqual(project_markers_to_trunk(marker_data, trunk_coordinates[:1])['b'],
+                         (0, None, None, 0.0, [0.0, 0.0, 0.0]))
+
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        segment_csv_files = find_tracing_csv_files(os.path.join(root_path, "MicroCT"))['CR1']
+        segment_result = process_segment('CR1', segment_csv_files, None, None, None, None, 110000.0)
+        output_directory = tempfile.mkdtemp()
+        try:
+            write_segment_result(segment_result, output_directory)
+            marker_projections = read_marker_projections(os.path.join(output_directory, 'CR1-marker-projections.csv'))
+            self.assertEqual(list(marker_projections.keys()), list(segment_result['marker_data'].keys()))
+            ex_data = read_exf_arrays(os.path.join(output_directory, 'CR1.exf'))
+            trunk_node_identifiers = ex_data['node_groups']['right cervical trunk']
+            trunk_points = ex_data['node_coordinates'][np.searchsorted(ex_data['node_identifiers'],
+                                                                       trunk_node_identifiers)]
+            trunk_length = np.sum(np.linalg.norm(np.diff(trunk_points, axis=0), axis=1))
+            for marker_name, (node_identifier, element_identifier, xi, arc_length, projected_point) in \
+                    marker_projections.items():
+                marker_point = np.array(segment_result['marker_data'][marker_name])
+                distances_squared = np.sum((trunk_points - marker_point) ** 2, axis=1)
+                self.assertEqual(node_identifier, trunk_node_identifiers[np.argmin(distances_squared)])
+                self.assertIn(element_identifier, ex_data['element_groups']['right cervical trunk'])
+                self.assertTrue(0.0 <= arc_length <= trunk_length)
+                self.assertLessEqual(np.sum((np.array(projected_point) - marker_point) ** 2),
+                                     np.min(distances_squared))
+        finally:
+            shutil.rmtree(output_directory)
+
+    def test_read_exf_arrays(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        microct_path = os.path.join(root_path, "MicroCT")
+        segment_results = {segment_result['segment_name']: segment_result
+                           for segment_result in process_dataset(None, microct_path, None, None, 110000.0)}
+        cl2_result = segment_results['CL2']
+
+        output_directory = tempfile.mkdtemp()
+        try:
+            write_segment_result(cl2_result, output_directory)
+            ex_data = read_exf_arrays(os.path.join(output_directory, 'CL2.exf'))
+        finally:
+            shutil.rmtree(output_directory)
+
+        node_count = next_free_identifiers(cl2_result['identifier_ranges'])[0] - 1
+        self.assertEqual(len(ex_data['node_identifiers']), node_count)
+        self.assertEqual(ex_data['node_coordinates'].shape, (node_count, 3))
+        self.assertEqual(ex_data['element_nodes'].shape, (len(ex_data['element_identifiers']), 2))
+        self.assertEqual(get_group_node_counts(ex_data)['left cervical trunk'], 7676)
+        self.assertEqual(list(ex_data['marker_names']), list(cl2_result['marker_data'].keys()))
+        minimum, maximum = get_group_bounding_boxes(ex_data)['left cervical trunk']
+        trunk_coordinates = cl2_result['trunk_coordinates']
+        for i in range(3):
+            self.assertAlmostEqual(minimum[i], min(point[i] for point in trunk_coordinates), places=6)
+            self.assertAlmostEqual(maximum[i], max(point[i] for point in trunk_coordinates), places=6)
+        self.assertEqual(find_disconnected_groups(ex_data), {})
+
+    def test_work_queue_workers(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        microct_path = os.path.join(root_path, "MicroCT")
+        queue_directory = tempfile.mkdtemp()
+        output_directory = tempfile.mkdtemp()
+        try:
+            # claim left by a worker which died long ago
+            stale_claim_file = os.path.join(queue_directory, 'TR1.claim')
+            with open(stale_claim_file, 'w') as f:
+                f.write('dead-worker\n')
+            stale_time = time.time() - 3600.0
+            os.utime(stale_claim_file, (stale_time, stale_time))
+
+            with ProcessPoolExecutor(max_workers=3) as executor:
+                worker_futures = [executor.submit(run_worker, None, microct_path, None, None, output_directory,
+                                                  110000.0, queue_directory, {'worker_name': 'worker' + str(i)},
+                                                  heartbeat_interval=0.5, stale_timeout=60.0, poll_interval=0.1)
+                                  for i in range(3)]
+                worker_output_files = [future.result() for future in worker_futures]
+
+            output_files = sorted(os.path.basename(output_file) for output_files in worker_output_files
+                                  for output_file in output_files)
+            # each segment is processed by exactly one worker
+            self.assertEqual([f for f in output_files if not f.endswith('.csv')],
+                             ['CL2.exf', 'CR1.exf', 'TL1.exf', 'TR1.exf'])
+            self.assertEqual(sorted(os.listdir(queue_directory)),
+                             sorted(segment_name + suffix for segment_name in ['CL2', 'CR1', 'TL1', 'TR1']
+                                    for suffix in ['.done', '.manifest']))
+            self.assertEqual(sorted(os.listdir(output_directory)), sorted(output_files))
+            # manifests list the files published for each segment
+            manifest_file_names = []
+            for segment_name in ['CL2', 'CR1', 'TL1', 'TR1']:
+                with open(os.path.join(queue_directory, segment_name + '.manifest'), 'r') as f:
+                    manifest_file_names.extend(f.read().split())
+            self.assertEqual(sorted(manifest_file_names), sorted(output_files))
+        finally:
+            shutil.rmtree(queue_directory)
+            shutil.rmtree(output_directory)
+
+    def test_work_queue_claim_ownership(self):
+        queue_directory = tempfile.mkdtemp()
+        try:
+            claim_file, claim_token = claim_work_item(queue_directory, 'CL2', 'worker0')
+            self.assertTrue(owns_work_item(claim_file, claim_token))
+            self.assertIsNone(claim_work_item(queue_directory, 'CL2', 'worker1'))
+
+            # claim goes stale and is taken over by another worker
+            stale_time = time.time() - 3600.0
+            os.utime(claim_file, (stale_time, stale_time))
+            stop_heartbeat = start_heartbeat(claim_file, claim_token, 0.05)
+            other_claim_file, other_claim_token = claim_work_item(queue_directory, 'CL2', 'worker1', 60.0)
+            self.assertEqual(other_claim_file, claim_file)
+            self.assertFalse(owns_work_item(claim_file, claim_token))
+            time.sleep(0.2)
+            stop_heartbeat.set()
+
+            # the first worker must not remove the claim of the second
+            self.assertFalse(release_work_item(claim_file, claim_token))
+            self.assertTrue(owns_work_item(other_claim_file, other_claim_token))
+            self.assertTrue(release_work_item(other_claim_file, other_claim_token))
+            self.assertEqual(os.listdir(queue_directory), [])
+
+            # failed work items are claimed again until they have failed max_attempts times
+            for attempt in range(2):
+                claim_file, claim_token = claim_work_item(queue_directory, 'CL2', 'worker0', max_attempts=2)
+                fail_work_item(queue_directory, 'CL2', 'worker0', claim_file, claim_token, 'error')
+            self.assertTrue(is_work_item_finished(queue_directory, 'CL2'))
+            self.assertTrue(is_work_item_finished(queue_directory, 'CL2', max_attempts=2))
+            self.assertFalse(is_work_item_finished(queue_directory, 'CL2', max_attempts=3))
+            self.assertIsNone(claim_work_item(queue_directory, 'CL2', 'worker0', max_attempts=2))
+            self.assertEqual(sorted(os.listdir(queue_directory)), ['CL2.failed.1', 'CL2.failed.2'])
+        finally:
+            shutil.rmtree(queue_directory)
+
+    def test_float32_precision(self):
+        root_path = os.path.join(here, "resources", "sub-SR000")
+        microct_path = os.path.join(root_path, "MicroCT")
+        segment_files = find_tracing_csv_files(microct_path)
+        _, _, trunk_coordinates, branch_names, branch_coordinates_data, branch_parent_indices = \
+            process_segment_csv_files(segment_files['CR1'], 110000.0)
+        _, _, trunk_coordinates_32, branch_names_32, branch_coordinates_data_32, branch_parent_indices_32 = \
+            process_segment_csv_files(segment_files['CR1'], 110000.0, dtype='float32')
+
+        self.assertEqual(trunk_coordinates_32.dtype.name, 'float32')
+        self.assertEqual(trunk_coordinates_32.shape, (len(trunk_coordinates), 3))
+        self.assertEqual(branch_names_32, branch_names)
+        self.assertEqual(branch_parent_indices_32, branch_parent_indices)
+        for branch_name in branch_names:
+            self.assertEqual(len(branch_coordinates_data_32[branch_name]), len(branch_coordinates_data[branch_name]))
+            for i in range(3):
+                self.assertAlmostEqual(float(branch_coordinates_data_32[branch_name][0][i]),
+                                       branch_coordinates_data[branch_name][0][i], delta=1.0e-3)
+
+        self.assertEqual(format_ex_real(1065.9497070312502), '  1.065949707031250e+03')
+        self.assertEqual(format_ex_real(1065.9497070312502, 8), ' 1.0659497e+03')
+
+        # float32 working storage is written the same by Zinc and the streaming writer
+        segment_result = process_segment('CR1', segment_files['CR1'], None, None, None, None, 110000.0,
+                                         dtype='float32')
+        output_directory = tempfile.mkdtemp()
+        try:
+            write_segment_result(segment_result, output_directory)
+            with open(os.path.join(output_directory, 'CR1.exf'), 'r') as f:
+                zinc_output = f.read()
+            write_segment_result(segment_result, output_directory, streaming_output=True)
+            with open(os.path.join(output_directory, 'CR1.exf'), 'r') as f:
+                self.assertEqual(f.read(), zinc_output)
+
+            # whole dataset through the default Zinc writer
+            output_files = main(None, microct_path, None, None, output_directory, 110000.0, {'dtype': 'float32'})
+            self.assertEqual(sorted(os.path.basename(output_file) for output_file in output_files),
+                             ['CL2.exf', 'CR1.exf', 'TL1.exf', 'TR1.exf'])
+            # misspelt options are not silently ignored
+            with self.assertRaises(ValueError):
+                main(None, microct_path, None, None, output_directory, 110000.0, {'stage_worker': 4})
+        finally:
+            shutil.rmtree(output_directory)
 
+    def test_run_stages(self):
+        stages = {
+            'sum': (lambda a, b: a + b, ['a', 'b']),
+            'a': (lambda: 2, []),
+            'b': (lambda a: a * 10, ['a'])
+        }
+        self.assertEqual(run_stages(stages), {'a': 2, 'b': 20, 'sum': 22})
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(run_stages(stages, executor), {'a': 2, 'b': 20, 'sum': 22})
+        with self.assertRaises(ValueError):
+            run_stages({'a': (lambda b: b, ['b']), 'b': (lambda a: a, ['a'])})
 
     def test_vagus_merge_output(self):
         """
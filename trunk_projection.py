@@ -0,0 +1,106 @@
+import csv
+
+import numpy as np
+
+from nerve_morphology import find_nearest_point_indices
+
+
+def project_points_to_polyline(points, polyline_coordinates, chunk_size=2 ** 18):
+    """
+    Project many points onto a polyline at once, in chunks of points so that the point to line segment arrays
+    stay below chunk_size values.
+    :param points: list or array of x, y, z coordinates to project
+    :param polyline_coordinates: list or array of at least 2 x, y, z coordinates along the polyline
+    :param chunk_size: maximum number of point to line segment projections calculated at once
+    :return: array with index of the line segment each point is closest to, array of xi from 0.0 at the start to
+        1.0 at the end of that line segment, array of arc length along the polyline to the projections,
+        N x 3 array of projected coordinates. Calculated in double precision.
+    """
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    polyline_points = np.asarray(polyline_coordinates, dtype=np.float64).reshape(-1, 3)
+    segment_starts = polyline_points[:-1]
+    segment_vectors = polyline_points[1:] - segment_starts
+    segment_lengths_squared = np.sum(segment_vectors ** 2, axis=1)
+    segment_lengths = np.sqrt(segment_lengths_squared)
+    start_arc_lengths = np.concatenate([[0.0], np.cumsum(segment_lengths)[:-1]])
+    # repeated polyline points give zero length line segments, which project onto their start
+    inverse_lengths_squared = np.divide(1.0, segment_lengths_squared, out=np.zeros_like(segment_lengths_squared),
+                                        where=segment_lengths_squared > 0.0)
+
+    segment_indices = np.zeros(len(points), dtype=np.intp)
+    xi = np.zeros(len(points))
+    points_per_chunk = max(1, chunk_size // max(1, len(segment_starts)))
+    for start in range(0, len(points), points_per_chunk):
+        offsets = points[start:start + points_per_chunk, np.newaxis, :] - segment_starts[np.newaxis, :, :]
+        chunk_xi = np.clip(np.einsum('ijk,jk->ij', offsets, segment_vectors) * inverse_lengths_squared, 0.0, 1.0)
+        offsets -= chunk_xi[:, :, np.newaxis] * segment_vectors[np.newaxis, :, :]
+        chunk_segment_indices = np.argmin(np.einsum('ijk,ijk->ij', offsets, offsets), axis=1)
+        segment_indices[start:start + points_per_chunk] = chunk_segment_indices
+        xi[start:start + points_per_chunk] = chunk_xi[np.arange(len(chunk_xi)), chunk_segment_indices]
+
+    arc_lengths = start_arc_lengths[segment_indices] + xi * segment_lengths[segment_indices]
+    projected_points = segment_starts[segment_indices] + xi[:, np.newaxis] * segment_vectors[segment_indices]
+    return segment_indices, xi, arc_lengths, projected_points
+
+
+def project_markers_to_trunk(marker_data, trunk_coordinates):
+    """
+    Find the nearest trunk node and the projection onto the trunk of all markers in one batched query.
+    :param marker_data: dict mapping marker names to marker x, y, z coordinates
+    :param trunk_coordinates: list or array with x, y, z trunk coordinates
+    :return: Dict mapping marker name to (index of nearest trunk point, index of trunk element the marker projects
+        onto, xi on that element, arc length along the trunk from its first point, list of projected x, y, z).
+        Element index and xi are None if the trunk has a single point. Empty if there are no trunk points.
+    """
+
+    if len(marker_data) == 0 or len(trunk_coordinates) == 0:
+        return {}
+
+    marker_names = list(marker_data.keys())
+    marker_points = [marker_data[marker_name] for marker_name in marker_names]
+    nearest_indices = find_nearest_point_indices(marker_points, trunk_coordinates)
+    if len(trunk_coordinates) < 2:
+        trunk_point = [float(x) for x in trunk_coordinates[0]]
+        return {marker_name: (0, None, None, 0.0, trunk_point) for marker_name in marker_names}
+
+    element_indices, xi, arc_lengths, projected_points = project_points_to_polyline(marker_points, trunk_coordinates)
+    return {marker_name: (int(nearest_indices[index]), int(element_indices[index]), float(xi[index]),
+                          float(arc_lengths[index]), [float(x) for x in projected_points[index]])
+            for index, marker_name in enumerate(marker_names)}
+
+
+def write_marker_projections(output_file, marker_projections, trunk_identifier_ranges):
+    """
+    :param output_file: location of the csv file with marker projections
+    :param marker_projections: Dict from project_markers_to_trunk
+    :param trunk_identifier_ranges: (node identifier range, element identifier range) of the trunk in the output
+    """
+
+    trunk_node_range, trunk_element_range = trunk_identifier_ranges
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(['marker', 'nearest node', 'element', 'xi', 'arc length', 'x', 'y', 'z'])
+        for marker_name, (node_index, element_index, xi, arc_length, projected_point) in marker_projections.items():
+            element_identifier = '' if element_index is None else trunk_element_range.start + element_index
+            writer.writerow([marker_name, trunk_node_range.start + node_index, element_identifier,
+                             '' if xi is None else repr(xi), repr(arc_length)] +
+                            [repr(x) for x in projected_point])
+
+
+def read_marker_projections(marker_projections_file):
+    """
+    :param marker_projections_file: location of the csv file written by write_marker_projections
+    :return: Dict mapping marker name to (nearest trunk node identifier, trunk element identifier or None,
+        xi or None, arc length, list of projected x, y, z).
+    """
+
+    marker_projections = {}
+    with open(marker_projections_file, 'r') as csvfile:
+        plots = csv.reader(csvfile, delimiter=',')
+        next(plots, None)  # skip headers
+        for row in plots:
+            marker_projections[row[0]] = (int(row[1]), int(row[2]) if row[2] else None,
+                                          float(row[3]) if row[3] else None, float(row[4]),
+                                          [float(x) for x in row[5:8]])
+    return marker_projections
@@ -0,0 +1,227 @@
+import os
+import csv
+import mmap
+
+import numpy as np
+
+from csv_processing import classify_csv_group, csv_file_group_name, find_trunk_group_name, branch_keywords
+from dataset_files import dataset_basename, has_dataset_extension, compressed_extension, is_dataset_dir, \
+    list_dataset_dirs, open_dataset_file, walk_dataset
+from nerve_morphology import find_trunk_morphology_file_for_segment
+
+
+segment_labels = ('CL', 'CR', 'TL', 'TR')
+# columns read from each kind of csv file, by position
+marker_columns = 4
+coordinate_columns = 4
+# index, area, perimeter, eq_diameter, center_x, center_y, whatever the header names
+morphology_columns = 6
+# positions of values read from morphology rows with an area, with their usual names
+morphology_value_columns = {0: 'index', 3: 'eq_diameter', 4: 'center_x', 5: 'center_y'}
+
+_newline = ord('\n')
+_separator = ord(',')
+
+
+def _count_bytes(data, chunk_size=2 ** 26):
+    """
+    :param data: bytes, or mmap of a file
+    :return: number of newlines, number of commas, True if the data ends with a newline or is empty.
+    """
+
+    values = np.frombuffer(data, dtype=np.uint8)
+    newline_count = 0
+    separator_count = 0
+    # in chunks, so the comparison arrays stay small for large files
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        newline_count += int(np.count_nonzero(chunk == _newline))
+        separator_count += int(np.count_nonzero(chunk == _separator))
+    ends_with_newline = (len(values) == 0) or (values[-1] == _newline)
+    del values, chunk
+    return newline_count, separator_count, ends_with_newline
+
+
+def scan_csv_file(csv_file):
+    """
+    Read the header and count rows and separators of a csv file without parsing it. Plain local files are
+    memory mapped, other files (archive members, gzip compressed or remote) are read into memory.
+    :param csv_file: path to the csv file
+    :return: list of header column names, number of rows after the header, number of commas after the header.
+    """
+
+    if os.path.isfile(csv_file) and not csv_file.endswith(compressed_extension):
+        with open(csv_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return [], 0, 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                header_end = data.find(b'\n')
+                header_line = data[:header_end if header_end >= 0 else len(data)]
+                newline_count, separator_count, ends_with_newline = _count_bytes(data)
+    else:
+        with open_dataset_file(csv_file, 'rb') as f:
+            data = f.read()
+        if not data:
+            return [], 0, 0
+        header_end = data.find(b'\n')
+        header_line = data[:header_end if header_end >= 0 else len(data)]
+        newline_count, separator_count, ends_with_newline = _count_bytes(data)
+
+    header = next(csv.reader([header_line.decode('utf-8', errors='replace').rstrip('\r')]), [])
+    line_count = newline_count + (0 if ends_with_newline else 1)
+    return header, line_count - 1, separator_count - header_line.count(b',')
+
+
+def _check_columns(csv_file, header, row_count, separator_count, required_columns):
+    """
+    :return: list of problems with the column counts of the csv file.
+    """
+
+    problems = []
+    if len(header) < required_columns:
+        problems.append(csv_file + ': header has ' + str(len(header)) + ' columns, at least ' +
+                        str(required_columns) + ' needed')
+    elif separator_count != row_count * (len(header) - 1):
+        # commas in quoted values also show up here, but are not used in these files
+        problems.append(csv_file + ': ' + str(separator_count) + ' separators for ' + str(row_count) + ' rows of ' +
+                        str(len(header)) + ' columns, some rows have missing or extra columns or are empty')
+    return problems
+
+
+def validate_segment_csv_files(segment_name, csv_files):
+    """
+    :param segment_name: name of the dataset segment (i.e. CL1)
+    :param csv_files: list with paths to csv files of the segment
+    :return: list of problems found, as text.
+    """
+
+    problems = []
+    if not csv_files:
+        return ['segment ' + segment_name + ': no csv files']
+
+    side_label = 'left' if 'CL' in csv_files[0] or 'TL' in csv_files[0] else 'right'
+    trunk_group_name = find_trunk_group_name(csv_files)
+    if trunk_group_name is None:
+        problems.append('segment ' + segment_name + ': no trunk csv file found from file names')
+    elif not trunk_group_name.startswith(side_label):
+        problems.append('segment ' + segment_name + ': trunk ' + trunk_group_name + ' is not on the ' + side_label +
+                        ' side of the segment')
+
+    trunk_file_names = [os.path.basename(csv_file) for csv_file in csv_files
+                        if classify_csv_group(csv_file_group_name(csv_file), side_label) == 'trunk']
+    if len(trunk_file_names) > 1:
+        problems.append('segment ' + segment_name + ': several trunk csv files, only ' + str(trunk_group_name) +
+                        ' is used: ' + ', '.join(trunk_file_names))
+
+    group_files = {}
+    for csv_file in csv_files:
+        if '-' not in os.path.basename(csv_file):
+            problems.append(csv_file + ': file name has no group name after a -')
+            continue
+        group_name = csv_file_group_name(csv_file)
+        group_type = classify_csv_group(group_name, side_label)
+        if group_type is None:
+            if not any(keyword in group_name.lower() for keyword in branch_keywords):
+                problems.append(csv_file + ': group ' + group_name + ' is not a marker, trunk or branch file')
+            continue
+        if group_type != 'marker' and group_name in group_files:
+            problems.append(csv_file + ': group ' + group_name + ' is also in ' + group_files[group_name])
+        group_files[group_name] = csv_file
+
+        header, row_count, separator_count = scan_csv_file(csv_file)
+        if group_type == 'marker':
+            problems.extend(_check_columns(csv_file, header, row_count, separator_count, marker_columns))
+            continue
+        problems.extend(_check_columns(csv_file, header, row_count, separator_count, coordinate_columns))
+        if group_type == 'trunk' and group_name == trunk_group_name and row_count < 2:
+            problems.append(csv_file + ': trunk has ' + str(row_count) + ' rows, at least 2 needed')
+        elif group_type == 'branch' and row_count < 2:
+            # stitching starts from the second branch point
+            problems.append(csv_file + ': branch has ' + str(row_count) + ' rows, at least 2 needed')
+
+    return problems
+
+
+def validate_morphology_file(morphology_file_path):
+    """
+    Check the columns read by position from a morphology file hold numbers, as header names are not used.
+    :param morphology_file_path: path to the csv morphology file
+    :return: list of problems found, as text.
+    """
+
+    header, row_count, separator_count = scan_csv_file(morphology_file_path)
+    problems = _check_columns(morphology_file_path, header, row_count, separator_count, morphology_columns)
+    if problems:
+        return problems
+    if row_count == 0:
+        return [morphology_file_path + ': no rows']
+
+    # rows without an area are skipped when reading
+    value_row_count = 0
+    invalid_line_numbers = []
+    with open_dataset_file(morphology_file_path) as csvfile:
+        rows = csv.reader(csvfile, delimiter=',')
+        next(rows, None)
+        for line_number, row in enumerate(rows, start=2):
+            if len(row) > 1 and row[1] == '':
+                continue
+            value_row_count += 1
+            try:
+                for position in morphology_value_columns.keys():
+                    float(row[position])
+            except (IndexError, ValueError):
+                invalid_line_numbers.append(line_number)
+    if invalid_line_numbers:
+        problems.append(morphology_file_path + ': ' + str(len(invalid_line_numbers)) + ' rows without numbers in '
+                        'columns ' + ', '.join(str(position + 1) + ' (' + column_name + ')'
+                                               for position, column_name in morphology_value_columns.items()) +
+                        ', first on line ' + str(invalid_line_numbers[0]))
+    elif value_row_count == 0:
+        problems.append(morphology_file_path + ': no rows with an area')
+    return problems
+
+
+def validate_dataset(microct_path, nerve_morphology_path=None):
+    """
+    Pre-flight scan of the dataset files, reading only file names, csv headers and row counts, so problems
+    which would otherwise only fail late in processing are all reported before processing starts.
+    :param microct_path: path to the folder with csv segmentation files
+    :param nerve_morphology_path: optional path to the folder with csv morphology files
+    :return: list of problems found, as text. Empty if the dataset can be processed.
+    """
+
+    if not is_dataset_dir(microct_path):
+        return [str(microct_path) + ': microct folder not found']
+
+    problems = []
+    segment_folders = {}
+    for segment_path in list_dataset_dirs(microct_path):
+        segment_filename = dataset_basename(segment_path)
+        segment_names = [name for name in segment_filename.split('-') if any(label in name for label in segment_labels)]
+        if not segment_names:
+            problems.append(segment_path + ': segment folder name has no ' + '/'.join(segment_labels) + ' label')
+            continue
+        segment_name = segment_names[0]
+        if segment_name in segment_folders:
+            problems.append(segment_path + ': segment ' + segment_name + ' is also in ' +
+                            segment_folders[segment_name])
+            continue
+        segment_folders[segment_name] = segment_path
+
+        csv_files = []
+        for rootpath, dirs, files in walk_dataset(segment_path):
+            csv_files.extend([os.path.join(rootpath, f) for f in files if has_dataset_extension(f, '.csv')])
+        segment_problems = validate_segment_csv_files(segment_name, csv_files)
+        problems.extend(segment_problems)
+
+        trunk_group_name = find_trunk_group_name(csv_files) if csv_files else None
+        if nerve_morphology_path and trunk_group_name:
+            morphology_file_path = find_trunk_morphology_file_for_segment(nerve_morphology_path, segment_name,
+                                                                          trunk_group_name)
+            if morphology_file_path:
+                problems.extend(validate_morphology_file(morphology_file_path))
+
+    if not segment_folders:
+        problems.append(str(microct_path) + ': no segment folders found')
+
+    return problems
@@ -0,0 +1,353 @@
+import os
+import time
+import socket
+import shutil
+import threading
+import traceback
+import uuid
+
+from csv_processing import find_tracing_csv_files
+from dataset_files import prefetch_dataset_files
+from pipeline import get_processing_options, process_segment, read_anatomy_data, write_segment_result, \
+    write_segment_streaming
+
+
+def get_default_worker_name():
+    """
+    :return: name identifying this worker process across hosts sharing the queue folder.
+    """
+
+    return socket.gethostname() + '-' + str(os.getpid())
+
+
+def _claim_file(queue_directory, item_name):
+    return os.path.join(queue_directory, item_name + '.claim')
+
+
+def _done_file(queue_directory, item_name):
+    return os.path.join(queue_directory, item_name + '.done')
+
+
+def _failed_file(queue_directory, item_name, attempt):
+    return os.path.join(queue_directory, item_name + '.failed.' + str(attempt))
+
+
+def _manifest_file(queue_directory, item_name):
+    return os.path.join(queue_directory, item_name + '.manifest')
+
+
+def count_failed_attempts(queue_directory, item_name):
+    """
+    :return: number of attempts at the work item which failed, from its numbered failed files.
+    """
+
+    attempt_count = 0
+    while os.path.exists(_failed_file(queue_directory, item_name, attempt_count + 1)):
+        attempt_count += 1
+    return attempt_count
+
+
+def is_work_item_finished(queue_directory, item_name, max_attempts=1):
+    """
+    :param max_attempts: number of failed attempts after which the work item is not tried again
+    :return: True if the work item was completed or failed max_attempts times.
+    """
+
+    return os.path.exists(_done_file(queue_directory, item_name)) or \
+        count_failed_attempts(queue_directory, item_name) >= max_attempts
+
+
+def _write_file_atomically(file_path, text):
+    """
+    Write text to a temporary file next to file_path and rename it into place, so other hosts never see a
+    partially written file.
+    """
+
+    temporary_file = file_path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(temporary_file, 'w') as f:
+        f.write(text)
+    os.replace(temporary_file, file_path)
+
+
+def reclaim_stale_claim(claim_file, stale_timeout):
+    """
+    Remove a claim whose worker has not sent a heartbeat for stale_timeout seconds.
+    Hosts must have synchronised clocks, as heartbeats are file modification times.
+    :param claim_file: path to the claim file
+    :param stale_timeout: seconds without heartbeat after which a claim is stale
+    :return: True if the claim file no longer exists, so the work item can be claimed again.
+    """
+
+    try:
+        if time.time() - os.stat(claim_file).st_mtime < stale_timeout:
+            return False
+    except FileNotFoundError:
+        return True
+
+    # rename is atomic, so only one worker can take over a stale claim
+    stale_file = claim_file + '.' + uuid.uuid4().hex + '.stale'
+    try:
+        os.rename(claim_file, stale_file)
+    except FileNotFoundError:
+        return True
+
+    # another worker may have reclaimed the item between the check and the rename, so put a fresh claim back
+    if time.time() - os.stat(stale_file).st_mtime < stale_timeout:
+        try:
+            os.link(stale_file, claim_file)
+        except FileExistsError:
+            pass
+        os.remove(stale_file)
+        return False
+
+    os.remove(stale_file)
+    return True
+
+
+def claim_work_item(queue_directory, item_name, worker_name, stale_timeout=300.0, max_attempts=1):
+    """
+    Try to claim a work item by atomically creating its lock file in the shared queue folder.
+    :param queue_directory: folder shared by all workers
+    :param item_name: name of the work item, e.g. segment name
+    :param worker_name: name of this worker, written into the claim file
+    :param stale_timeout: seconds without heartbeat after which a claim of another worker is taken over
+    :param max_attempts: number of failed attempts after which the work item is not claimed again
+    :return: (path to the claim file, claim token written into it) if claimed, otherwise None.
+    """
+
+    if is_work_item_finished(queue_directory, item_name, max_attempts):
+        return None
+
+    claim_file = _claim_file(queue_directory, item_name)
+    try:
+        fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not reclaim_stale_claim(claim_file, stale_timeout):
+            return None
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+    # unique to this claim, so a worker can tell its claim from a later claim of the same item by another worker
+    claim_token = worker_name + '\n' + uuid.uuid4().hex + '\n'
+    with os.fdopen(fd, 'w') as f:
+        f.write(claim_token)
+
+    # the item may have been finished by the worker whose claim was just released
+    if is_work_item_finished(queue_directory, item_name, max_attempts):
+        release_work_item(claim_file, claim_token)
+        return None
+
+    return claim_file, claim_token
+
+
+def _read_claim_token(claim_file):
+    """
+    :return: contents of the claim file, or None if it does not exist.
+    """
+
+    try:
+        with open(claim_file, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def owns_work_item(claim_file, claim_token):
+    """
+    :return: True if the claim file still holds this worker's claim, False if it was taken over or removed.
+    """
+
+    return _read_claim_token(claim_file) == claim_token
+
+
+def release_work_item(claim_file, claim_token):
+    """
+    Remove the claim file so the work item can be claimed again, only if it still holds this worker's claim.
+    :return: True if the claim was released, False if it was no longer owned.
+    """
+
+    # rename is atomic, so the claim file checked is the one removed
+    released_file = claim_file + '.' + uuid.uuid4().hex + '.released'
+    try:
+        os.rename(claim_file, released_file)
+    except FileNotFoundError:
+        return False
+    if _read_claim_token(released_file) == claim_token:
+        os.remove(released_file)
+        return True
+
+    # claim of another worker, put it back
+    try:
+        os.link(released_file, claim_file)
+    except FileExistsError:
+        pass
+    os.remove(released_file)
+    return False
+
+
+def start_heartbeat(claim_file, claim_token, heartbeat_interval=30.0):
+    """
+    Start a thread touching the claim file every heartbeat_interval seconds, so other workers know it is alive.
+    The heartbeat stops when the claim is no longer owned; the worker must check owns_work_item before publishing.
+    :return: threading.Event to set to stop the heartbeat.
+    """
+
+    stop_event = threading.Event()
+
+    def heartbeat():
+        while not stop_event.wait(heartbeat_interval):
+            if not owns_work_item(claim_file, claim_token):
+                print('Warning: claim', claim_file, 'was taken over by another worker.')
+                return
+            try:
+                os.utime(claim_file)
+            except FileNotFoundError:
+                print('Warning: claim', claim_file, 'was taken over by another worker.')
+                return
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return stop_event
+
+
+def complete_work_item(queue_directory, item_name, worker_name, claim_file, claim_token):
+    """
+    Mark a claimed work item as done and remove its claim. Call after its output files are published.
+    """
+
+    _write_file_atomically(_done_file(queue_directory, item_name), worker_name + '\n')
+    release_work_item(claim_file, claim_token)
+
+
+def fail_work_item(queue_directory, item_name, worker_name, claim_file, claim_token, error_text):
+    """
+    Record a failed attempt at a claimed work item with the error text in the next numbered failed file, and remove
+    its claim. Workers retry the item until it has failed their max_attempts times.
+    """
+
+    attempt = count_failed_attempts(queue_directory, item_name) + 1
+    _write_file_atomically(_failed_file(queue_directory, item_name, attempt), worker_name + '\n' + error_text)
+    release_work_item(claim_file, claim_token)
+
+
+def publish_output_files(partial_directory, output_directory, manifest_file):
+    """
+    Move all files from partial_directory into output_directory with atomic renames, then remove partial_directory.
+    The names of the files are first written to manifest_file, so the complete list of files being published is
+    known if the worker stops part way through. Both folders must be on the same file system.
+    :return: list of published file paths.
+    """
+
+    file_names = sorted(os.listdir(partial_directory))
+    _write_file_atomically(manifest_file, ''.join(file_name + '\n' for file_name in file_names))
+    output_files = []
+    for file_name in file_names:
+        output_file = os.path.join(output_directory, file_name)
+        os.replace(os.path.join(partial_directory, file_name), output_file)
+        output_files.append(output_file)
+    os.rmdir(partial_directory)
+    return output_files
+
+
+def run_worker(anatomy_file_path, microct_path, nerve_morphology_path, fascicle_path, output_directory,
+               stitching_tolerance, queue_directory, options=None, executor=None, heartbeat_interval=30.0,
+               stale_timeout=300.0, poll_interval=None):
+    """
+    Process segments as a worker sharing a queue folder with other workers, on this host or other hosts with the
+    same shared file system. Each segment is a work item claimed with a lock file in the queue folder, kept alive
+    with heartbeats while it is processed. Claims without heartbeat for stale_timeout seconds are taken over.
+    Output files are written to a partial folder and renamed into output_directory when complete, if the claim is
+    still owned; otherwise the segment is left to the worker which took over the claim. The segment is only marked
+    done once a manifest of its output files is in the queue folder, all files are published, and the claim is
+    still owned afterwards. Failed segments are tried again until they have failed max_attempts times.
+    Use one queue folder for each subject.
+    See init.main for the processing parameters.
+    :param queue_directory: folder shared by all workers for the lock files
+    :param options: optional dict of processing options, see init.main. Uses worker_name, by default host name and
+        process id, max_attempts, levels_of_detail, prefetch_workers, streaming_output, dtype, significant_digits
+        and stream_segment_groups.
+    :param executor: optional concurrent.futures executor to run independent segment stages concurrently
+    :param heartbeat_interval: seconds between heartbeats on the claim file
+    :param stale_timeout: seconds without heartbeat after which a claim of another worker is taken over
+    :param poll_interval: seconds to wait before checking segments claimed by other workers again,
+        by default heartbeat_interval
+    :return: list of output file paths written by this worker.
+    """
+
+    options = get_processing_options(options)
+    worker_name = options['worker_name']
+    if worker_name is None:
+        worker_name = get_default_worker_name()
+    max_attempts = options['max_attempts']
+    if poll_interval is None:
+        poll_interval = heartbeat_interval
+    os.makedirs(queue_directory, exist_ok=True)
+
+    vagus_orientations, vagus_branch_terms = read_anatomy_data(anatomy_file_path)
+    segment_files = find_tracing_csv_files(microct_path)
+    if len(segment_files) == 0:
+        print('Warning: no microct files found.')
+
+    output_files = []
+    while True:
+        unfinished_segment_names = [segment_name for segment_name in segment_files.keys()
+                                    if not is_work_item_finished(queue_directory, segment_name, max_attempts)]
+        if not unfinished_segment_names:
+            break
+
+        claimed_count = 0
+        for segment_name in unfinished_segment_names:
+            claim = claim_work_item(queue_directory, segment_name, worker_name, stale_timeout, max_attempts)
+            if claim is None:
+                continue
+            claim_file, claim_token = claim
+            claimed_count += 1
+            print(segment_name, 'claimed by', worker_name)
+            stop_heartbeat = start_heartbeat(claim_file, claim_token, heartbeat_interval)
+            partial_directory = os.path.join(output_directory, '.' + segment_name + '-' + worker_name + '.partial')
+            try:
+                segment_csv_files = segment_files[segment_name]
+                if len(segment_csv_files) == 0:
+                    raise ValueError('No microct files found for segment ' + segment_name)
+                file_buffers = next(prefetch_dataset_files([segment_csv_files], options['prefetch_workers']))
+                os.makedirs(partial_directory, exist_ok=True)
+                if options['stream_segment_groups']:
+                    write_segment_streaming(segment_name, segment_csv_files, vagus_orientations, vagus_branch_terms,
+                                            nerve_morphology_path, fascicle_path, stitching_tolerance,
+                                            partial_directory, file_buffers, options['dtype'],
+                                            options['significant_digits'])
+                else:
+                    segment_result = process_segment(segment_name, segment_csv_files, vagus_orientations,
+                                                     vagus_branch_terms, nerve_morphology_path, fascicle_path,
+                                                     stitching_tolerance, file_buffers, executor, options['dtype'])
+                    write_segment_result(segment_result, partial_directory, options['levels_of_detail'],
+                                         options['streaming_output'], options['significant_digits'])
+                claim_owned = owns_work_item(claim_file, claim_token)
+                if claim_owned:
+                    output_files.extend(publish_output_files(partial_directory, output_directory,
+                                                             _manifest_file(queue_directory, segment_name)))
+                    # the claim may have been taken over while publishing, the new owner then publishes again
+                    claim_owned = owns_work_item(claim_file, claim_token)
+            except Exception:
+                stop_heartbeat.set()
+                shutil.rmtree(partial_directory, ignore_errors=True)
+                if owns_work_item(claim_file, claim_token):
+                    print('Warning: segment', segment_name, 'failed.')
+                    fail_work_item(queue_directory, segment_name, worker_name, claim_file, claim_token,
+                                   traceback.format_exc())
+                else:
+                    print('Warning: segment', segment_name, 'abandoned, its claim was taken over by another worker.')
+                continue
+            stop_heartbeat.set()
+            if not claim_owned:
+                # another worker is processing the segment, leave it to complete it
+                shutil.rmtree(partial_directory, ignore_errors=True)
+                print('Warning: segment', segment_name, 'abandoned, its claim was taken over by another worker.')
+                continue
+            complete_work_item(queue_directory, segment_name, worker_name, claim_file, claim_token)
+
+        if claimed_count == 0:
+            # remaining segments are being processed by other workers, wait for them or for their claims to go stale
+            time.sleep(poll_interval)
+
+    return output_files